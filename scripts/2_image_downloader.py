@@ -3,25 +3,88 @@
 Missing Apple CDN variants are expected: HTTP 404 responses are skipped safely.
 Successful assets are appended to database/images.csv (filename + square res)
 for gallery discovery; the remaining metadata columns are filled in later.
+
+The job is I/O-bound, so downloads run on a single asyncio event loop sharing
+one keep-alive connection pool to the CDN. The number of requests in flight
+adapts AIMD-style to latency and throttling, up to --concurrency; transient
+failures are re-queued with jittered exponential backoff (honouring
+Retry-After) until their per-task retry budget runs out.
+
+Each image streams into <code>.png.part, is validated as it arrives (PNG
+signature, every chunk CRC, a final IEND) and is renamed into place only once
+it passes, so an interrupted transfer never leaves a truncated .png behind.
+A surviving .part is resumed with an HTTP Range request on the next attempt.
+
+Every finished image is recorded in a manifest (download_manifest.csv in the
+target folder) with its ETag, Last-Modified, byte size and SHA-256.
+--revalidate re-checks every image the manifest or images.csv knows about
+with conditional GETs, so only renders Apple has actually changed are
+transferred again.
+
+--probe sizes each new image before fetching it: a small render gives the
+product's fill ratio and corner kind, and a search over canvas sizes using
+one-byte Range requests finds where the CDN stops scaling and starts padding
+(the native master size). analyze_padding's rules then pick the canvas, so each image is
+fetched once at the right size instead of at 4608 and again after analysis.
+
+Progress lives in a small SQLite job store (download_jobs.sqlite3): every
+listed task's state, attempt count and timestamps are committed as workers
+go, so a killed run resumes where it stopped (a 404 stays missing unless
+--retry-missing asks again). 1_download_list.txt is imported into the store
+and pruned from it; new images.csv rows are exported from it.
 """
 
 import argparse
+import asyncio
 import csv
-import multiprocessing
+import hashlib
+import io
 import os
+import random
+import sqlite3
+import struct
 import time
-from dataclasses import dataclass
-from multiprocessing import Pool
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Iterable, List, Set, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
-import requests
+import aiohttp
 
 BASE_URL_TEMPLATE = "https://store.storeimages.cdn-apple.com/8755/as-images.apple.com/is/{code}?wid={wid}&hei={hei}&fmt=png-alpha"
 SCRIPT_DIR = Path(__file__).resolve().parent
 IMAGES_TO_DOWNLOAD_PATH = SCRIPT_DIR / "1_download_list.txt"
 IMAGES_CSV_PATH = SCRIPT_DIR.parent / "database" / "images.csv"
 DEFAULT_TARGET_FOLDER = Path("/Volumes/Storage/Images/download")
+JOB_STORE_PATH = SCRIPT_DIR / "download_jobs.sqlite3"
+DEFAULT_CONCURRENCY = 32      # ceiling for the adaptive in-flight window
+INITIAL_CONCURRENCY = 8       # window the run starts with
+MIN_CONCURRENCY = 1
+DEFAULT_MAX_ATTEMPTS = 5      # per-task retry budget (first try included)
+CONNECT_TIMEOUT = 15          # seconds to open a connection
+READ_TIMEOUT = 15             # seconds of silence tolerated mid-response
+CHUNK_SIZE = 64 * 1024
+PART_SUFFIX = ".part"              # in-progress download, resumable
+VALIDATOR_SUFFIX = ".part.etag"    # ETag/Last-Modified the .part came from
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+MANIFEST_NAME = "download_manifest.csv"  # written inside the target folder
+MANIFEST_HEADER = ["code", "wid", "hei", "etag", "last_modified", "size", "sha256"]
+
+PROBE_CANVAS = 256          # small render used for fill ratio + corner kind
+PROBE_PRECISION = 64        # stop the native-size search once this tight (px)
+PADDING_GROWTH = 0.5        # bytes growing slower than this x linear = padding only
+
+BACKOFF_BASE = 1.0            # seconds; doubles with every failed attempt
+BACKOFF_CAP = 60.0            # longest backoff (and longest Retry-After honoured)
+THROTTLE_STATUSES = {429, 503}
+TRANSIENT_STATUSES = THROTTLE_STATUSES | {500, 502, 504}
+LATENCY_SMOOTHING = 0.2       # EWMA weight of the newest latency/error sample
+LATENCY_CONGESTION = 3.0      # smoothed latency this far above baseline = congested
+LATENCY_SLACK = 0.25          # ...and at least this many seconds above it
+ERROR_RATE_LIMIT = 0.2        # smoothed error rate above this = congested
+DECREASE_FACTOR = 0.5         # multiplicative window decrease on congestion
 
 # Column order of database/images.csv. The downloader only knows the filename
 # and the square resolution it requested; hidden/colour/non_transparent are
@@ -37,6 +100,86 @@ class DownloadTask:
     folder: Path
 
 
+@dataclass(frozen=True)
+class DownloadResult:
+    """Outcome of one attempt, returned by value from the download engine.
+
+    outcome is one of "downloaded", "existing", "unchanged" / "updated"
+    (--revalidate), "missing" (HTTP 404), "transient" (worth retrying) or
+    "failed" (permanent for this run); see download_image for which of those
+    count as resolved.
+    """
+
+    task: DownloadTask
+    outcome: str
+    note: str = ""
+    latency: Optional[float] = None      # seconds until response headers
+    retry_after: Optional[float] = None  # server-requested delay, seconds
+    throttled: bool = False              # 429/503, timeout or dropped connection
+
+    @property
+    def succeeded(self) -> bool:
+        return self.outcome in ("downloaded", "existing", "unchanged", "updated")
+
+    @property
+    def resolved(self) -> bool:
+        return self.succeeded or self.outcome == "missing"
+
+    @property
+    def retryable(self) -> bool:
+        return self.outcome == "transient"
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    etag: str
+    last_modified: str
+    size: int
+    sha256: str
+
+
+class DownloadManifest:
+    """Validators and content fingerprints of every downloaded image.
+
+    Keyed by (code, wid, hei): a different requested canvas is a different
+    rendition with its own ETag. Kept in memory during a run and rewritten
+    atomically by save().
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: Dict[Tuple[str, int, int], ManifestEntry] = {}
+        if path.exists():
+            with path.open("r", encoding="utf-8", newline="") as file:
+                for row in csv.DictReader(file):
+                    key = (row["code"], int(row["wid"]), int(row["hei"]))
+                    self.entries[key] = ManifestEntry(
+                        etag=row.get("etag") or "",
+                        last_modified=row.get("last_modified") or "",
+                        size=int(row.get("size") or 0),
+                        sha256=row.get("sha256") or "",
+                    )
+
+    def get(self, task: "DownloadTask") -> Optional[ManifestEntry]:
+        return self.entries.get((task.code, task.width, task.height))
+
+    def record(self, task: "DownloadTask", entry: ManifestEntry) -> None:
+        self.entries[(task.code, task.width, task.height)] = entry
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with tmp_path.open("w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file, lineterminator="\n")
+            writer.writerow(MANIFEST_HEADER)
+            for (code, wid, hei), entry in sorted(self.entries.items()):
+                writer.writerow(
+                    [code, wid, hei, entry.etag, entry.last_modified,
+                     entry.size, entry.sha256]
+                )
+        os.replace(tmp_path, self.path)
+
+
 def parse_resolution(resolution: str) -> Tuple[int, int]:
     cleaned = resolution.lower().replace(" ", "")
     if "x" not in cleaned:
@@ -88,6 +231,34 @@ def parse_tasks(file_path: Path, target_folder: Path) -> List[DownloadTask]:
     return tasks
 
 
+def catalogue_tasks(
+    images_csv: Path, manifest: DownloadManifest, target_folder: Path
+) -> List[DownloadTask]:
+    """Every already-downloaded image, for a --revalidate sweep.
+
+    Manifest entries come first (they carry validators, so most will answer
+    304); images.csv rows whose PNG is on disk but not yet in the manifest
+    follow and are fetched once unconditionally to bootstrap their entry.
+    """
+    tasks: List[DownloadTask] = []
+    seen: Set[str] = set()
+    for code, wid, hei in manifest.entries:
+        if code not in seen and (target_folder / f"{code}.png").is_file():
+            seen.add(code)
+            tasks.append(DownloadTask(code, wid, hei, target_folder))
+    if images_csv.exists():
+        with images_csv.open("r", encoding="utf-8", newline="") as file:
+            for row in csv.DictReader(file):
+                code = (row.get("filename") or "").strip()
+                res = (row.get("res") or "").strip()
+                if not code or not res.isdigit() or code in seen:
+                    continue
+                if (target_folder / f"{code}.png").is_file():
+                    seen.add(code)
+                    tasks.append(DownloadTask(code, int(res), int(res), target_folder))
+    return tasks
+
+
 def load_existing_codes(path: Path) -> Set[str]:
     if not path.exists():
         return set()
@@ -119,7 +290,337 @@ def append_image_rows(path: Path, rows: Iterable[Tuple[str, int]]) -> None:
             writer.writerow([code, res, *blanks])
 
 
-def download_image(task: DownloadTask, failed_list, success_list, resolved_list) -> bool:
+JOB_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    code TEXT PRIMARY KEY,
+    wid INTEGER NOT NULL,
+    hei INTEGER NOT NULL,
+    folder TEXT NOT NULL,
+    state TEXT NOT NULL,           -- pending | in-flight | done | missing | transient | failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    fetched_wid INTEGER,           -- canvas actually downloaded (--probe may change it)
+    note TEXT NOT NULL DEFAULT '',
+    exported INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (code TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+# Job state recorded for each DownloadResult outcome.
+OUTCOME_STATES = {
+    "downloaded": "done",
+    "existing": "done",
+    "unchanged": "done",
+    "updated": "done",
+    "missing": "missing",
+    "transient": "transient",
+    "failed": "failed",
+}
+
+
+class JobStore:
+    """SQLite record of every listed download and how far it got.
+
+    1_download_list.txt is imported into the store (and pruned of resolved
+    lines from it); images.csv is mirrored into the images table, re-read only
+    when the file changes, and new rows are exported from finished jobs.
+    Every state change is committed immediately: a killed run leaves its
+    finished jobs done and its in-flight ones pending for the next run.
+    During downloads the scheduler makes those commits on one helper thread,
+    off the event loop, so the connection is not tied to the main thread.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(JOB_STORE_SCHEMA)
+        with self.db:
+            self.db.execute("UPDATE jobs SET state = 'pending' WHERE state = 'in-flight'")
+
+    def close(self) -> None:
+        self.db.close()
+
+    def import_tasks(self, tasks: Iterable[DownloadTask], retry_missing: bool = False) -> None:
+        """Sync the store with the list: the list says what is still wanted.
+
+        New lines become pending jobs. A listed job stays done only while its
+        file is still on disk, and stays missing (a 404) unless retry_missing
+        asks for another try, so a killed run resumes exactly where it
+        stopped. Anything else listed is pending again. Unresolved jobs whose
+        line was deleted from the list are dropped.
+        """
+        now = time.time()
+        listed: Set[str] = set()
+        with self.db:
+            for task in tasks:
+                listed.add(task.code)
+                done_on_disk = (task.folder / f"{task.code}.png").is_file()
+                self.db.execute(
+                    """
+                    INSERT INTO jobs (code, wid, hei, folder, state, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, 'pending', ?, ?)
+                    ON CONFLICT (code) DO UPDATE SET
+                        wid = excluded.wid,
+                        hei = excluded.hei,
+                        folder = excluded.folder,
+                        state = CASE WHEN state = 'done' AND ? THEN 'done'
+                                     WHEN state = 'missing' AND NOT ? THEN 'missing'
+                                     ELSE 'pending' END,
+                        updated_at = excluded.updated_at
+                    """,
+                    (task.code, task.width, task.height, str(task.folder), now, now,
+                     done_on_disk, retry_missing),
+                )
+            unresolved = self.db.execute(
+                "SELECT code FROM jobs WHERE state NOT IN ('done', 'missing')"
+            ).fetchall()
+            self.db.executemany(
+                "DELETE FROM jobs WHERE code = ?",
+                [(code,) for (code,) in unresolved if code not in listed],
+            )
+
+    def runnable(self) -> List[DownloadTask]:
+        rows = self.db.execute(
+            "SELECT code, wid, hei, folder FROM jobs "
+            "WHERE state NOT IN ('done', 'missing') ORDER BY rowid"
+        ).fetchall()
+        return [DownloadTask(code, wid, hei, Path(folder)) for code, wid, hei, folder in rows]
+
+    def start(self, task: DownloadTask) -> None:
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET state = 'in-flight', attempts = attempts + 1, "
+                "started_at = ?, updated_at = ? WHERE code = ?",
+                (now, now, task.code),
+            )
+
+    def record(self, result: DownloadResult) -> None:
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET state = ?, fetched_wid = ?, note = ?, updated_at = ? "
+                "WHERE code = ?",
+                (OUTCOME_STATES[result.outcome], result.task.width, result.note,
+                 time.time(), result.task.code),
+            )
+
+    def resolved_codes(self) -> Set[str]:
+        rows = self.db.execute(
+            "SELECT code FROM jobs WHERE state IN ('done', 'missing')"
+        ).fetchall()
+        return {code for (code,) in rows}
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def sync_images_csv(self, path: Path) -> None:
+        """Mirror images.csv filenames, re-parsing only if the file changed."""
+        signature = self._signature(path)
+        stored = self.db.execute("SELECT value FROM meta WHERE key = 'images_csv'").fetchone()
+        if stored and stored[0] == signature:
+            return
+        with self.db:
+            self.db.execute("DELETE FROM images")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO images (code) VALUES (?)",
+                [(code,) for code in load_existing_codes(path)],
+            )
+            self._save_signature(path)
+
+    def export_images_csv(self, path: Path) -> int:
+        """Append finished, not-yet-listed jobs to images.csv; returns the count."""
+        rows = self.db.execute(
+            "SELECT code, COALESCE(fetched_wid, wid) FROM jobs "
+            "WHERE state = 'done' AND NOT exported "
+            "AND code NOT IN (SELECT code FROM images) ORDER BY rowid"
+        ).fetchall()
+        append_image_rows(path, rows)
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO images (code) VALUES (?)", [(code,) for code, _ in rows]
+            )
+            self.db.execute("UPDATE jobs SET exported = 1 WHERE state = 'done'")
+            self._save_signature(path)
+        return len(rows)
+
+    @staticmethod
+    def _signature(path: Path) -> str:
+        if not path.exists():
+            return ""
+        stat = path.stat()
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _save_signature(self, path: Path) -> None:
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('images_csv', ?)",
+            (self._signature(path),),
+        )
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (delta-seconds or HTTP-date) into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class PngIntegrityError(ValueError):
+    """Raised when a PNG byte stream is corrupt or ends before IEND."""
+
+
+class PngStreamValidator:
+    """Incrementally checks a PNG as its bytes arrive.
+
+    Verifies the signature, that IHDR comes first, every chunk's CRC, and that
+    the stream ends exactly at IEND. Chunk payloads are hashed as they pass,
+    never buffered, so multi-MB IDAT chunks cost no extra memory. The whole
+    stream is also SHA-256'd for the download manifest.
+    """
+
+    def __init__(self) -> None:
+        self.offset = 0
+        self.digest = hashlib.sha256()
+        self.complete = False
+        self._buffer = b""
+        self._signature_ok = False
+        self._chunk_type = b""
+        self._remaining = 0     # payload bytes left in the current chunk
+        self._in_payload = False
+        self._crc = 0
+        self._chunks = 0
+
+    def feed(self, data: bytes) -> None:
+        self.offset += len(data)
+        self.digest.update(data)
+        view = memoryview(data)
+        while view:
+            if self.complete:
+                raise PngIntegrityError("data after IEND")
+            if self._in_payload:
+                take = min(self._remaining, len(view))
+                self._crc = zlib.crc32(view[:take], self._crc)
+                self._remaining -= take
+                view = view[take:]
+                if not self._remaining:
+                    self._in_payload = False
+                continue
+            need = self._header_size()
+            take = min(need - len(self._buffer), len(view))
+            self._buffer += bytes(view[:take])
+            view = view[take:]
+            if len(self._buffer) == need:
+                self._consume_header()
+
+    def finish(self) -> None:
+        if not self.complete:
+            raise PngIntegrityError(f"truncated after {self.offset} bytes (no IEND)")
+
+    def _header_size(self) -> int:
+        if not self._signature_ok:
+            return len(PNG_SIGNATURE)
+        return 4 if self._chunk_type else 8  # CRC trailer, or length + type
+
+    def _consume_header(self) -> None:
+        header, self._buffer = self._buffer, b""
+        if not self._signature_ok:
+            if header != PNG_SIGNATURE:
+                raise PngIntegrityError("bad PNG signature")
+            self._signature_ok = True
+        elif self._chunk_type:
+            (expected,) = struct.unpack(">I", header)
+            if expected != self._crc & 0xFFFFFFFF:
+                name = self._chunk_type.decode("latin-1")
+                raise PngIntegrityError(f"CRC mismatch in {name} chunk #{self._chunks}")
+            self.complete = self._chunk_type == b"IEND"
+            self._chunk_type = b""
+        else:
+            length, chunk_type = struct.unpack(">I4s", header)
+            if length > 0x7FFFFFFF:
+                raise PngIntegrityError(f"chunk length {length} out of range")
+            if self._chunks == 0 and chunk_type != b"IHDR":
+                raise PngIntegrityError("first chunk is not IHDR")
+            self._chunks += 1
+            self._chunk_type = chunk_type
+            self._crc = zlib.crc32(chunk_type)
+            self._remaining = length
+            self._in_payload = length > 0
+
+
+def scan_png_file(path: Path) -> PngStreamValidator:
+    """Feed an on-disk (possibly partial) PNG through a fresh validator."""
+    validator = PngStreamValidator()
+    with path.open("rb") as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            validator.feed(chunk)
+    return validator
+
+
+def discard_partial(part_path: Path) -> None:
+    part_path.unlink(missing_ok=True)
+    part_path.with_name(part_path.name[: -len(PART_SUFFIX)] + VALIDATOR_SUFFIX).unlink(
+        missing_ok=True
+    )
+
+
+def prepare_resume(file_save_path: Path, part_path: Path) -> PngStreamValidator:
+    """Return a validator primed with whatever bytes are already on disk.
+
+    A non-empty final .png that fails validation (a truncated file from before
+    downloads were atomic) is demoted to .part so it can be resumed. A corrupt
+    .part is discarded and the download starts over.
+    """
+    if file_save_path.is_file() and file_save_path.stat().st_size > 0:
+        try:
+            validator = scan_png_file(file_save_path)
+            validator.finish()
+            return validator
+        except PngIntegrityError as exc:
+            print(f"Existing {file_save_path.name} is incomplete ({exc}); resuming")
+            discard_partial(part_path)
+            os.replace(file_save_path, part_path)
+
+    if part_path.is_file() and part_path.stat().st_size > 0:
+        try:
+            return scan_png_file(part_path)
+        except PngIntegrityError as exc:
+            print(f"Discarding corrupt partial {part_path.name} ({exc})")
+    discard_partial(part_path)
+    return PngStreamValidator()
+
+
+def conditional_headers(entry: Optional[ManifestEntry], size: int) -> Dict[str, str]:
+    """If-None-Match / If-Modified-Since for a file the manifest vouches for."""
+    if entry is None or entry.size != size:
+        return {}  # unknown or locally modified: fetch unconditionally
+    headers = {}
+    if entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+    return headers
+
+
+async def download_image(
+    session: aiohttp.ClientSession,
+    task: DownloadTask,
+    manifest: Optional[DownloadManifest] = None,
+    revalidate: bool = False,
+) -> DownloadResult:
     """Download one image.
 
     A code is "resolved" — safe to remove from list.txt — only on a definitive
@@ -127,69 +628,435 @@ def download_image(task: DownloadTask, failed_list, success_list, resolved_list)
     404 (the image will never exist). Transient/unknown errors (connection
     drops, retries exceeded, other HTTP codes, bad content type) are NOT
     resolved, so their lines stay in list.txt for a future retry.
+
+    Within a run, connection drops, timeouts, 429 and 5xx responses are
+    "transient" and get re-queued by the scheduler; other HTTP errors and a
+    bad content type are "failed" and are not retried until the next run.
+    A stream that fails PNG validation is discarded and counts as transient.
+
+    With revalidate, an existing file is re-requested conditionally: a 304 is
+    "unchanged", a new body replaces the file atomically and is "updated"
+    (or "unchanged" if its bytes turn out identical).
     """
     os.makedirs(task.folder, exist_ok=True)
     file_save_path = task.folder / f"{task.code}.png"
+    part_path = task.folder / f"{task.code}.png{PART_SUFFIX}"
+    validator_path = task.folder / f"{task.code}.png{VALIDATOR_SUFFIX}"
     url = BASE_URL_TEMPLATE.format(code=task.code, wid=task.width, hei=task.height)
 
-    if file_save_path.is_file() and file_save_path.stat().st_size > 0:
-        print(f"Skipping existing image {file_save_path}")
-        success_list.append(task.code)
-        resolved_list.append(task.code)
-        return True
+    validator = await asyncio.to_thread(prepare_resume, file_save_path, part_path)
+    previous = manifest.get(task) if manifest is not None else None
+    headers = {}
+    if validator.complete:
+        if previous is None and manifest is not None and not revalidate:
+            manifest.record(
+                task,
+                ManifestEntry("", "", validator.offset, validator.digest.hexdigest()),
+            )
+        if not revalidate:
+            print(f"Skipping existing image {file_save_path}")
+            return DownloadResult(task, "existing")
+        headers = conditional_headers(previous, validator.offset)
+        if previous is None:
+            previous = ManifestEntry("", "", validator.offset, validator.digest.hexdigest())
+        validator = PngStreamValidator()
+    elif validator.offset:
+        headers["Range"] = f"bytes={validator.offset}-"
+        if validator_path.is_file():
+            remote_version = validator_path.read_text(encoding="utf-8").strip()
+            if remote_version and not remote_version.startswith("W/"):
+                headers["If-Range"] = remote_version  # weak ETags are not allowed
 
+    started = time.monotonic()
+    latency = None
     try:
-        response = requests.get(url, stream=True, timeout=15)
-    except requests.exceptions.ConnectionError:
-        raise
-    except requests.exceptions.RequestException as exc:
-        print(f"Request error while downloading {task.code}.png: {exc}")
-        failed_list.append(task.code)
-        return False
-
-    if response.status_code == 404:
-        response.close()
-        print(f"Skipping unavailable image {task.code}.png (HTTP 404)")
-        failed_list.append(task.code)
-        resolved_list.append(task.code)
-        return False
-
-    if response.status_code >= 400:
-        status_code = response.status_code
-        response.close()
-        print(f"Skipping {task.code}.png (HTTP {status_code})")
-        failed_list.append(task.code)
-        return False
-
-    content_type = response.headers.get("content-type", "").lower()
-    if not content_type.startswith("image/"):
-        response.close()
-        print(f"Skipping {task.code}.png (unexpected content type: {content_type})")
-        failed_list.append(task.code)
-        return False
-
-    with open(file_save_path, "wb") as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                file.write(chunk)
-    response.close()
-
-    print(f"Downloaded {task.code}.png ({task.width}x{task.height}) to {task.folder}")
-    success_list.append(task.code)
-    resolved_list.append(task.code)
-    return True
-
-
-def download_worker(task):
-    download_task, failed_downloads, successful_downloads, resolved_downloads = task
-    try:
-        download_image(
-            download_task, failed_downloads, successful_downloads, resolved_downloads
+        async with session.get(url, headers=headers) as response:
+            latency = time.monotonic() - started
+            if response.status == 304:
+                return DownloadResult(task, "unchanged", "HTTP 304", latency)
+
+            if response.status == 404:
+                discard_partial(part_path)
+                print(f"Skipping unavailable image {task.code}.png (HTTP 404)")
+                return DownloadResult(task, "missing", "HTTP 404", latency)
+
+            if response.status == 416:
+                # Our partial is at least as long as the resource: start over.
+                discard_partial(part_path)
+                return DownloadResult(task, "transient", "HTTP 416", latency)
+
+            if response.status in TRANSIENT_STATUSES:
+                return DownloadResult(
+                    task,
+                    "transient",
+                    f"HTTP {response.status}",
+                    latency,
+                    retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                    throttled=response.status in THROTTLE_STATUSES,
+                )
+
+            if response.status >= 400:
+                print(f"Skipping {task.code}.png (HTTP {response.status})")
+                return DownloadResult(task, "failed", f"HTTP {response.status}", latency)
+
+            content_type = response.headers.get("content-type", "").lower()
+            if not content_type.startswith("image/"):
+                print(
+                    f"Skipping {task.code}.png (unexpected content type: {content_type})"
+                )
+                return DownloadResult(
+                    task, "failed", f"content type {content_type}", latency
+                )
+
+            resumed = response.status == 206 and response.headers.get(
+                "Content-Range", ""
+            ).startswith(f"bytes {validator.offset}-")
+            if not resumed:
+                # Full body (no Range support, or If-Range saw a new version).
+                validator = PngStreamValidator()
+                remote_version = response.headers.get("ETag") or response.headers.get(
+                    "Last-Modified"
+                )
+                if remote_version:
+                    validator_path.write_text(remote_version, encoding="utf-8")
+                else:
+                    validator_path.unlink(missing_ok=True)
+
+            with open(part_path, "ab" if resumed else "wb") as file:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    validator.feed(chunk)
+                    file.write(chunk)
+            validator.finish()
+    except PngIntegrityError as exc:
+        discard_partial(part_path)
+        print(f"Discarding corrupt download {task.code}.png ({exc})")
+        return DownloadResult(task, "transient", f"corrupt PNG: {exc}"[:80], latency)
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+        return DownloadResult(
+            task, "transient", f"{type(exc).__name__}: {exc}"[:80], latency,
+            throttled=True,
+        )
+    except aiohttp.ClientError as exc:
+        return DownloadResult(task, "transient", str(exc)[:80], latency)
+
+    os.replace(part_path, file_save_path)
+    validator_path.unlink(missing_ok=True)
+    sha256 = validator.digest.hexdigest()
+    if manifest is not None:
+        manifest.record(
+            task,
+            ManifestEntry(
+                etag=response.headers.get("ETag", ""),
+                last_modified=response.headers.get("Last-Modified", ""),
+                size=validator.offset,
+                sha256=sha256,
+            ),
         )
-    except requests.exceptions.ConnectionError as err:
-        print(f"Connection error while downloading {download_task.code}.png: {err}")
-        time.sleep(5)
-        download_worker(task)
+    if previous is not None and revalidate:
+        if previous.sha256 == sha256:
+            return DownloadResult(task, "unchanged", "same content", latency)
+        print(f"Updated {task.code}.png ({task.width}x{task.height}) in {task.folder}")
+        return DownloadResult(task, "updated", latency=latency)
+    how = "Resumed" if resumed else "Downloaded"
+    print(f"{how} {task.code}.png ({task.width}x{task.height}) to {task.folder}")
+    return DownloadResult(task, "downloaded", latency=latency)
+
+
+class ProbeError(Exception):
+    """A probe request could not be answered; fall back to the listed canvas."""
+
+
+async def rendition_size(session: aiohttp.ClientSession, code: str, canvas: int) -> int:
+    """Encoded byte size of one square rendition, without its body.
+
+    A one-byte Range request returns the total in Content-Range; servers
+    that ignore Range still send Content-Length before any body is read.
+    """
+    url = BASE_URL_TEMPLATE.format(code=code, wid=canvas, hei=canvas)
+    async with session.get(url, headers={"Range": "bytes=0-0"}) as response:
+        if response.status == 206:
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if total.isdigit():
+                return int(total)
+        elif response.status == 200 and response.content_length:
+            return response.content_length
+        raise ProbeError(f"no size for {canvas}px (HTTP {response.status})")
+
+
+async def probe_task(session: aiohttp.ClientSession, task: DownloadTask) -> DownloadTask:
+    """Return task resized to the canvas analyze_padding would propose.
+
+    The CDN scales the master down into canvases smaller than its native size
+    and pads (never scales up) beyond it. So the PROBE_CANVAS render gives the
+    product's share of the native frame, and the native size is the knee in
+    the rendition's byte size: below it, a bigger canvas means more product
+    pixels and the size grows at least linearly; past it, the extra canvas is
+    transparent padding that deflates to almost nothing. Binary search finds
+    the knee, two body-less size requests per step.
+    """
+    # Imported here so plain downloads don't need Pillow/NumPy.
+    from PIL import Image
+
+    import analyze_padding
+    import image_analysis
+
+    url = BASE_URL_TEMPLATE.format(code=task.code, wid=PROBE_CANVAS, hei=PROBE_CANVAS)
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise ProbeError(f"probe render HTTP {response.status}")
+        body = await response.read()
+    with Image.open(io.BytesIO(body)) as probe:
+        pixels = image_analysis.rgba_array(probe)
+    metrics = image_analysis.measure_array(pixels)
+    if metrics.bbox is None:
+        raise ProbeError("probe render is empty")
+    fill = metrics.bbox_long / metrics.canvas
+
+    lo, hi = PROBE_CANVAS, task.width
+    while hi - lo > PROBE_PRECISION:
+        mid = (lo + hi) // 2
+        step = PROBE_PRECISION // 2
+        size, larger = await asyncio.gather(
+            rendition_size(session, task.code, mid),
+            rendition_size(session, task.code, mid + step),
+        )
+        if (larger - size) / size < PADDING_GROWTH * step / mid:
+            hi = mid  # already padding at mid
+        else:
+            lo = mid
+    native = hi
+
+    # Re-sample the corner with the inset scaled down to the probe render.
+    inset = max(1, round(image_analysis.CORNER_INSET * metrics.canvas / native))
+    white_rect = analyze_padding.is_white(pixels, inset)
+
+    proposal = analyze_padding.propose(
+        task.code, task.width, round(fill * native), white_rect
+    )
+    print(f"Probed {task.code}: native ~{native}px, {proposal.kind}, {proposal.note}")
+    if not proposal.new_canvas:
+        return task
+    return replace(task, width=proposal.new_canvas, height=proposal.new_canvas)
+
+
+class AdaptiveLimiter:
+    """AIMD in-flight window driven by latency and error feedback.
+
+    Every clean response grows the window by 1/window (about +1 per window's
+    worth of responses). Throttling (429/503), timeouts, dropped connections,
+    a smoothed error rate above ERROR_RATE_LIMIT, or smoothed latency
+    LATENCY_CONGESTION times above the best seen so far shrink it by
+    DECREASE_FACTOR — at most once per smoothed round trip, so one burst of
+    failures counts as a single congestion signal.
+    """
+
+    def __init__(self, initial: int, maximum: int, minimum: int = MIN_CONCURRENCY):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.window = float(min(max(initial, minimum), self.maximum))
+        self.in_flight = 0
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self.error_rate = 0.0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.in_flight < int(self.window)
+            )
+            self.in_flight += 1
+
+    async def release(self, result: DownloadResult) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._record(result)
+            self._condition.notify_all()
+
+    def _record(self, result: DownloadResult) -> None:
+        if result.outcome == "existing":
+            return  # no request was made
+        if result.outcome == "failed" and result.latency is None:
+            return  # a local error (e.g. disk full) says nothing about the CDN
+        error = 0.0 if result.resolved else 1.0
+        self.error_rate += LATENCY_SMOOTHING * (error - self.error_rate)
+        if result.latency is not None:
+            if self.latency is None:
+                self.latency = result.latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (result.latency - self.latency)
+            self.baseline = (
+                self.latency if self.baseline is None else min(self.baseline, self.latency)
+            )
+
+        slow = (
+            self.latency is not None
+            and self.baseline is not None
+            and self.latency > self.baseline * LATENCY_CONGESTION
+            and self.latency > self.baseline + LATENCY_SLACK
+        )
+        if result.throttled or slow or self.error_rate > ERROR_RATE_LIMIT:
+            now = time.monotonic()
+            if now - self._last_decrease >= max(1.0, self.latency or 0.0):
+                self._last_decrease = now
+                self.window = max(self.minimum, self.window * DECREASE_FACTOR)
+        elif not error:
+            self.window = min(self.maximum, self.window + 1.0 / self.window)
+
+
+class DownloadScheduler:
+    """Queue of download tasks with bounded, backed-off retries.
+
+    Workers never retry inline: a transient result puts the task back on the
+    queue after a jittered exponential backoff (or the server's Retry-After,
+    whichever is longer), freeing the worker and its window slot meanwhile.
+    Each task keeps its final result once it resolves, fails permanently, or
+    exhausts max_attempts.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        limiter: AdaptiveLimiter,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        manifest: Optional[DownloadManifest] = None,
+        revalidate: bool = False,
+        probe: bool = False,
+        store: Optional[JobStore] = None,
+    ):
+        self.session = session
+        self.limiter = limiter
+        self.max_attempts = max(1, max_attempts)
+        self.manifest = manifest
+        self.revalidate = revalidate
+        self.probe = probe
+        self.probed: Dict[DownloadTask, DownloadTask] = {}
+        self.store = store
+        self.queue: "asyncio.Queue[DownloadTask]" = asyncio.Queue()
+        self.attempts: Dict[DownloadTask, int] = {}
+        self.results: List[DownloadResult] = []
+        self.outstanding = 0
+        self.finished = asyncio.Event()
+        # Job store commits run here, one at a time, off the event loop.
+        self.store_thread = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, task: DownloadTask) -> None:
+        self.outstanding += 1
+        self.queue.put_nowait(task)
+
+    async def run(self, workers: int) -> List[DownloadResult]:
+        if not self.outstanding:
+            return self.results
+        pool = [asyncio.create_task(self._worker()) for _ in range(workers)]
+        finished = asyncio.create_task(self.finished.wait())
+        try:
+            done, _ = await asyncio.wait(
+                [finished, *pool], return_when=asyncio.FIRST_COMPLETED
+            )
+            for worker in done - {finished}:
+                worker.result()  # a crashed worker would otherwise hang the run
+        finally:
+            finished.cancel()
+            for worker in pool:
+                worker.cancel()
+            await asyncio.gather(*pool, return_exceptions=True)
+            self.store_thread.shutdown()
+        return self.results
+
+    def backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, BACKOFF_CAP))
+        return delay
+
+    async def _sized(self, task: DownloadTask) -> DownloadTask:
+        """The task at its probed canvas (--probe), probing at most once."""
+        if not self.probe or task.width != task.height:
+            return task
+        if task not in self.probed:
+            if (task.folder / f"{task.code}.png").is_file():
+                self.probed[task] = task  # already downloaded: keep its size
+            else:
+                try:
+                    self.probed[task] = await probe_task(self.session, task)
+                except (ProbeError, aiohttp.ClientError, asyncio.TimeoutError, OSError) as exc:
+                    print(f"Probe failed for {task.code} ({exc}); using {task.width}px")
+                    self.probed[task] = task
+        return self.probed[task]
+
+    async def _stored(self, method: Callable[..., None], *args: object) -> None:
+        if self.store is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.store_thread, method, *args)
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            task = await self.queue.get()
+            await self.limiter.acquire()
+            result = DownloadResult(task, "transient", "cancelled")
+            try:
+                sized = await self._sized(task)  # probing is not a download attempt
+                await self._stored(JobStore.start, self.store, task)
+                result = await download_image(
+                    self.session, sized, self.manifest, self.revalidate
+                )
+            except OSError as exc:
+                # Local I/O (e.g. a full disk): fail this task, not the run.
+                print(f"Failed to save {task.code}.png ({exc})")
+                result = DownloadResult(task, "failed", f"{type(exc).__name__}: {exc}"[:80])
+            finally:
+                await self.limiter.release(result)
+            await self._stored(JobStore.record, self.store, result)
+
+            attempt = self.attempts.get(task, 0) + 1
+            self.attempts[task] = attempt
+            if result.retryable and attempt < self.max_attempts:
+                delay = self.backoff(attempt, result.retry_after)
+                print(
+                    f"Retrying {task.code}.png in {delay:.1f}s "
+                    f"({result.note}; attempt {attempt}/{self.max_attempts}, "
+                    f"window {int(self.limiter.window)})"
+                )
+                loop.call_later(delay, self.queue.put_nowait, task)
+                continue
+
+            if result.retryable:
+                print(f"Giving up on {task.code}.png for this run ({result.note})")
+            self.results.append(result)
+            self.outstanding -= 1
+            if not self.outstanding:
+                self.finished.set()
+
+
+async def download_all(
+    tasks: Iterable[DownloadTask],
+    concurrency: int,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    manifest: Optional[DownloadManifest] = None,
+    revalidate: bool = False,
+    probe: bool = False,
+    store: Optional[JobStore] = None,
+) -> List[DownloadResult]:
+    """Run every task over one pooled, keep-alive HTTP session.
+
+    At most `concurrency` requests are ever in flight; the adaptive window
+    decides how many actually are. Connections to the CDN are reused across
+    tasks instead of paying a TCP/TLS handshake per image.
+    """
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+    )
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        limiter = AdaptiveLimiter(INITIAL_CONCURRENCY, concurrency)
+        scheduler = DownloadScheduler(
+            session, limiter, max_attempts, manifest, revalidate, probe, store
+        )
+        for task in tasks:
+            scheduler.submit(task)
+        return await scheduler.run(concurrency)
 
 
 def remove_resolved_lines(path: Path, resolved_codes: Set[str]) -> int:
@@ -240,22 +1107,55 @@ def parse_args() -> argparse.Namespace:
         help="Folder where downloaded PNGs will be stored.",
     )
     parser.add_argument(
-        "--processes",
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Upper bound on the adaptive number of downloads in flight.",
+    )
+    parser.add_argument(
+        "--max-attempts",
         type=int,
-        default=multiprocessing.cpu_count(),
-        help="Number of worker processes to use.",
+        default=DEFAULT_MAX_ATTEMPTS,
+        help="Attempts per image before a transient failure is left for the next run.",
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help=(
+            "Also re-check every image already downloaded (manifest + images.csv) "
+            "with conditional GETs and re-fetch only those that changed."
+        ),
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help=f"Download manifest CSV (default: <target-folder>/{MANIFEST_NAME}).",
+    )
+    parser.add_argument(
+        "--job-store",
+        type=Path,
+        default=JOB_STORE_PATH,
+        help="SQLite file holding per-task progress (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--retry-missing",
+        action="store_true",
+        help="Request listed images that returned 404 on an earlier run again.",
+    )
+    parser.add_argument(
+        "--probe",
+        action="store_true",
+        help=(
+            "Probe each new square image's native size and fetch it at the canvas "
+            "analyze_padding.py would propose instead of the listed resolution."
+        ),
     )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
-    existing_codes = load_existing_codes(IMAGES_CSV_PATH)
-
-    manager = multiprocessing.Manager()
-    failed_downloads = manager.list()
-    successful_downloads = manager.list()
-    resolved_downloads = manager.list()
 
     input_file = (
         args.input_file
@@ -268,33 +1168,67 @@ if __name__ == "__main__":
         else (SCRIPT_DIR / args.target_folder).resolve()
     )
 
-    tasks = parse_tasks(input_file, target_folder)
-    worker_payloads = [
-        (task, failed_downloads, successful_downloads, resolved_downloads)
-        for task in tasks
-    ]
+    manifest = DownloadManifest(args.manifest or target_folder / MANIFEST_NAME)
+    store = JobStore(args.job_store)
+    listed_tasks = parse_tasks(input_file, target_folder)
+    store.import_tasks(listed_tasks, args.retry_missing)
+    store.sync_images_csv(IMAGES_CSV_PATH)
 
-    if not worker_payloads:
+    tasks = store.runnable()
+    already_done = len({task.code for task in listed_tasks} & store.resolved_codes())
+    if already_done:
+        print(f"{already_done} listed image(s) already resolved in {args.job_store.name}.")
+    run_tasks = list(tasks)
+    if args.revalidate:
+        listed = {task.code for task in tasks}
+        run_tasks.extend(
+            task
+            for task in catalogue_tasks(IMAGES_CSV_PATH, manifest, target_folder)
+            if task.code not in listed
+        )
+        print(f"Revalidating {len(run_tasks) - len(tasks)} downloaded image(s).")
+
+    results: List[DownloadResult] = []
+    if not run_tasks:
         print("No images to process.")
     else:
-        with Pool(args.processes) as pool:
-            pool.map(download_worker, worker_payloads)
-
-    successful_set = set(successful_downloads)
-    ordered_new_rows: List[Tuple[str, int]] = []
-    seen = set()
-    for task in tasks:
-        code = task.code
-        if code in successful_set and code not in existing_codes and code not in seen:
-            seen.add(code)
-            ordered_new_rows.append((code, task.width))
-    append_image_rows(IMAGES_CSV_PATH, ordered_new_rows)
+        try:
+            results = asyncio.run(
+                download_all(
+                    run_tasks,
+                    max(1, args.concurrency),
+                    args.max_attempts,
+                    manifest=manifest,
+                    revalidate=args.revalidate,
+                    probe=args.probe,
+                    store=store,
+                )
+            )
+        finally:
+            manifest.save()
+
+    added = store.export_images_csv(IMAGES_CSV_PATH)
+    if added:
+        print(f"\nAppended {added} row(s) to {IMAGES_CSV_PATH.name}.")
 
-    removed = remove_resolved_lines(input_file, set(resolved_downloads))
+    removed = remove_resolved_lines(input_file, store.resolved_codes())
     if removed:
         print(f"\nRemoved {removed} resolved line(s) from {input_file.name}.")
 
+    failed_downloads = [result for result in results if not result.succeeded]
     if failed_downloads:
         print("\nFailed downloads:")
-        for code in failed_downloads:
-            print(f" - {code}")
+        for result in failed_downloads:
+            kind = "resolved" if result.resolved else result.outcome
+            print(f" - {result.task.code} ({kind}: {result.note})")
+
+    if args.revalidate:
+        updated = [r.task.code for r in results if r.outcome == "updated"]
+        unchanged = sum(r.outcome == "unchanged" for r in results)
+        print(f"\nRevalidation: {len(updated)} updated, {unchanged} unchanged.")
+        for code in updated:
+            print(f" ~ {code}")
+
+    counts = store.counts()
+    store.close()
+    print("\nJob store: " + ", ".join(f"{n} {state}" for state, n in sorted(counts.items())))
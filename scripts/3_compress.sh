@@ -9,6 +9,12 @@ set -euo pipefail
 # from the lossless PNG (dssim < 0.0002) while running ~3x smaller than the
 # WebP-lossless sources this pipeline used to emit. See scripts benchmark.
 #
+# Both passes read the masters' 512px and 2048px mipmap levels
+# (mipmap_store.py) instead of decoding and downscaling the full master: one
+# Python run builds just those two levels up front (one decode per master),
+# then each pass copies the levels of its stale outputs in a single batch, and
+# xargs only runs the encoders.
+#
 # macOS-native: BSD xargs provides the parallelism (no GNU parallel, no
 # bash-4 features), and the job count defaults to the machine's core count.
 # All paths are absolute, so it can be launched from any directory; override
@@ -16,6 +22,7 @@ set -euo pipefail
 folder_x="${FINAL_SOURCES:-/Volumes/Storage/Images/1_final-sources}"
 folder_y="${AVIF_SOURCES:-/Volumes/Storage/Images/2_compressed-avif-sources}"
 folder_z="${AVIF_PREVIEWS:-/Volumes/Storage/Images/3_compressed-avif-previews}"
+scripts_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 jobs="${MAX_JOBS:-$(sysctl -n hw.ncpu 2>/dev/null || nproc 2>/dev/null || echo 8)}"
 
 command -v magick >/dev/null 2>&1 || {
@@ -23,6 +30,11 @@ command -v magick >/dev/null 2>&1 || {
   exit 1
 }
 
+command -v python3 >/dev/null 2>&1 || {
+  echo "python3 (with Pillow and NumPy) is required for mipmap_store.py." >&2
+  exit 1
+}
+
 command -v avifenc >/dev/null 2>&1 || {
   echo "avifenc is required (install with 'brew install libavif')." >&2
   exit 1
@@ -43,54 +55,63 @@ if [ -z "$first_png" ]; then
   exit 0
 fi
 
+stage=$(mktemp -d "${TMPDIR:-/tmp}/compress.XXXXXX")
+trap 'rm -rf "$stage"' EXIT
+mkdir -p "$stage/previews" "$stage/sources"
 export folder_y folder_z
 
-# Each worker skips outputs that are newer than their source and rebuilds
-# stale ones. A failed file makes the whole pass (and script) exit non-zero,
-# but unlike parallel's --halt, in-flight siblings still finish their file.
+# NUL-separated masters whose "$1/<name>.avif" is missing, dropping outputs
+# that are older than their source so they get rebuilt.
+stale_sources() {
+  find "$folder_x" -maxdepth 1 -type f -iname '*.png' -print0 |
+    while IFS= read -r -d '' file; do
+      base="${file##*/}"
+      out="$1/${base%.*}.avif"
+      if [ -e "$out" ] && [ "$file" -nt "$out" ]; then
+        rm -f "$out"
+      fi
+      [ -e "$out" ] || printf '%s\0' "$file"
+    done
+}
+
+# A failed file makes its pass (and the script) exit non-zero, but the other
+# files of the pass still get exported and encoded.
+status=0
 
+echo "Building 512px and 2048px mipmap levels with $jobs jobs..."
+python3 "$scripts_dir/mipmap_store.py" build --workers "$jobs" --edge 512 --edge 2048 \
+  "$folder_x" || status=1
+
+# The 512px level is already the preview size; a master no bigger than that
+# is exported as is (never upscaled), so ImageMagick only encodes.
 echo "Compressing AVIF previews with $jobs jobs..."
-find "$folder_x" -maxdepth 1 -type f -iname '*.png' -print0 |
+stale_sources "$folder_z" |
+  xargs -0 python3 "$scripts_dir/mipmap_store.py" export --workers "$jobs" 512 "$stage/previews" ||
+  status=1
+find "$stage/previews" -maxdepth 1 -type f -name '*.png' -print0 |
   xargs -0 -P "$jobs" -I{} bash -c '
     set -euo pipefail
-    file="$1"
-    base="${file##*/}"
-    base="${base%.*}"
-    out="$folder_z/$base.avif"
-    # Drop a stale output if the source has changed since it was created.
-    [ -e "$out" ] && [ "$file" -nt "$out" ] && rm -f "$out"
-    [ -e "$out" ] && exit 0
-    # ">" = shrink-only: never upscale a master smaller than the target.
-    magick "$file" -resize "512x512>" -quality 90 -strip -filter Lanczos \
-      -define avif:codec=aom -define avif:speed=0 "$out"
-  ' _ {}
+    base="${1##*/}"
+    magick "$1" -quality 90 -strip \
+      -define avif:codec=aom -define avif:speed=0 "$folder_z/${base%.*}.avif"
+  ' _ {} || status=1
 
+# avifenc cannot resize, so the 2048px level (LANCZOS, like the previews) is
+# exported as a PNG for it. Masters at or below 2048px are exported as is and
+# encoded at native size: resizing would only upscale and refilter them.
 echo "Compressing AVIF q95 sources with $jobs jobs..."
-find "$folder_x" -maxdepth 1 -type f -iname '*.png' -print0 |
+stale_sources "$folder_y" |
+  xargs -0 python3 "$scripts_dir/mipmap_store.py" export --workers "$jobs" 2048 "$stage/sources" ||
+  status=1
+find "$stage/sources" -maxdepth 1 -type f -name '*.png' -print0 |
   xargs -0 -P "$jobs" -I{} bash -c '
     set -euo pipefail
-    file="$1"
-    base="${file##*/}"
-    base="${base%.*}"
-    out="$folder_y/$base.avif"
-    # Drop a stale output if the source has changed since it was created.
-    [ -e "$out" ] && [ "$file" -nt "$out" ] && rm -f "$out"
-    [ -e "$out" ] && exit 0
-    # Masters at or below 2048px are encoded at native size, straight from
-    # the PNG — resizing would only upscale and refilter them.
-    dims=$(magick identify -ping -format "%w %h" "$file")
-    w=${dims% *}
-    h=${dims#* }
-    if [ "$w" -le 2048 ] && [ "$h" -le 2048 ]; then
-      avifenc -j 1 -s 4 -q 95 -y 444 "$file" "$out" >/dev/null
-      exit 0
-    fi
-    # avifenc cannot resize, so ImageMagick produces the 2048px pixels into a
-    # temp PNG (same Lanczos downscale as the previews) and avifenc encodes it.
-    tmp="$folder_y/.$base.tmp.png"
-    trap "rm -f \"$tmp\"" EXIT
-    magick "$file" -resize 2048x2048 -strip -filter Lanczos "$tmp"
-    avifenc -j 1 -s 4 -q 95 -y 444 "$tmp" "$out" >/dev/null
-  ' _ {}
+    base="${1##*/}"
+    avifenc -j 1 -s 4 -q 95 -y 444 "$1" "$folder_y/${base%.*}.avif" >/dev/null
+  ' _ {} || status=1
 
+[ "$status" -eq 0 ] || {
+  echo "Some files failed; see the errors above." >&2
+  exit "$status"
+}
 echo "Done."
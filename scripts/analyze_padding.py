@@ -21,11 +21,13 @@ download anything. Feed the list to 2_image_downloader.py to fetch.
 """
 
 import argparse
-import subprocess
-from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 
+import numpy as np
+
+from image_analysis import CORNER_INSET, ImageMetrics, MetricsCache, measure_array
+
 SCRIPT_DIR = Path(__file__).resolve().parent
 DEFAULT_SOURCE = Path("/Volumes/Storage/Images/download")
 DEFAULT_LIST = SCRIPT_DIR / "download2_list.txt"
@@ -34,8 +36,6 @@ DEFAULT_REPORT = SCRIPT_DIR / "download2_report.csv"
 TARGET_FILL = 0.65          # product fills this fraction of the long side
 MIN_RECLAIM = 0.10          # only re-download if we shrink the canvas >= this
 MIN_CANVAS = 1000           # never re-download smaller than this (tiny masters)
-WHITE_THRESHOLD = 250       # r,g,b all >= this (0-255) counts as "white"
-CORNER_INSET = 8            # px inside the bbox corner to sample
 
 
 @dataclass
@@ -48,58 +48,46 @@ class Analysis:
     note: str = ""
 
 
-def _im(args: list[str]) -> str:
-    return subprocess.run(
-        ["convert", *args], capture_output=True, text=True, timeout=60
-    ).stdout.strip()
-
-
-def analyse(path: Path) -> Analysis:
+def analyse(path: Path, metrics: ImageMetrics | Exception) -> Analysis:
     code = path.stem
-    try:
-        w, h = _im([str(path), "-format", "%w %h", "info:"]).split()
-        canvas = max(int(w), int(h))
-
-        # Trim bounding box (%@) using the transparent corner as reference.
-        trim = _im([str(path), "-format", "%@", "info:"])
-        bw, rest = trim.split("x", 1)
-        bh, xoff, yoff = rest.replace("+", " ").split()
-        bbox_long = max(int(bw), int(bh))
-        x, y = int(xoff), int(yoff)
-
-        if bbox_long <= 0:
-            return Analysis(code, canvas, 0, "empty", 0, "no content found")
-
-        # Sample just inside the bbox corner to classify the padding.
-        px = _im([str(path), "-format",
-                  f"%[pixel:p{{{x + CORNER_INSET},{y + CORNER_INSET}}}]", "info:"])
-        r, g, b, a = _parse_pixel(px)
-        is_white_rect = a > 0.5 and min(r, g, b) >= WHITE_THRESHOLD
-
-        if is_white_rect:
-            new_canvas = bbox_long
-            kind = "white-rect"
-        else:
-            new_canvas = round(bbox_long / TARGET_FILL)
-            kind = "alpha"
-
-        new_canvas = min(max(new_canvas, MIN_CANVAS), canvas)
-        if new_canvas > canvas * (1 - MIN_RECLAIM):
-            return Analysis(code, canvas, bbox_long, kind, 0,
-                            f"fills {bbox_long/canvas:.0%} - leave alone")
-        return Analysis(code, canvas, bbox_long, kind, new_canvas,
-                        f"{bbox_long/canvas:.0%} -> {new_canvas}px")
-    except Exception as exc:  # noqa: BLE001 - report and continue
-        return Analysis(code, 0, 0, "error", 0, str(exc)[:80])
-
-
-def _parse_pixel(px: str) -> tuple[float, float, float, float]:
-    """Parse ImageMagick 'srgba(r,g,b,a)' / 'srgb(r,g,b)' into (r,g,b,a 0-1)."""
-    inside = px[px.index("(") + 1:px.index(")")]
-    parts = [p.strip() for p in inside.split(",")]
-    r, g, b = (float(parts[i]) for i in range(3))
-    a = float(parts[3]) if len(parts) > 3 else 1.0
-    return r, g, b, a
+    if isinstance(metrics, Exception):  # report and continue
+        return Analysis(code, 0, 0, "error", 0, str(metrics)[:80])
+    if metrics.bbox is None:
+        return Analysis(code, metrics.canvas, 0, "empty", 0, "no content found")
+    # The colour just inside the bbox corner classifies the padding.
+    return propose(code, metrics.canvas, metrics.bbox_long, metrics.white_corner)
+
+
+def is_white(pixels: np.ndarray, inset: int = CORNER_INSET) -> bool:
+    """Whether the product in an (H, W, 4) RGBA array is white-rectangle art,
+    judged as analyse() judges a measured master: by the colour `inset` px
+    inside the corner of its bounding box.
+
+    Shared with 2_image_downloader.py --probe, which passes an inset scaled
+    down to its small probe render.
+    """
+    return measure_array(pixels, inset).white_corner
+
+
+def propose(code: str, canvas: int, bbox_long: int, white_rect: bool) -> Analysis:
+    """Apply the canvas rules above to one measured product.
+
+    Shared with 2_image_downloader.py --probe, which measures bbox_long from
+    cheap probe renders instead of a full 4608 download.
+    """
+    if white_rect:
+        new_canvas = bbox_long
+        kind = "white-rect"
+    else:
+        new_canvas = round(bbox_long / TARGET_FILL)
+        kind = "alpha"
+
+    new_canvas = min(max(new_canvas, MIN_CANVAS), canvas)
+    if new_canvas > canvas * (1 - MIN_RECLAIM):
+        return Analysis(code, canvas, bbox_long, kind, 0,
+                        f"fills {bbox_long/canvas:.0%} - leave alone")
+    return Analysis(code, canvas, bbox_long, kind, new_canvas,
+                    f"{bbox_long/canvas:.0%} -> {new_canvas}px")
 
 
 def main() -> None:
@@ -113,8 +101,11 @@ def main() -> None:
     pngs = sorted(args.source.glob("*.png"))
     print(f"Analysing {len(pngs)} PNGs in {args.source} ...")
 
-    with ProcessPoolExecutor(max_workers=args.workers) as pool:
-        results = list(pool.map(analyse, pngs))
+    # Only PNGs new or changed since the last run are decoded.
+    cache = MetricsCache()
+    measured = cache.measure_many(pngs, args.workers)
+    cache.close()
+    results = [analyse(path, metrics) for path, metrics in zip(pngs, measured)]
 
     flagged = [r for r in results if r.new_canvas > 0]
     white = [r for r in flagged if r.kind == "white-rect"]
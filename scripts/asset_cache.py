@@ -0,0 +1,611 @@
+"""Persistent cache of normalised product layers, shared by the OG generators.
+
+generate_og_images.py and generate_ipad_og_images.py both start every layer
+the same way: decode a full-resolution master, crop it to its alpha bbox and
+LANCZOS-resize it onto a fixed transparent canvas. The result depends only on
+the master's content and the normaliser's constants, so it is stored once on
+disk and reused across pages, runs and both scripts. A miss always
+resamples the master itself: a MipmapStore level would add a second LANCZOS
+pass for a layer that is built once per master anyway.
+
+Layers are kept premultiplied ("RGBa"), which is what Pillow resamples in
+anyway: rotating a cached layer gives exactly the pixels rotating the
+straight-alpha original would. Only the non-transparent rectangle is stored,
+as a raw .npy array that is memory-mapped on load; the index lives in SQLite.
+Entries are keyed by the master's content hash (from MetricsCache) plus the
+normaliser's namespace and constants, so a replaced master or a changed
+constant simply misses.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from image_analysis import MetricsCache
+from mipmap_store import load_blob, store_blob
+
+try:
+    import numpy as np
+    from PIL import Image, ImageFilter
+except ImportError as exc:  # pragma: no cover - makes failure mode obvious
+    raise SystemExit(
+        "Pillow and NumPy are required. Install them via 'pip install Pillow numpy'."
+    ) from exc
+
+ASSET_CACHE_DIR = Path(__file__).resolve().parent / "og_asset_cache"
+ASSET_CACHE_VERSION = 1  # bump when the stored layout or key changes
+ROTATED_CACHE_BUDGET = 512 * 1024 * 1024  # bytes of rotated layers kept in RAM
+AFFINE_PADDING = 5  # transparent border around reduced masters: prefilter + BICUBIC reach
+AFFINE_PREFILTER = 0.5  # Gaussian sigma per output px the affine input is band-limited to
+AFFINE_PARAMS = (AFFINE_PADDING, AFFINE_PREFILTER)  # shape every affine frame
+
+Normaliser = Callable[[Image.Image, "tuple[int, int, int, int] | None"], Image.Image]
+# Maps the master's alpha bbox size to the normalised product's size and its
+# top-left on the normaliser's canvas.
+Geometry = Callable[
+    [tuple[int, int]], "tuple[tuple[int, int], tuple[int, int]]"
+]
+
+
+def asset_key(fingerprint: str, namespace: str, params: tuple) -> str:
+    payload = json.dumps(
+        [ASSET_CACHE_VERSION, fingerprint, namespace, params], separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class NormalizedAssetCache:
+    """Normalised layers on disk, as premultiplied RGBa Images.
+
+    `namespace` names the normaliser ("iphone-case", "ipad-product") and
+    `params` must hold every constant that shapes its output.
+    """
+
+    def __init__(
+        self,
+        directory: Path = ASSET_CACHE_DIR,
+        metrics: MetricsCache | None = None,
+    ) -> None:
+        self.directory = directory
+        directory.mkdir(parents=True, exist_ok=True)
+        self.metrics = metrics or MetricsCache()
+        self.db = sqlite3.connect(directory / "index.sqlite3", timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS assets (
+                key TEXT PRIMARY KEY,
+                master TEXT NOT NULL,
+                namespace TEXT NOT NULL,
+                canvas_w INTEGER NOT NULL,
+                canvas_h INTEGER NOT NULL,
+                x INTEGER NOT NULL,
+                y INTEGER NOT NULL
+            )
+            """
+        )
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _blob(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.npy"
+
+    def _load(self, key: str) -> Image.Image | None:
+        row = self.db.execute(
+            "SELECT canvas_w, canvas_h, x, y FROM assets WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        canvas_w, canvas_h, x, y = row
+        return load_blob(self._blob(key), (canvas_w, canvas_h), (x, y))
+
+    def _store(self, key: str, master: Path, namespace: str, layer: Image.Image) -> None:
+        box = store_blob(self._blob(key), layer)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO assets "
+                "(key, master, namespace, canvas_w, canvas_h, x, y) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, str(master), namespace, *layer.size, box[0], box[1]),
+            )
+
+    def get(
+        self, path: Path, namespace: str, params: tuple, normalise: Normaliser
+    ) -> Image.Image:
+        """The normalised layer for the master at path, building it on a miss.
+
+        `normalise(rgba, alpha_box)` receives the decoded straight-alpha
+        master and returns the normalised RGBA layer.
+        """
+        rgba = None
+        fingerprint = self.metrics.fingerprint(path)
+        if fingerprint is None:  # unmeasured or changed: hashes it while decoding
+            rgba, metrics = self.metrics.open_rgba(path)
+            fingerprint = self.metrics.fingerprint(path)
+        key = asset_key(fingerprint, namespace, params)
+
+        cached = self._load(key)
+        if cached is not None:
+            if rgba is not None:
+                rgba.close()
+            return cached
+
+        if rgba is None:
+            rgba, metrics = self.metrics.open_rgba(path)
+        normalized = normalise(rgba, metrics.alpha_box)
+        layer = normalized.convert("RGBa")
+        normalized.close()
+        self._store(key, path, namespace, layer)
+        return layer
+
+
+def rotate_layer(layer: Image.Image, angle: int) -> Image.Image:
+    """Rotate a premultiplied layer the way both OG layouts do; returns
+    straight-alpha RGBA on the full expand=True frame."""
+    rotated = layer.rotate(
+        angle,
+        resample=Image.Resampling.BICUBIC,
+        expand=True,
+        fillcolor=(0, 0, 0, 0),
+    )
+    straight = rotated.convert("RGBA")
+    rotated.close()
+    return straight
+
+
+def rotation_frame(
+    size: tuple[int, int], angle: float
+) -> tuple[tuple[int, int], list[float]]:
+    """Frame size and output-to-input matrix of Image.rotate(angle, expand=True)
+    on an image of `size`, as Pillow computes them."""
+    width, height = size
+    radians = -math.radians(angle % 360.0)
+    matrix = [
+        round(math.cos(radians), 15),
+        round(math.sin(radians), 15),
+        0.0,
+        round(-math.sin(radians), 15),
+        round(math.cos(radians), 15),
+        0.0,
+    ]
+
+    def transform(x: float, y: float) -> tuple[float, float]:
+        a, b, c, d, e, f = matrix
+        return a * x + b * y + c, d * x + e * y + f
+
+    centre = (width / 2, height / 2)
+    matrix[2], matrix[5] = transform(-centre[0], -centre[1])
+    matrix[2] += centre[0]
+    matrix[5] += centre[1]
+    corners = [transform(x, y) for x, y in ((0, 0), (width, 0), (width, height), (0, height))]
+    frame_width = math.ceil(max(x for x, _ in corners)) - math.floor(min(x for x, _ in corners))
+    frame_height = math.ceil(max(y for _, y in corners)) - math.floor(min(y for _, y in corners))
+    matrix[2], matrix[5] = transform(
+        -(frame_width - width) / 2.0, -(frame_height - height) / 2.0
+    )
+    return (frame_width, frame_height), matrix
+
+
+def reduction_factor(box_size: tuple[int, int], size: tuple[int, int]) -> int:
+    """Largest integer box reduction that keeps the master at or above the
+    target size, so the affine pass never downscales by 2x or more."""
+    return max(1, min(box_size[0] // max(1, size[0]), box_size[1] // max(1, size[1])))
+
+
+def prefilter_sigma(box_size: tuple[int, int], size: tuple[int, int], factor: int) -> float:
+    """Gaussian sigma, in reduced px, for the downscale (1x to 2x) left to the
+    affine transform after an integer reduction by `factor`.
+
+    BICUBIC alone only band-limits at the input's own rate, so a remaining
+    reduction r > 1 would alias; blurring by AFFINE_PREFILTER * sqrt(r^2 - 1)
+    brings the total to AFFINE_PREFILTER * r, i.e. the output's rate.
+    """
+    remaining = max(box_size[0] / size[0], box_size[1] / size[1]) / factor
+    return AFFINE_PREFILTER * math.sqrt(max(0.0, remaining * remaining - 1))
+
+
+def reduce_master(
+    rgba: Image.Image,
+    alpha_box: tuple[int, int, int, int],
+    factor: int,
+    sigma: float = 0.0,
+) -> Image.Image:
+    """The master's alpha bbox, box-reduced by `factor`, premultiplied and
+    padded by AFFINE_PADDING on every side, then Gaussian-blurred by `sigma`
+    (see prefilter_sigma) when that is non-zero.
+
+    The crop is widened to a multiple of `factor` (with transparent pixels),
+    so reduced pixel i covers exactly master pixels [i*factor, (i+1)*factor).
+    """
+    left, top, right, bottom = alpha_box
+    width = -(-(right - left) // factor) * factor
+    height = -(-(bottom - top) // factor) * factor
+    product = rgba.crop((left, top, left + width, top + height)).convert("RGBa")
+    reduced = product.reduce(factor) if factor > 1 else product
+    padded = Image.new(
+        "RGBa",
+        (reduced.width + 2 * AFFINE_PADDING, reduced.height + 2 * AFFINE_PADDING),
+        (0, 0, 0, 0),
+    )
+    padded.paste(reduced, (AFFINE_PADDING, AFFINE_PADDING))
+    if reduced is not product:
+        reduced.close()
+    product.close()
+    if sigma > 0:
+        blurred = padded.filter(ImageFilter.GaussianBlur(sigma))
+        padded.close()
+        return blurred
+    return padded
+
+
+def affine_layer(
+    reduced: Image.Image,
+    factor: int,
+    box_size: tuple[int, int],
+    geometry: "tuple[tuple[int, int], tuple[int, int]]",
+    canvas: tuple[int, int],
+    angle: float,
+) -> Image.Image:
+    """Crop, scale and rotate in one BICUBIC resample.
+
+    Produces the frame rotate_layer() would give for the normalised layer:
+    the product at `geometry` (size, top-left) on `canvas`, rotated with
+    expand=True. Returns straight-alpha RGBA.
+    """
+    (size_w, size_h), (x, y) = geometry
+    frame, (a, b, c, d, e, f) = rotation_frame(canvas, angle)
+    # frame -> canvas (rotation), canvas -> master bbox (scale), -> reduced.
+    kx = box_size[0] / size_w / factor
+    ky = box_size[1] / size_h / factor
+    matrix = (
+        kx * a,
+        kx * b,
+        kx * (c - x) + AFFINE_PADDING,
+        ky * d,
+        ky * e,
+        ky * (f - y) + AFFINE_PADDING,
+    )
+    transformed = reduced.transform(
+        frame,
+        Image.Transform.AFFINE,
+        matrix,
+        resample=Image.Resampling.BICUBIC,
+        fillcolor=(0, 0, 0, 0),
+    )
+    straight = transformed.convert("RGBA")
+    transformed.close()
+    return straight
+
+
+class AffineFrames:
+    """Rotated layer frames in a single resample, straight from the master.
+
+    The alternative to rotate_layer(normalised layer): the master's alpha
+    bbox is box-reduced by an integer factor and low-passed for the rest of
+    the reduction (cached on disk like any other normalised layer, under
+    "<namespace>-affine"), and a single affine transform then scales, places
+    and rotates it onto the same expand=True frame, so layouts and positions
+    carry over unchanged.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        params: tuple,
+        canvas: tuple[int, int],
+        geometry: Geometry,
+        assets: NormalizedAssetCache | None = None,
+    ) -> None:
+        self.namespace = f"{namespace}-affine"
+        self.params = (*params, AFFINE_PARAMS)
+        self.canvas = canvas
+        self.geometry = geometry
+        self.assets = assets or NormalizedAssetCache()
+
+    def _reduce(
+        self, rgba: Image.Image, alpha_box: tuple[int, int, int, int] | None
+    ) -> Image.Image:
+        if alpha_box is None:
+            rgba.close()
+            raise ValueError("source image is fully transparent")
+        box_size = (alpha_box[2] - alpha_box[0], alpha_box[3] - alpha_box[1])
+        size = self.geometry(box_size)[0]
+        factor = reduction_factor(box_size, size)
+        reduced = reduce_master(
+            rgba, alpha_box, factor, prefilter_sigma(box_size, size, factor)
+        )
+        rgba.close()
+        return reduced
+
+    def __call__(self, path: Path, angle: int) -> Image.Image:
+        reduced = self.assets.get(path, self.namespace, self.params, self._reduce)
+        alpha_box = self.assets.metrics.measure(path).alpha_box
+        box_size = (alpha_box[2] - alpha_box[0], alpha_box[3] - alpha_box[1])
+        geometry = self.geometry(box_size)
+        frame = affine_layer(
+            reduced,
+            reduction_factor(box_size, geometry[0]),
+            box_size,
+            geometry,
+            self.canvas,
+            angle,
+        )
+        reduced.close()
+        return frame
+
+
+@dataclass
+class RotatedLayer:
+    """A rotated layer trimmed to its alpha bbox.
+
+    `offset` is where `image` sits inside the full rotate(expand=True) frame
+    of `size`; `alpha` is its alpha channel, and `spans` the per-row span
+    table layers_collide() tests against.
+    """
+
+    image: Image.Image
+    offset: tuple[int, int]
+    size: tuple[int, int]
+    alpha: np.ndarray
+    _spans: "LayerSpans | None" = field(default=None, repr=False)
+
+    @property
+    def spans(self) -> "LayerSpans":
+        if self._spans is None:
+            self._spans = LayerSpans.from_alpha(self.alpha)
+        return self._spans
+
+    @classmethod
+    def from_frame(cls, frame: Image.Image) -> "RotatedLayer":
+        alpha = np.asarray(frame.getchannel("A"))
+        rows = np.flatnonzero(alpha.any(axis=1))
+        if rows.size == 0:  # nothing visible: a 1x1 transparent stand-in
+            return cls(
+                Image.new("RGBA", (1, 1), (0, 0, 0, 0)), (0, 0), frame.size,
+                np.zeros((1, 1), dtype=np.uint8),
+            )
+        cols = np.flatnonzero(alpha.any(axis=0))
+        box = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+        return cls(
+            frame.crop(box),
+            box[:2],
+            frame.size,
+            alpha[box[1]:box[3], box[0]:box[2]].copy(),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.image.width * self.image.height * 4 + self.alpha.nbytes * 2
+
+
+class RotatedLayerCache:
+    """Rotated layers memoised per (master, angle), within a byte budget.
+
+    Every OG layout rotates by a small fixed set of angles, and popular SKUs
+    recur across variants and pages, so the same bicubic rotation would
+    otherwise be recomputed again and again. Least recently used layers are
+    dropped once the cached pixels and alpha exceed `budget` bytes. Callers
+    must not close or modify the returned images. On a miss `frames(path,
+    angle)` builds the full rotated frame (see rotate_layer, AffineFrames).
+    """
+
+    def __init__(
+        self,
+        frames: Callable[[Path, int], Image.Image],
+        budget: int = ROTATED_CACHE_BUDGET,
+    ) -> None:
+        self.frames = frames
+        self.budget = budget
+        self.layers: OrderedDict[tuple[Path, int], RotatedLayer] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: Path, angle: int) -> RotatedLayer:
+        key = (path, angle)
+        layer = self.layers.get(key)
+        if layer is not None:
+            self.layers.move_to_end(key)
+            self.hits += 1
+            return layer
+
+        self.misses += 1
+        frame = self.frames(path, angle)
+        layer = RotatedLayer.from_frame(frame)
+        frame.close()
+        self.layers[key] = layer
+        self.nbytes += layer.nbytes
+        while self.nbytes > self.budget and len(self.layers) > 1:
+            # Not closed: a render in progress may still hold it.
+            _, evicted = self.layers.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return layer
+
+
+def _row_runs(mask: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Per row: first set column, one past the last, and whether every
+    pixel between them is set. Empty rows get an empty (w, 0) span."""
+    width = mask.shape[1]
+    present = mask.any(axis=1)
+    start = np.where(present, mask.argmax(axis=1), width)
+    end = np.where(present, width - mask[:, ::-1].argmax(axis=1), 0)
+    solid = present & (mask.sum(axis=1) == end - start)
+    return start.astype(np.int32), end.astype(np.int32), solid
+
+
+@dataclass
+class LayerSpans:
+    """Per-row span table of a layer's alpha.
+
+    `hull` spans cover every pixel with alpha > 0 (exactly, where `solid`);
+    `core` spans are single runs of fully opaque pixels (empty otherwise).
+    """
+
+    hull_start: np.ndarray
+    hull_end: np.ndarray
+    solid: np.ndarray
+    core_start: np.ndarray
+    core_end: np.ndarray
+
+    @classmethod
+    def from_alpha(cls, alpha: np.ndarray) -> "LayerSpans":
+        hull_start, hull_end, solid = _row_runs(alpha != 0)
+        core_start, core_end, single = _row_runs(alpha == 255)
+        core_start = np.where(single, core_start, alpha.shape[1])
+        core_end = np.where(single, core_end, 0)
+        return cls(hull_start, hull_end, solid, core_start, core_end)
+
+
+def layers_collide(
+    first: RotatedLayer,
+    first_position: "tuple[int, int] | list[int]",
+    second: RotatedLayer,
+    second_position: "tuple[int, int] | list[int]",
+) -> bool:
+    """Whether the layers' images, at these top-left positions, collide.
+
+    Same rule as multiplying the two alpha channels with ImageChops and
+    checking for any non-zero pixel: some pixel has alpha_a * alpha_b >= 255.
+    Rows are rejected or accepted from the span tables; only rows where
+    neither is conclusive compare actual alpha values.
+    """
+    dx = second_position[0] - first_position[0]
+    dy = second_position[1] - first_position[1]
+    first_height, first_width = first.alpha.shape
+    second_height, second_width = second.alpha.shape
+    top, bottom = max(0, dy), min(first_height, dy + second_height)
+    left, right = max(0, dx), min(first_width, dx + second_width)
+    if top >= bottom or left >= right:
+        return False
+
+    a, b = first.spans, second.spans
+    rows_a = slice(top, bottom)
+    rows_b = slice(top - dy, bottom - dy)
+    b_start = b.hull_start[rows_b] + dx
+    b_end = b.hull_end[rows_b] + dx
+    candidates = np.maximum(a.hull_start[rows_a], b_start) < np.minimum(
+        a.hull_end[rows_a], b_end
+    )
+    if not candidates.any():
+        return False
+
+    # Fully opaque against any alpha > 0 always reaches 255.
+    if (
+        candidates
+        & b.solid[rows_b]
+        & (np.maximum(a.core_start[rows_a], b_start) < np.minimum(a.core_end[rows_a], b_end))
+    ).any():
+        return True
+    if (
+        candidates
+        & a.solid[rows_a]
+        & (
+            np.maximum(a.hull_start[rows_a], b.core_start[rows_b] + dx)
+            < np.minimum(a.hull_end[rows_a], b.core_end[rows_b] + dx)
+        )
+    ).any():
+        return True
+
+    rows = np.flatnonzero(candidates) + top
+    product = first.alpha[rows, left:right].astype(np.uint16) * second.alpha[
+        rows - dy, left - dx:right - dx
+    ]
+    return bool((product >= 255).any())
+
+
+@dataclass
+class Composite:
+    """One composited output: the layers on transparency, the same over the
+    background colour, and the region the layers touched (None: nothing)."""
+
+    transparent: Image.Image
+    background: Image.Image
+    dirty: tuple[int, int, int, int] | None = None
+
+
+class LayerCompositor:
+    """Composites trimmed layers straight into pooled output-size buffers.
+
+    Layer positions are given in a larger layout frame whose `origin` maps to
+    the output's top-left, so nothing outside the output is ever allocated;
+    each layer is clipped to the output rectangle before compositing. The
+    background version is derived from the transparent buffer over only the
+    touched region; everywhere else it already holds the plain colour.
+
+    Buffers are handed out as Composites and come back through release()
+    once they are saved (possibly on an encoder thread); a reused Composite
+    only has its previously touched region reset.
+    """
+
+    def __init__(
+        self,
+        size: tuple[int, int],
+        background: tuple[int, int, int, int],
+        origin: tuple[int, int] = (0, 0),
+    ) -> None:
+        self.size = size
+        self.origin = origin
+        self.background_colour = background
+        self.free: list[Composite] = []
+        self.lock = threading.Lock()
+
+    def _take(self) -> Composite:
+        with self.lock:
+            target = self.free.pop() if self.free else None
+        if target is None:
+            return Composite(
+                Image.new("RGBA", self.size, (0, 0, 0, 0)),
+                Image.new("RGBA", self.size, self.background_colour),
+            )
+        if target.dirty is not None:
+            target.transparent.paste((0, 0, 0, 0), target.dirty)
+            target.background.paste(self.background_colour, target.dirty)
+            target.dirty = None
+        return target
+
+    def release(self, composite: Composite) -> None:
+        with self.lock:
+            self.free.append(composite)
+
+    def composite(
+        self,
+        layers: list[RotatedLayer],
+        positions: "list[list[int]] | list[tuple[int, int]]",
+    ) -> Composite:
+        """Composite layers in order, then flatten the touched region."""
+        target = self._take()
+        dirty: tuple[int, int, int, int] | None = None
+        width, height = self.size
+        for layer, (x, y) in zip(layers, positions, strict=True):
+            x -= self.origin[0]
+            y -= self.origin[1]
+            box = (
+                max(0, x),
+                max(0, y),
+                min(width, x + layer.image.width),
+                min(height, y + layer.image.height),
+            )
+            if box[0] >= box[2] or box[1] >= box[3]:
+                continue
+            target.transparent.alpha_composite(
+                layer.image, box[:2], (box[0] - x, box[1] - y, box[2] - x, box[3] - y)
+            )
+            dirty = box if dirty is None else (
+                min(dirty[0], box[0]),
+                min(dirty[1], box[1]),
+                max(dirty[2], box[2]),
+                max(dirty[3], box[3]),
+            )
+        if dirty is not None:
+            target.background.alpha_composite(target.transparent, dirty[:2], dirty)
+        target.dirty = dirty
+        return target
@@ -3,14 +3,25 @@
 
 Specs live in a CSV (see crop_specs.csv) and can reference products from
 database.csv via simple match expressions or explicit SKU/file globs.
+
+Every output is recorded in crop_manifest.csv in the output folder with the
+source fingerprint and spec parameters that produced it, so reruns recrop
+only outputs whose source or spec changed and report orphaned outputs.
 """
 
 from __future__ import annotations
 
 import argparse
+import bisect
 import csv
+import hashlib
+import io
+import json
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
 from pathlib import Path
 from typing import Dict, Iterable, List, Sequence, Set
 
@@ -28,6 +39,13 @@ DEFAULT_SOURCE = "/Volumes/Storage/Images/1_final-sources"
 DEFAULT_OUTPUT = "/Volumes/Storage/Images/crop_town"
 DEFAULT_EXTENSIONS = ".png"
 COLUMN_SEPARATOR = ";"  # separates clauses inside `match`
+GLOB_WILDCARDS = "*?["  # first of these ends a glob's literal prefix
+INDEX_VERSION = 1  # bump when the cached index file layout changes
+MANIFEST_NAME = "crop_manifest.csv"  # kept in the output folder
+MANIFEST_HEADER = [
+    "dest", "source", "source_size", "source_mtime_ns", "source_sha256",
+    "left", "top", "right", "bottom", "output_subdir", "output_suffix", "label",
+]
 
 
 def parse_args() -> argparse.Namespace:
@@ -62,15 +80,38 @@ def parse_args() -> argparse.Namespace:
         default=DEFAULT_EXTENSIONS,
         help="Comma-separated list of extensions to probe for each SKU/file.",
     )
+    parser.add_argument(
+        "--index-cache",
+        type=Path,
+        default=None,
+        help="Cache the source directory listing in this JSON file; reused "
+        "while the directory's mtime is unchanged.",
+    )
     parser.add_argument(
         "--overwrite",
         action="store_true",
-        help="Overwrite destination files instead of skipping them.",
+        help="Recrop every planned output, even ones the manifest says are "
+        "up to date or that predate the manifest.",
+    )
+    parser.add_argument(
+        "--prune-orphans",
+        action="store_true",
+        help="Delete outputs in the manifest that no spec produces any more, "
+        "once their source is gone from disk; outputs of a spec that matched "
+        "0 files this run are always kept.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Processes cropping in parallel; each decodes a source once "
+        "and writes all of its crops (default: 8).",
     )
     parser.add_argument(
         "--dry-run",
         action="store_true",
-        help="Resolve matches and print the plan without writing files.",
+        help="Resolve matches and print the plan, grouped by source, "
+        "without writing files.",
     )
     return parser.parse_args()
 
@@ -128,6 +169,7 @@ class CropSpec:
     extra_suffixes: List[str] = field(default_factory=list)
     output_subdir: str = ""
     output_suffix: str = ""
+    match: MatchExpr | None = None  # match_expr, compiled by load_specs
 
     @property
     def has_selector(self) -> bool:
@@ -166,61 +208,249 @@ def load_specs(path: Path) -> List[CropSpec]:
                 raise ValueError(
                     f"Spec '{label}' must provide at least one of match/skus/glob."
                 )
+            if spec.match_expr:
+                spec.match = compile_match(spec.match_expr)
             specs.append(spec)
     return specs
 
 
-def filter_database(rows: Sequence[Dict[str, str]], expr: str) -> List[Dict[str, str]]:
-    if not expr:
-        return []
-    clauses = [
-        clause.strip() for clause in expr.split(COLUMN_SEPARATOR) if clause.strip()
-    ]
-    if not clauses:
-        return []
-    matched = list(rows)
-    for clause in clauses:
+class DatabaseView:
+    """Column-oriented, pre-lowercased view of database.csv for spec matching.
+
+    `=` clauses are answered from a per-column hash index (value -> row ids)
+    and `~` clauses by one substring search over a column's lowercased values
+    joined into a single string. Indexes are built on first use and every
+    clause result is memoised, so specs sharing clauses cost nothing extra.
+    """
+
+    _JOIN = "\x00"  # cannot occur in CSV text, so needles never span rows
+
+    def __init__(self, rows: Sequence[Dict[str, str]]):
+        self.rows = list(rows)
+        self.columns: Dict[str, List[str]] = {}
+        for row in self.rows:
+            for key in row:
+                self.columns.setdefault(key, [])
+        for key, values in self.columns.items():
+            values.extend(row.get(key, "") for row in self.rows)
+        self._equal: Dict[str, Dict[str, List[int]]] = {}
+        self._haystacks: Dict[str, tuple[str, List[int]]] = {}
+        self._memo: Dict[tuple[str, str, str], frozenset[int]] = {}
+
+    def _column(self, key: str) -> List[str]:
+        column = self.columns.get(key)
+        if column is None:
+            column = self.columns[key] = [""] * len(self.rows)
+        return column
+
+    def equal(self, key: str, target: str) -> frozenset[int]:
+        memo_key = (key, "=", target)
+        if memo_key not in self._memo:
+            index = self._equal.get(key)
+            if index is None:
+                index = self._equal[key] = {}
+                for row_id, value in enumerate(self._column(key)):
+                    index.setdefault(value, []).append(row_id)
+            self._memo[memo_key] = frozenset(index.get(target, ()))
+        return self._memo[memo_key]
+
+    def contains(self, key: str, needle: str) -> frozenset[int]:
+        memo_key = (key, "~", needle)
+        if memo_key not in self._memo:
+            if not needle:
+                self._memo[memo_key] = frozenset(range(len(self.rows)))
+                return self._memo[memo_key]
+            haystack, starts = self._haystack(key)
+            hits: Set[int] = set()
+            position = haystack.find(needle)
+            while position != -1:
+                row_id = bisect.bisect_right(starts, position) - 1
+                hits.add(row_id)
+                # Resume at the next row: one hit per row is enough.
+                following = row_id + 1
+                if following == len(starts):
+                    break
+                position = haystack.find(needle, starts[following])
+            self._memo[memo_key] = frozenset(hits)
+        return self._memo[memo_key]
+
+    def _haystack(self, key: str) -> tuple[str, List[int]]:
+        cached = self._haystacks.get(key)
+        if cached is None:
+            lowered = [value.lower() for value in self._column(key)]
+            starts: List[int] = []
+            offset = 0
+            for value in lowered:
+                starts.append(offset)
+                offset += len(value) + len(self._JOIN)
+            cached = self._haystacks[key] = (self._JOIN.join(lowered), starts)
+        return cached
+
+
+@dataclass(frozen=True)
+class MatchClause:
+    key: str
+    op: str  # "=" exact (case-sensitive) | "~" contains (case-insensitive)
+    value: str
+
+    def row_ids(self, view: DatabaseView) -> frozenset[int]:
+        if self.op == "~":
+            return view.contains(self.key, self.value)
+        return view.equal(self.key, self.value)
+
+
+@dataclass(frozen=True)
+class MatchExpr:
+    """A spec's `match` column, parsed once; clauses are ANDed."""
+
+    text: str
+    clauses: tuple[MatchClause, ...]
+
+    def select(self, view: DatabaseView) -> List[Dict[str, str]]:
+        """Matching rows, in database order."""
+        if not self.clauses:
+            return []
+        row_ids = None
+        for clause in self.clauses:
+            hits = clause.row_ids(view)
+            row_ids = hits if row_ids is None else row_ids & hits
+            if not row_ids:
+                return []
+        return [view.rows[row_id] for row_id in sorted(row_ids)]
+
+
+def compile_match(expr: str) -> MatchExpr:
+    clauses: List[MatchClause] = []
+    for clause in expr.split(COLUMN_SEPARATOR):
+        clause = clause.strip()
+        if not clause:
+            continue
         if "~" in clause:
             key, value = clause.split("~", 1)
-            key = key.strip().lower()
-            needle = value.strip().lower()
-            matched = [row for row in matched if needle in row.get(key, "").lower()]
+            clauses.append(MatchClause(key.strip().lower(), "~", value.strip().lower()))
         elif "=" in clause:
             key, value = clause.split("=", 1)
-            key = key.strip().lower()
-            target = value.strip()
-            matched = [row for row in matched if row.get(key, "") == target]
+            clauses.append(MatchClause(key.strip().lower(), "=", value.strip()))
         else:
             raise ValueError(
                 f"Unsupported clause '{clause}' in expression '{expr}'. "
                 f"Use '~' for contains or '=' for exact matches."
             )
-    return matched
-
-
-def find_file_for_code(
-    code: str,
-    source_dir: Path,
-    extensions: Sequence[str],
-) -> Path | None:
-    for ext in extensions:
-        candidate = source_dir / f"{code}{ext}"
-        if candidate.exists():
-            return candidate
-    return None
+    return MatchExpr(expr, tuple(clauses))
+
+
+def filter_database(view: DatabaseView, expr: MatchExpr | str) -> List[Dict[str, str]]:
+    if isinstance(expr, str):
+        if not expr:
+            return []
+        expr = compile_match(expr)
+    return expr.select(view)
+
+
+class SourceIndex:
+    """In-memory listing of the (flat) source directory.
+
+    Built from a single os.scandir pass so spec resolution never stats the
+    (often network-mounted) source folder per SKU, per extension or per
+    variant. Names are kept sorted for prefix lookups when expanding globs.
+    """
+
+    def __init__(self, source_dir: Path, names: Iterable[str]):
+        self.source_dir = source_dir
+        self.names = sorted(names)
+        self.by_stem: Dict[str, List[str]] = {}
+        for name in self.names:
+            self.by_stem.setdefault(Path(name).stem, []).append(name)
+
+    @classmethod
+    def scan(cls, source_dir: Path) -> "SourceIndex":
+        with os.scandir(source_dir) as entries:
+            names = [entry.name for entry in entries if entry.is_file()]
+        return cls(source_dir, names)
+
+    @classmethod
+    def load(cls, source_dir: Path, cache_path: Path | None) -> "SourceIndex":
+        """Scan source_dir, or reuse cache_path while the directory's mtime
+        (which changes whenever a file is added, removed or renamed) matches."""
+        if cache_path is None:
+            return cls.scan(source_dir)
+        mtime_ns = source_dir.stat().st_mtime_ns
+        try:
+            cached = json.loads(cache_path.read_text(encoding="utf-8"))
+            if (
+                cached.get("version") == INDEX_VERSION
+                and cached.get("source_dir") == str(source_dir.resolve())
+                and cached.get("mtime_ns") == mtime_ns
+            ):
+                return cls(source_dir, cached["names"])
+        except (OSError, ValueError, KeyError):
+            pass
+        index = cls.scan(source_dir)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        tmp_path.write_text(
+            json.dumps(
+                {
+                    "version": INDEX_VERSION,
+                    "source_dir": str(source_dir.resolve()),
+                    "mtime_ns": mtime_ns,
+                    "names": index.names,
+                }
+            ),
+            encoding="utf-8",
+        )
+        os.replace(tmp_path, cache_path)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def find(self, stem: str, extensions: Sequence[str]) -> Path | None:
+        """First of stem + ext (in extensions order) present in the folder."""
+        names = self.by_stem.get(stem)
+        if not names:
+            return None
+        for ext in extensions:
+            if f"{stem}{ext}" in names:
+                return self.source_dir / f"{stem}{ext}"
+        return None
+
+    def glob(self, pattern: str) -> List[Path]:
+        """Files matching pattern, like Path.glob for flat patterns.
+
+        Only names sharing the pattern's literal prefix are tested. Patterns
+        reaching into subdirectories fall back to a real glob.
+        """
+        if "/" in pattern or os.sep in pattern:
+            return sorted(
+                path for path in self.source_dir.glob(pattern) if path.is_file()
+            )
+        cut = min(
+            (pattern.index(char) for char in GLOB_WILDCARDS if char in pattern),
+            default=len(pattern),
+        )
+        prefix = pattern[:cut]
+        start = bisect.bisect_left(self.names, prefix)
+        matches: List[Path] = []
+        for name in self.names[start:]:
+            if not name.startswith(prefix):
+                break
+            if fnmatchcase(name, pattern):
+                matches.append(self.source_dir / name)
+        return matches
 
 
 def gather_paths_for_spec(
     spec: CropSpec,
-    database_rows: Sequence[Dict[str, str]],
-    source_dir: Path,
+    database: DatabaseView,
+    index: SourceIndex,
     extensions: Sequence[str],
 ) -> List[Path]:
     resolved: List[Path] = []
     seen: Set[Path] = set()
 
     def add_path(path: Path) -> None:
-        if path not in seen and path.is_file():
+        if path not in seen:
             resolved.append(path)
             seen.add(path)
 
@@ -229,7 +459,7 @@ def gather_paths_for_spec(
         warn_context: str,
         include_suffixes: bool,
     ) -> None:
-        file_path = find_file_for_code(code, source_dir, extensions)
+        file_path = index.find(code, extensions)
         if file_path:
             add_path(file_path)
         else:
@@ -239,7 +469,7 @@ def gather_paths_for_spec(
         if include_suffixes and spec.extra_suffixes:
             for suffix in spec.extra_suffixes:
                 variant_code = f"{code}{suffix}"
-                variant_path = find_file_for_code(variant_code, source_dir, extensions)
+                variant_path = index.find(variant_code, extensions)
                 if variant_path:
                     add_path(variant_path)
                 else:
@@ -252,7 +482,7 @@ def gather_paths_for_spec(
         add_code(sku, "SKU", include_suffixes=False)
 
     if spec.match_expr:
-        matched_rows = filter_database(database_rows, spec.match_expr)
+        matched_rows = filter_database(database, spec.match or spec.match_expr)
         if not matched_rows:
             print(
                 f"[warn] Match '{spec.match_expr}' returned 0 rows for '{spec.label}'."
@@ -264,33 +494,304 @@ def gather_paths_for_spec(
             add_code(sku, "matched SKU", include_suffixes=True)
 
     if spec.glob:
-        for file_path in source_dir.glob(spec.glob):
+        for file_path in index.glob(spec.glob):
             add_path(file_path)
 
     return resolved
 
 
-def crop_single_image(
-    src: Path,
-    dest: Path,
-    left: int,
-    top: int,
-    right: int,
-    bottom: int,
-) -> None:
-    dest.parent.mkdir(parents=True, exist_ok=True)
-    with Image.open(src) as im:
-        width, height = im.size
-        if left < 0 or top < 0 or right < 0 or bottom < 0:
+@dataclass(frozen=True)
+class CropJob:
+    dest: Path
+    left: int
+    top: int
+    right: int
+    bottom: int
+    label: str
+    output_subdir: str = ""
+    output_suffix: str = ""
+
+    @property
+    def margins(self) -> str:
+        return f"L{self.left}/T{self.top}/R{self.right}/B{self.bottom}"
+
+    @property
+    def params(self) -> tuple[int, int, int, int, str, str]:
+        """Everything about the spec that shapes this output."""
+        return (self.left, self.top, self.right, self.bottom,
+                self.output_subdir, self.output_suffix)
+
+    def box(self, src: Path, size: tuple[int, int]) -> tuple[int, int, int, int]:
+        width, height = size
+        if self.left < 0 or self.top < 0 or self.right < 0 or self.bottom < 0:
             raise ValueError("Crop values must be non-negative integers.")
-        if left + right >= width or top + bottom >= height:
+        if self.left + self.right >= width or self.top + self.bottom >= height:
             raise ValueError(
-                f"Cropping {src.name} by L{left}+R{right} / T{top}+B{bottom} "
-                "would eliminate the entire image."
+                f"Cropping {src.name} by L{self.left}+R{self.right} / "
+                f"T{self.top}+B{self.bottom} would eliminate the entire image."
+            )
+        return (self.left, self.top, width - self.right, height - self.bottom)
+
+
+@dataclass(frozen=True)
+class SourceFingerprint:
+    size: int
+    mtime_ns: int
+    sha256: str
+
+
+@dataclass
+class ManifestEntry:
+    source: str
+    fingerprint: SourceFingerprint
+    params: tuple[int, int, int, int, str, str]
+    label: str
+
+
+class CropManifest:
+    """What produced every output: source name and fingerprint plus the spec
+    parameters (margins, subdir, suffix).
+
+    Keyed by the output path relative to the output folder. Kept in memory
+    during a run and rewritten atomically by save().
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: Dict[str, ManifestEntry] = {}
+        if path.exists():
+            with path.open("r", encoding="utf-8", newline="") as handle:
+                for row in csv.DictReader(handle):
+                    self.entries[row["dest"]] = ManifestEntry(
+                        source=row["source"],
+                        fingerprint=SourceFingerprint(
+                            int(row["source_size"]),
+                            int(row["source_mtime_ns"]),
+                            row["source_sha256"],
+                        ),
+                        params=(
+                            int(row["left"]), int(row["top"]),
+                            int(row["right"]), int(row["bottom"]),
+                            row["output_subdir"], row["output_suffix"],
+                        ),
+                        label=row.get("label") or "",
+                    )
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with tmp_path.open("w", encoding="utf-8", newline="") as handle:
+            writer = csv.writer(handle, lineterminator="\n")
+            writer.writerow(MANIFEST_HEADER)
+            for dest, entry in sorted(self.entries.items()):
+                fp = entry.fingerprint
+                writer.writerow(
+                    [dest, entry.source, fp.size, fp.mtime_ns, fp.sha256,
+                     *entry.params, entry.label]
+                )
+        os.replace(tmp_path, self.path)
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_unchanged(path: Path, recorded: SourceFingerprint) -> bool:
+    """Size + mtime match, or (touched but same size) the content hash does."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return False
+    if (stat.st_size, stat.st_mtime_ns) == (recorded.size, recorded.mtime_ns):
+        return True
+    return stat.st_size == recorded.size and file_sha256(path) == recorded.sha256
+
+
+@dataclass
+class CropPlan:
+    """Every output to write, grouped by the source master it is cut from."""
+
+    groups: Dict[Path, List[CropJob]] = field(default_factory=dict)
+    reasons: Dict[Path, str] = field(default_factory=dict)  # dest -> why
+    skipped: int = 0
+    current: int = 0  # up to date according to the manifest
+    orphans: List[str] = field(default_factory=list)  # manifest dests
+    empty_specs: Set[str] = field(default_factory=set)  # labels matching 0 files
+
+    @property
+    def outputs(self) -> int:
+        return sum(len(jobs) for jobs in self.groups.values())
+
+
+def build_plan(
+    specs: Sequence[CropSpec],
+    database: DatabaseView,
+    index: SourceIndex,
+    extensions: Sequence[str],
+    output_dir: Path,
+    overwrite: bool,
+    manifest: CropManifest | None = None,
+) -> CropPlan:
+    """Resolve every spec up front into one source -> outputs plan.
+
+    A destination claimed by two specs is written once: by the first spec,
+    or with --overwrite by the last (as sequential cropping would leave it).
+    With a manifest, an existing output is recropped only when its source
+    or its spec parameters changed; outputs the manifest does not know are
+    skipped as before. Manifest outputs no spec claims any more are orphans.
+    """
+    plan = CropPlan()
+    planned: Dict[Path, Path] = {}  # dest -> source
+    claimed: Set[str] = set()
+    listings: Dict[Path, Set[str]] = {}
+    unchanged: Dict[tuple[Path, SourceFingerprint], bool] = {}
+
+    def stale_reason(dest: Path, src: Path, job: CropJob) -> str:
+        """Why dest must be (re)written; "" when it is up to date."""
+        if overwrite:
+            return "overwrite"
+        entry = None
+        if manifest is not None:
+            entry = manifest.entries.get(dest.relative_to(output_dir).as_posix())
+        if not exists(dest):
+            return "new" if entry is None else "missing"
+        if entry is None:
+            return "untracked"
+        if entry.params != job.params:
+            return "spec changed"
+        key = (src, entry.fingerprint)
+        if key not in unchanged:
+            unchanged[key] = source_unchanged(src, entry.fingerprint)
+        if entry.source != src.name or not unchanged[key]:
+            return "source changed"
+        return ""
+
+    def exists(dest: Path) -> bool:
+        names = listings.get(dest.parent)
+        if names is None:
+            try:
+                with os.scandir(dest.parent) as entries:
+                    names = {entry.name for entry in entries}
+            except FileNotFoundError:
+                names = set()
+            listings[dest.parent] = names
+        return dest.name in names
+
+    for spec in specs:
+        targets = gather_paths_for_spec(spec, database, index, extensions)
+        if not targets:
+            print(f"[info] Spec '{spec.label}' matched 0 files.")
+            plan.empty_specs.add(spec.label)
+            continue
+        dest_dir = output_dir / spec.output_subdir if spec.output_subdir else output_dir
+        for image_path in targets:
+            suffix = spec.output_suffix or ""
+            dest_path = dest_dir / (image_path.stem + suffix + image_path.suffix)
+            job = CropJob(
+                dest_path, spec.left, spec.top, spec.right, spec.bottom, spec.label,
+                spec.output_subdir, spec.output_suffix,
+            )
+            rel = dest_path.relative_to(output_dir).as_posix()
+
+            if rel in claimed:
+                if not overwrite:
+                    print(f"[skip] {dest_path} already claimed by an earlier spec.")
+                    plan.skipped += 1
+                    continue
+                # With --overwrite every claim is planned; the later one wins.
+                previous = plan.groups[planned[dest_path]]
+                previous[:] = [other for other in previous if other.dest != dest_path]
+                if not previous:
+                    del plan.groups[planned[dest_path]]
+            else:
+                claimed.add(rel)
+                reason = stale_reason(dest_path, image_path, job)
+                if reason == "untracked":
+                    print(f"[skip] {dest_path} already exists (not in manifest).")
+                    plan.skipped += 1
+                    continue
+                if not reason:
+                    plan.current += 1
+                    continue
+                plan.reasons[dest_path] = reason
+
+            planned[dest_path] = image_path
+            plan.groups.setdefault(image_path, []).append(job)
+    if manifest is not None:
+        plan.orphans = sorted(set(manifest.entries) - claimed)
+    return plan
+
+
+def keep_reason(entry: ManifestEntry, plan: CropPlan, source_dir: Path) -> str:
+    """Why an orphaned output must not be pruned; "" when it may be.
+
+    Nothing claiming an output looks the same whether its product really
+    went away or its spec's selector came up empty (a partially mounted
+    source folder, a stale --index-cache). So an orphan is only prunable
+    when its spec did not come up empty and its source is gone from disk,
+    checked directly rather than through the index.
+    """
+    if entry.label in plan.empty_specs:
+        return f"spec '{entry.label}' matched 0 files this run"
+    if (source_dir / entry.source).exists():
+        return f"source {entry.source} still exists"
+    return ""
+
+
+def crop_group(
+    src: Path, jobs: Sequence[CropJob]
+) -> tuple[SourceFingerprint | None, List[tuple[CropJob, str]]]:
+    """Decode src once and write every crop cut from it.
+
+    Runs in a worker process. Returns the source's fingerprint (taken from
+    the same read as the decode) and (job, error) pairs, error "" on
+    success, so one bad box or unreadable master cannot abort the pool.
+    """
+    fingerprint = None
+    results: List[tuple[CropJob, str]] = []
+    try:
+        stat = src.stat()
+        data = src.read_bytes()
+        fingerprint = SourceFingerprint(
+            stat.st_size, stat.st_mtime_ns, hashlib.sha256(data).hexdigest()
+        )
+        with Image.open(io.BytesIO(data)) as im:
+            im.load()
+            for job in jobs:
+                # Written to a temp file and renamed, so a killed run never
+                # leaves a truncated output that build_plan would then call
+                # untracked and skip for good.
+                tmp = job.dest.with_name(
+                    f".{job.dest.stem}.{os.getpid()}.tmp{job.dest.suffix}"
+                )
+                try:
+                    cropped = im.crop(job.box(src, im.size))
+                    job.dest.parent.mkdir(parents=True, exist_ok=True)
+                    cropped.save(tmp)
+                    os.replace(tmp, job.dest)
+                    results.append((job, ""))
+                except Exception as exc:  # noqa: BLE001 - reported by main
+                    results.append((job, str(exc)))
+                finally:
+                    tmp.unlink(missing_ok=True)
+    except Exception as exc:  # noqa: BLE001 - reported by main
+        done = {job.dest for job, _ in results}
+        results.extend((job, str(exc)) for job in jobs if job.dest not in done)
+    return fingerprint, results
+
+
+def print_plan(plan: CropPlan, output_dir: Path) -> None:
+    for src, jobs in plan.groups.items():
+        print(f"[dry] {src.name} ({len(jobs)} output{'s' if len(jobs) != 1 else ''})")
+        for job in jobs:
+            print(
+                f"        -> {job.dest.relative_to(output_dir)} "
+                f"({job.margins}, {job.label}; {plan.reasons.get(job.dest, 'new')})"
             )
-        crop_box = (left, top, width - right, height - bottom)
-        cropped = im.crop(crop_box)
-        cropped.save(dest)
 
 
 def main() -> None:
@@ -303,6 +804,7 @@ def main() -> None:
             else (SCRIPT_DIR / args.database)
         )
 
+    database = DatabaseView(database_rows)
     specs = load_specs(
         args.specs if args.specs.is_absolute() else (SCRIPT_DIR / args.specs)
     )
@@ -326,53 +828,97 @@ def main() -> None:
     )
     if not extensions:
         raise SystemExit("At least one extension must be provided.")
+    index_cache = args.index_cache
+    if index_cache is not None and not index_cache.is_absolute():
+        index_cache = SCRIPT_DIR / index_cache
+    index = SourceIndex.load(source_dir, index_cache)
+    print(f"[info] Indexed {len(index)} files in {source_dir}.")
+
+    manifest = CropManifest(output_dir / MANIFEST_NAME)
+    plan = build_plan(
+        specs, database, index, extensions, output_dir, args.overwrite, manifest
+    )
+    prunable: List[str] = []
+    for dest in plan.orphans:
+        entry = manifest.entries[dest]
+        held = keep_reason(entry, plan, source_dir) if args.prune_orphans else ""
+        print(
+            f"[orphan] {dest} (was '{entry.label}' from {entry.source})"
+            + (f", kept: {held}" if held else "")
+        )
+        if args.prune_orphans and not held:
+            prunable.append(dest)
+    summary = (
+        f"{plan.current} up to date, {plan.skipped} skipped, "
+        f"{len(plan.orphans)} orphaned"
+    )
+    if args.dry_run:
+        print_plan(plan, output_dir)
+        print(
+            f"\nDry-run complete. {plan.outputs} images would be written from "
+            f"{len(plan.groups)} source decodes ({summary})."
+        )
+        return
 
     total_written = 0
-    total_skipped = 0
-    total_planned = 0
-    for spec in specs:
-        targets = gather_paths_for_spec(spec, database_rows, source_dir, extensions)
-        if not targets:
-            print(f"[info] Spec '{spec.label}' matched 0 files.")
-            continue
-        for image_path in targets:
-            suffix = spec.output_suffix or ""
-            dest_name = image_path.stem + suffix + image_path.suffix
-            dest_dir = output_dir
-            if spec.output_subdir:
-                dest_dir = output_dir / spec.output_subdir
-            dest_path = dest_dir / dest_name
-
-            if dest_path.exists() and not args.overwrite:
-                print(f"[skip] {dest_path} already exists.")
-                total_skipped += 1
-                continue
+    failures: List[tuple[CropJob, str]] = []
+    workers = max(1, args.workers)
+    groups = list(plan.groups.items())
+    try:
+        for dest in prunable:
+            (output_dir / dest).unlink(missing_ok=True)
+            del manifest.entries[dest]
+            print(f"[prune] {dest}")
+        if workers > 1 and len(groups) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(crop_group, src, jobs): src for src, jobs in groups
+                }
+                outcomes = (
+                    (futures[future], future.result())
+                    for future in as_completed(futures)
+                )
+                total_written = _report(outcomes, output_dir, manifest, failures)
+        else:
+            outcomes = ((src, crop_group(src, jobs)) for src, jobs in groups)
+            total_written = _report(outcomes, output_dir, manifest, failures)
+    finally:
+        manifest.save()
+
+    print(
+        f"\nDone. Wrote {total_written} cropped files from {len(groups)} sources "
+        f"({summary})."
+    )
+    if failures:
+        print(f"\n{len(failures)} crops failed:", file=sys.stderr)
+        for job, error in failures:
+            print(f"  {job.dest.relative_to(output_dir)}: {error}", file=sys.stderr)
+        sys.exit(1)
 
-            total_planned += 1
-            print(
-                f"[{'dry' if args.dry_run else 'crop'}] {image_path.name} "
-                f"-> {dest_path.relative_to(output_dir)} "
-                f"(L{spec.left}/T{spec.top}/R{spec.right}/B{spec.bottom})"
-            )
-            if args.dry_run:
+
+def _report(
+    outcomes: Iterable[
+        tuple[Path, tuple[SourceFingerprint | None, List[tuple[CropJob, str]]]]
+    ],
+    output_dir: Path,
+    manifest: CropManifest,
+    failures: List[tuple[CropJob, str]],
+) -> int:
+    """Print each group's results and record successful crops."""
+    written = 0
+    for src, (fingerprint, results) in outcomes:
+        for job, error in results:
+            dest = job.dest.relative_to(output_dir)
+            if error:
+                failures.append((job, error))
+                print(f"[fail] {src.name} -> {dest}: {error}")
                 continue
-            crop_single_image(
-                image_path,
-                dest_path,
-                left=spec.left,
-                top=spec.top,
-                right=spec.right,
-                bottom=spec.bottom,
+            written += 1
+            manifest.entries[dest.as_posix()] = ManifestEntry(
+                src.name, fingerprint, job.params, job.label
             )
-            total_written += 1
-
-    if args.dry_run:
-        print(
-            f"\nDry-run complete. {total_planned} images would be written "
-            f"({total_skipped} skipped)."
-        )
-    else:
-        print(f"\nDone. Wrote {total_written} cropped files ({total_skipped} skipped).")
+            print(f"[crop] {src.name} -> {dest} ({job.margins})")
+    return written
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Compare the OG generators' two-pass and single-resample affine layer paths.
+
+For a sample of masters and every layout angle, builds the rotated layer
+frame both ways:
+
+  two-pass  LANCZOS normalise onto the layout canvas, then BICUBIC rotate
+  affine    integer box-reduce and Gaussian prefilter of the master, then
+            one BICUBIC transform that crops, scales, places and rotates
+            (--resample affine)
+
+and reports the time of each stage plus quality against a reference that
+favours neither: the product LANCZOS-resampled in floating point straight to
+--supersample x its normalised size, rotated at that size and box-reduced
+back. Quality is PSNR over premultiplied RGBA and edge energy (sum of squared
+alpha gradients) relative to the reference; below 1.0 is softer than the
+reference.
+
+Read-only: masters are decoded directly and no cache is touched.
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import generate_ipad_og_images as ipad
+import generate_og_images as iphone
+from asset_cache import (
+    affine_layer,
+    prefilter_sigma,
+    reduce_master,
+    reduction_factor,
+    rotate_layer,
+    rotation_frame,
+)
+from mipmap_store import resample
+
+LAYOUTS = {
+    "iphone": (iphone.normalize_case, iphone.case_geometry, iphone.CASE_SIZE, iphone.ROTATIONS),
+    "ipad": (ipad.normalize_product, ipad.product_geometry, ipad.PRODUCT_CANVAS_SIZE, ipad.ROTATIONS),
+}
+DEFAULT_SAMPLE = 12
+DEFAULT_SUPERSAMPLE = 4
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("masters", nargs="*", type=Path, help="master PNGs (default: a sample of SOURCE_DIR)")
+    parser.add_argument("--layout", choices=sorted(LAYOUTS), default="iphone")
+    parser.add_argument("--sample", type=int, default=DEFAULT_SAMPLE,
+                        help=f"masters to take from SOURCE_DIR when none are given (default: {DEFAULT_SAMPLE})")
+    parser.add_argument("--supersample", type=int, default=DEFAULT_SUPERSAMPLE,
+                        help=f"reference render multiple (default: {DEFAULT_SUPERSAMPLE})")
+    return parser.parse_args()
+
+
+def premultiplied(frame: Image.Image) -> np.ndarray:
+    with frame.convert("RGBa") as converted:
+        return np.asarray(converted, dtype=np.float64)
+
+
+def psnr(frame: np.ndarray, reference: np.ndarray) -> float:
+    mse = float(np.mean((frame - reference) ** 2))
+    return float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def edge_energy(frame: np.ndarray) -> float:
+    alpha = frame[..., 3]
+    return float((np.diff(alpha, axis=0) ** 2).sum() + (np.diff(alpha, axis=1) ** 2).sum())
+
+
+def reference_frame(
+    product: Image.Image,
+    placement: "tuple[tuple[int, int], tuple[int, int]]",
+    canvas: tuple[int, int],
+    angle: float,
+    supersample: int,
+) -> Image.Image:
+    """The rotated frame of straight RGBA `product` (the master's alpha bbox)
+    at `placement` on `canvas`, built independently of both paths: a float
+    LANCZOS resample to `supersample` x the normalised size, a BICUBIC
+    rotation on the `supersample` x canvas and a box reduction back."""
+    (width, height), (x, y) = placement
+    resized = resample(product, (width * supersample, height * supersample))
+    layer = Image.new(
+        "RGBa", (canvas[0] * supersample, canvas[1] * supersample), (0, 0, 0, 0)
+    )
+    with resized.convert("RGBa") as premultiplied_product:
+        layer.paste(premultiplied_product, (x * supersample, y * supersample))
+    resized.close()
+    frame, (a, b, c, d, e, f) = rotation_frame(canvas, angle)
+    rotated = layer.transform(
+        (frame[0] * supersample, frame[1] * supersample),
+        Image.Transform.AFFINE,
+        (a, b, c * supersample, d, e, f * supersample),
+        resample=Image.Resampling.BICUBIC,
+        fillcolor=(0, 0, 0, 0),
+    )
+    layer.close()
+    reduced = rotated.reduce(supersample)
+    rotated.close()
+    straight = reduced.convert("RGBA")
+    reduced.close()
+    return straight
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def compare(path: Path, layout: str, supersample: int) -> list[dict[str, float | str]]:
+    normalise, geometry, canvas, angles = LAYOUTS[layout]
+    with Image.open(path) as image:
+        rgba = image.convert("RGBA")
+    alpha_box = rgba.getchannel("A").getbbox()
+    if alpha_box is None:
+        raise ValueError("source image is fully transparent")
+    box_size = (alpha_box[2] - alpha_box[0], alpha_box[3] - alpha_box[1])
+    placement = geometry(box_size)
+    factor = reduction_factor(box_size, placement[0])
+    sigma = prefilter_sigma(box_size, placement[0], factor)
+
+    normalised, normalise_ms = timed(normalise, rgba.copy(), alpha_box)
+    layer = normalised.convert("RGBa")
+    normalised.close()
+    reduced, reduce_ms = timed(reduce_master, rgba, alpha_box, factor, sigma)
+    product = rgba.crop(alpha_box)
+    rgba.close()
+
+    rows = []
+    for angle in angles:
+        two_pass, rotate_ms = timed(rotate_layer, layer, angle)
+        affine, affine_ms = timed(
+            affine_layer, reduced, factor, box_size, placement, canvas, angle
+        )
+        reference = reference_frame(product, placement, canvas, angle, supersample)
+        expected = premultiplied(reference)
+        two_pass_pixels, affine_pixels = premultiplied(two_pass), premultiplied(affine)
+        energy = edge_energy(expected) or 1.0
+        rows.append(
+            {
+                "master": path.name,
+                "angle": angle,
+                "factor": factor,
+                "two_pass_prep_ms": normalise_ms,
+                "two_pass_ms": rotate_ms,
+                "affine_prep_ms": reduce_ms,
+                "affine_ms": affine_ms,
+                "two_pass_psnr": psnr(two_pass_pixels, expected),
+                "affine_psnr": psnr(affine_pixels, expected),
+                "two_pass_edge": edge_energy(two_pass_pixels) / energy,
+                "affine_edge": edge_energy(affine_pixels) / energy,
+                "two_pass_mb": layer.width * layer.height * 4 / 1e6,
+                "affine_mb": reduced.width * reduced.height * 4 / 1e6,
+            }
+        )
+        for frame in (two_pass, affine, reference):
+            frame.close()
+    layer.close()
+    reduced.close()
+    product.close()
+    return rows
+
+
+def main() -> int:
+    args = parse_args()
+    source_dir = (iphone if args.layout == "iphone" else ipad).SOURCE_DIR
+    masters = args.masters or sorted(source_dir.glob("*.png"))[: args.sample]
+    if not masters:
+        print(f"No masters given and none found in {source_dir}", file=sys.stderr)
+        return 1
+
+    rows = []
+    for path in masters:
+        try:
+            rows.extend(compare(path, args.layout, args.supersample))
+        except (OSError, ValueError) as error:
+            print(f"{path.name}: {error}", file=sys.stderr)
+    if not rows:
+        return 1
+
+    print(f"{'master':<24} {'angle':>5} {'f':>2}  {'ms 2p/aff':>11}  {'PSNR 2p/aff':>13}  {'edge 2p/aff':>11}")
+    for row in rows:
+        print(
+            f"{row['master'][:24]:<24} {row['angle']:>5} {row['factor']:>2}  "
+            f"{row['two_pass_ms']:5.1f}/{row['affine_ms']:<5.1f}  "
+            f"{row['two_pass_psnr']:6.2f}/{row['affine_psnr']:<6.2f}  "
+            f"{row['two_pass_edge']:5.3f}/{row['affine_edge']:<5.3f}"
+        )
+
+    def mean(key: str) -> float:
+        return statistics.fmean(row[key] for row in rows)
+
+    print(f"\n{len(masters)} masters x {len(LAYOUTS[args.layout][3])} angles, reference at {args.supersample}x")
+    print(f"  prep per master  two-pass {mean('two_pass_prep_ms'):7.1f} ms   affine {mean('affine_prep_ms'):7.1f} ms")
+    print(f"  per layer        two-pass {mean('two_pass_ms'):7.1f} ms   affine {mean('affine_ms'):7.1f} ms")
+    print(f"  cached layer     two-pass {mean('two_pass_mb'):7.1f} MB   affine {mean('affine_mb'):7.1f} MB")
+    print(f"  PSNR vs ref      two-pass {mean('two_pass_psnr'):7.2f} dB   affine {mean('affine_psnr'):7.2f} dB")
+    print(f"  edge energy      two-pass {mean('two_pass_edge'):7.3f}      affine {mean('affine_edge'):7.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -6,13 +6,46 @@ from __future__ import annotations
 import argparse
 import csv
 import hashlib
+import itertools
 import random
 import re
 import sys
 from collections import OrderedDict
 from pathlib import Path
-
-from PIL import Image, ImageChops
+from typing import Callable, Iterator
+
+from PIL import Image
+
+from asset_cache import (
+    AFFINE_PARAMS,
+    AffineFrames,
+    Composite,
+    LayerCompositor,
+    NormalizedAssetCache,
+    RotatedLayer,
+    RotatedLayerCache,
+    layers_collide,
+    rotate_layer,
+)
+from image_analysis import MetricsCache
+from og_pipeline import (
+    DEFAULT_ENCODERS,
+    DEFAULT_WORKERS,
+    MANIFEST_NAME,
+    OUTPUT_FORMATS,
+    EncoderPool,
+    OgManifest,
+    OutputFormat,
+    RenderJob,
+    ShardResult,
+    first_errors,
+    layout_hash,
+    master_fingerprints,
+    render_jobs,
+    run_shards,
+    shard_pages,
+    stale_jobs,
+)
 
 
 SCRIPT_DIR = Path(__file__).resolve().parent
@@ -38,6 +71,26 @@ MAX_COLLISION_PASSES = 100
 # pass (which otherwise stops at the first pixel of separation).
 EXTRA_SEPARATION = 110
 RESIZED_CACHE_LIMIT = 20
+# Everything normalize_product depends on; part of the on-disk asset cache key.
+NORMALIZE_NAMESPACE = "ipad-product"
+NORMALIZE_PARAMS = (PRODUCT_CANVAS_SIZE, PRODUCT_MAX_SIZE)
+RESAMPLE_MODES = ("two-pass", "affine")
+# Everything besides the masters that shapes a render; part of each variant's
+# og_manifest.csv record. Bump the version when render() itself changes.
+LAYOUT_VERSION = 1
+LAYOUT = (
+    LAYOUT_VERSION,
+    OUTPUT_SIZE,
+    BACKGROUND_COLOUR,
+    ROTATIONS,
+    CENTRES,
+    COLLISION_NUDGE,
+    MAX_COLLISION_PASSES,
+    EXTRA_SEPARATION,
+    NORMALIZE_PARAMS,
+)
+# Per-process layer cache, output buffers and encoders, set up by init_worker.
+_renderer: tuple[RotatedLayerCache, LayerCompositor, EncoderPool] | None = None
 
 # The composition needs the flat, fully closed front view. On the older pages
 # the main SKU image shows the cover slightly ajar, so per-page rules restrict
@@ -77,6 +130,32 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--output-dir", type=Path, default=DEFAULT_OUTPUT_DIR)
     parser.add_argument("--variants", type=int, default=DEFAULT_VARIANTS)
     parser.add_argument("--page", action="append", default=[])
+    parser.add_argument(
+        "--resample",
+        choices=RESAMPLE_MODES,
+        default=RESAMPLE_MODES[0],
+        help="two-pass: LANCZOS normalise, then BICUBIC rotate; affine: one "
+        "BICUBIC crop+scale+rotate from a box-reduced master",
+    )
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="png")
+    parser.add_argument("--quality", type=int, help="WebP/AVIF quality 0-100")
+    parser.add_argument(
+        "--effort",
+        type=int,
+        help="PNG compress_level 0-9, WebP method 0-6, AVIF 0-10 (10 - speed)",
+    )
+    parser.add_argument("--encoders", type=int, default=DEFAULT_ENCODERS)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help=f"re-render every variant, even those {MANIFEST_NAME} records as current",
+    )
+    parser.add_argument(
+        "--plan-only",
+        action="store_true",
+        help="print each variant's selection without rendering or touching the output folder",
+    )
     return parser.parse_args()
 
 
@@ -163,145 +242,205 @@ def variant_seed(page_slug: str, variant: int, retry: int = 0) -> int:
     return int.from_bytes(hashlib.sha256(value).digest()[:8], "big")
 
 
+# (SKU, model, casefolded colour, kind, candidate): what choose_products
+# compares, computed once per page rather than on every retry.
+KeyedProduct = tuple[str, str, str, str, tuple[dict[str, str], Path]]
+
+
+def keyed_products(candidates: list[tuple[dict[str, str], Path]]) -> list[KeyedProduct]:
+    return [
+        (row["SKU"], row["model"], row["colour"].casefold(), row["kind"], (row, asset))
+        for row, asset in candidates
+    ]
+
+
 def choose_products(
-    candidates: list[tuple[dict[str, str], Path]], rng: random.Random
+    candidates: list[KeyedProduct], rng: random.Random
 ) -> list[tuple[dict[str, str], Path]]:
+    """Pair a random product with the one least like it.
+
+    The partner is the lowest (same model, same colour, same kind, random)
+    key; the random draws are made in shuffled order, as sorting by that key
+    would, so a seed always picks the same pair.
+    """
     remaining = candidates.copy()
     rng.shuffle(remaining)
-    first = remaining[0]
-    first_row = first[0]
-    choices = [item for item in remaining[1:] if item[0]["SKU"] != first_row["SKU"]]
-    choices.sort(
-        key=lambda item: (
-            item[0]["model"] == first_row["model"],
-            item[0]["colour"].casefold() == first_row["colour"].casefold(),
-            item[0]["kind"] == first_row["kind"],
-            rng.random(),
-        )
-    )
-    selected = [first, choices[0]]
+    first_sku, first_model, first_colour, first_kind, first = remaining[0]
+    best = None
+    best_key = None
+    for sku, model, colour, kind, item in remaining[1:]:
+        if sku == first_sku:
+            continue
+        key = (model == first_model, colour == first_colour, kind == first_kind, rng.random())
+        if best_key is None or key < best_key:
+            best, best_key = item, key
+    selected = [first, best]
     rng.shuffle(selected)
     return selected
 
 
+class SelectionSpace:
+    """Every pair choose_products can produce for a page, counted and
+    enumerated without sampling. plan_variants only builds one when seeded
+    sampling stops finding unused pairs.
+
+    The partner only depends on how the two products' (model, colour, kind)
+    compare, so candidates are bucketed by those: every first product in a
+    bucket reaches every product in the buckets least like it, in either
+    order.
+    """
+
+    def __init__(self, candidates: list[tuple[dict[str, str], Path]]) -> None:
+        buckets: dict[tuple[str, str, str], list[tuple[dict[str, str], Path]]] = {}
+        for sku, model, colour, kind, item in keyed_products(candidates):
+            buckets.setdefault((model, colour, kind), []).append(item)
+        keys = sorted(buckets)
+        self.items = [buckets[key] for key in keys]
+        pairs: set[tuple[int, int]] = set()
+        for first, (model, colour, kind) in enumerate(keys):
+            best = None
+            options: list[int] = []
+            for second, (other_model, other_colour, other_kind) in enumerate(keys):
+                if second == first and len(self.items[first]) < 2:
+                    continue
+                key = (other_model == model, other_colour == colour, other_kind == kind)
+                if best is None or key < best:
+                    best, options = key, [second]
+                elif key == best:
+                    options.append(second)
+            pairs.update((min(first, second), max(first, second)) for second in options)
+        self.pairs = sorted(pairs)
+        self.total = 2 * sum(
+            len(self.items[first]) * (len(self.items[second]) - 1) // 2
+            if first == second
+            else len(self.items[first]) * len(self.items[second])
+            for first, second in self.pairs
+        )
+
+    def arrangements(
+        self, rng: random.Random
+    ) -> Iterator[list[tuple[dict[str, str], Path]]]:
+        """Every reachable pair once in each order, bucket pairs in random order."""
+        pairs = self.pairs.copy()
+        rng.shuffle(pairs)
+        for first, second in pairs:
+            if first == second:
+                products = itertools.combinations(self.items[first], 2)
+            else:
+                products = itertools.product(self.items[first], self.items[second])
+            for one, other in products:
+                yield [one, other]
+                yield [other, one]
+
+
 def plan_variants(
     candidates: list[tuple[dict[str, str], Path]], page_slug: str, count: int
 ) -> list[list[tuple[dict[str, str], Path]]]:
+    space: SelectionSpace | None = None  # built only once sampling runs dry
+    keyed = keyed_products(candidates)
     planned: list[list[tuple[dict[str, str], Path]]] = []
     used_orders: set[tuple[str, str]] = set()
     for variant in range(1, count + 1):
         for retry in range(500):
             rng = random.Random(variant_seed(page_slug, variant, retry))
-            selection = choose_products(candidates, rng)
+            selection = choose_products(keyed, rng)
             signature = tuple(row["SKU"] for row, _ in selection)
             if signature not in used_orders:
-                used_orders.add(signature)
-                planned.append(selection)
                 break
         else:
-            raise ValueError(f"{page_slug}: could not create {count} unique variants")
+            # Sampling only keeps hitting used pairs once nearly all are
+            # taken; pick an unused one directly, if any is left.
+            if space is None:
+                space = SelectionSpace(candidates)
+                if space.total < count:
+                    raise ValueError(
+                        f"{page_slug}: only {space.total} unique variants are possible, "
+                        f"{count} requested"
+                    )
+            rng = random.Random(variant_seed(page_slug, variant, -1))
+            for selection in space.arrangements(rng):
+                signature = tuple(row["SKU"] for row, _ in selection)
+                if signature not in used_orders:
+                    break
+            else:
+                raise ValueError(f"{page_slug}: could not create {count} unique variants")
+        used_orders.add(signature)
+        planned.append(selection)
     return planned
 
 
 class ProductCache:
-    def __init__(self, limit: int = RESIZED_CACHE_LIMIT) -> None:
+    def __init__(
+        self,
+        limit: int = RESIZED_CACHE_LIMIT,
+        assets: NormalizedAssetCache | None = None,
+    ) -> None:
         self.limit = limit
         self.images: OrderedDict[Path, Image.Image] = OrderedDict()
+        # Normalised layers persist across runs and are shared between scripts.
+        self.assets = assets or NormalizedAssetCache()
 
     def get(self, path: Path) -> Image.Image:
         if path in self.images:
             image = self.images.pop(path)
             self.images[path] = image
             return image
-        with Image.open(path) as source:
-            image = normalize_product(source)
+        image = self.assets.get(
+            path, NORMALIZE_NAMESPACE, NORMALIZE_PARAMS, normalize_product
+        )
         self.images[path] = image
         if len(self.images) > self.limit:
             _, evicted = self.images.popitem(last=False)
             evicted.close()
         return image
 
+    def frame(self, path: Path, angle: int) -> Image.Image:
+        return rotate_layer(self.get(path), angle)
+
+
+def product_geometry(
+    product_size: tuple[int, int],
+) -> tuple[tuple[int, int], tuple[int, int]]:
+    """Size and top-left of a normalised product on PRODUCT_CANVAS_SIZE."""
+    width, height = product_size
+    scale = min(PRODUCT_MAX_SIZE[0] / width, PRODUCT_MAX_SIZE[1] / height)
+    size = (round(width * scale), round(height * scale))
+    position = (
+        (PRODUCT_CANVAS_SIZE[0] - size[0]) // 2,
+        (PRODUCT_CANVAS_SIZE[1] - size[1]) // 2,
+    )
+    return size, position
+
 
-def normalize_product(source: Image.Image) -> Image.Image:
-    rgba = source.convert("RGBA")
-    alpha_box = rgba.getbbox()
+def normalize_product(
+    rgba: Image.Image, alpha_box: tuple[int, int, int, int] | None
+) -> Image.Image:
     if alpha_box is None:
         rgba.close()
         raise ValueError("source image is fully transparent")
     product = rgba.crop(alpha_box)
     rgba.close()
-    scale = min(
-        PRODUCT_MAX_SIZE[0] / product.width,
-        PRODUCT_MAX_SIZE[1] / product.height,
-    )
-    size = (round(product.width * scale), round(product.height * scale))
+    size, position = product_geometry(product.size)
     resized = product.resize(size, Image.Resampling.LANCZOS)
     product.close()
     normalized = Image.new("RGBA", PRODUCT_CANVAS_SIZE, (0, 0, 0, 0))
-    position = (
-        (PRODUCT_CANVAS_SIZE[0] - size[0]) // 2,
-        (PRODUCT_CANVAS_SIZE[1] - size[1]) // 2,
-    )
     normalized.alpha_composite(resized, position)
     resized.close()
     return normalized
 
 
-def alpha_overlap(
-    first: Image.Image,
-    first_position: list[int],
-    second: Image.Image,
-    second_position: list[int],
-) -> bool:
-    first_alpha = first.getchannel("A")
-    second_alpha = second.getchannel("A")
-    first_box = first_alpha.getbbox()
-    second_box = second_alpha.getbbox()
-    if first_box is None or second_box is None:
-        first_alpha.close()
-        second_alpha.close()
-        return False
-    first_global = tuple(
-        value + first_position[index % 2] for index, value in enumerate(first_box)
-    )
-    second_global = tuple(
-        value + second_position[index % 2] for index, value in enumerate(second_box)
-    )
-    intersection = (
-        max(first_global[0], second_global[0]),
-        max(first_global[1], second_global[1]),
-        min(first_global[2], second_global[2]),
-        min(first_global[3], second_global[3]),
-    )
-    if intersection[0] >= intersection[2] or intersection[1] >= intersection[3]:
-        first_alpha.close()
-        second_alpha.close()
-        return False
-    first_crop = first_alpha.crop(
-        tuple(
-            intersection[index] - first_position[index % 2] for index in range(4)
-        )
-    )
-    second_crop = second_alpha.crop(
-        tuple(
-            intersection[index] - second_position[index % 2] for index in range(4)
-        )
-    )
-    overlap = ImageChops.multiply(first_crop, second_crop).getbbox() is not None
-    first_crop.close()
-    second_crop.close()
-    first_alpha.close()
-    second_alpha.close()
-    return overlap
-
-
-def place_layers(layers: list[Image.Image]) -> list[list[int]]:
+def place_layers(layers: list[RotatedLayer]) -> list[list[int]]:
+    """Top-left positions of the trimmed layer images."""
     positions = [
-        [round(cx - layer.width / 2), round(cy - layer.height / 2)]
+        [
+            round(cx - layer.size[0] / 2) + layer.offset[0],
+            round(cy - layer.size[1] / 2) + layer.offset[1],
+        ]
         for layer, (cx, cy) in zip(layers, CENTRES, strict=True)
     ]
+    first, second = layers
     for _ in range(MAX_COLLISION_PASSES):
-        if not alpha_overlap(layers[0], positions[0], layers[1], positions[1]):
+        if not layers_collide(first, positions[0], second, positions[1]):
             positions[0][0] -= EXTRA_SEPARATION
             positions[1][0] += EXTRA_SEPARATION
             return positions
@@ -312,30 +451,37 @@ def place_layers(layers: list[Image.Image]) -> list[list[int]]:
 
 def render(
     products: list[tuple[dict[str, str], Path]],
-    background_path: Path,
-    transparent_path: Path,
-    cache: ProductCache,
-) -> None:
+    cache: RotatedLayerCache,
+    compositor: LayerCompositor,
+) -> Composite:
     layers = [
-        cache.get(asset).rotate(
-            angle,
-            resample=Image.Resampling.BICUBIC,
-            expand=True,
-            fillcolor=(0, 0, 0, 0),
-        )
+        cache.get(asset, angle)
         for (_, asset), angle in zip(products, ROTATIONS, strict=True)
     ]
     positions = place_layers(layers)
-    transparent = Image.new("RGBA", OUTPUT_SIZE, (0, 0, 0, 0))
-    for layer, position in zip(layers, positions, strict=True):
-        transparent.alpha_composite(layer, tuple(position))
-        layer.close()
-    transparent.save(transparent_path, format="PNG", compress_level=7)
-    background = Image.new("RGBA", OUTPUT_SIZE, BACKGROUND_COLOUR)
-    background.alpha_composite(transparent)
-    background.convert("RGB").save(background_path, format="PNG", compress_level=7)
-    background.close()
-    transparent.close()
+    return compositor.composite(layers, positions)
+
+
+def layer_frames(resample: str) -> Callable[[Path, int], Image.Image]:
+    if resample == "affine":
+        return AffineFrames(
+            NORMALIZE_NAMESPACE, NORMALIZE_PARAMS, PRODUCT_CANVAS_SIZE, product_geometry
+        )
+    return ProductCache().frame
+
+
+def init_worker(resample: str, output: OutputFormat, encoders: int) -> None:
+    global _renderer
+    compositor = LayerCompositor(OUTPUT_SIZE, BACKGROUND_COLOUR)
+    _renderer = (
+        RotatedLayerCache(layer_frames(resample)),
+        compositor,
+        EncoderPool(output, compositor, encoders),
+    )
+
+
+def render_shard(slug: str, jobs: list[RenderJob]) -> ShardResult:
+    return render_jobs(slug, jobs, render, *_renderer)
 
 
 def selected_pages(requested_slugs: list[str]) -> "OrderedDict[str, list[str]]":
@@ -354,6 +500,14 @@ def main() -> int:
     if args.variants < 1:
         print("--variants must be at least 1", file=sys.stderr)
         return 2
+    if args.workers < 1 or args.encoders < 1:
+        print("--workers and --encoders must be at least 1", file=sys.stderr)
+        return 2
+    try:
+        output = OutputFormat.parse(args.format, args.quality, args.effort)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 2
     if not SOURCE_DIR.is_dir():
         print(f"Local source directory not found: {SOURCE_DIR}", file=sys.stderr)
         return 1
@@ -364,9 +518,10 @@ def main() -> int:
         return 2
 
     rows = read_database()
-    args.output_dir.mkdir(parents=True, exist_ok=True)
-    cache = ProductCache()
-    failures: list[str] = []
+    # Plan every page first; variant plans are deterministic, so the jobs
+    # can then render in any order and on any worker.
+    planned: list[tuple[str, list[RenderJob]]] = []
+    plan_errors: dict[str, Exception] = {}
     for slug, models in pages.items():
         try:
             fixed = PAGE_ASSET_RULES.get(slug, {}).get("fixed")
@@ -377,33 +532,81 @@ def main() -> int:
                 candidates = eligible_products(rows, models, slug)
                 variants = plan_variants(candidates, slug, args.variants)
             views = page_views(slug)
-            for number, products in enumerate(variants, start=1):
-                # Cycle through the page's candidate views so pages with
-                # several usable shots produce examples of each.
-                view = views[(number - 1) % len(views)]
-                products = [(row, view_asset(row["SKU"], view)) for row, _ in products]
-                filename = f"ipad-{slug}-{number}.png"
-                transparent_filename = f"ipad-{slug}-{number}-transparent.png"
-                render(
+        except Exception as error:
+            plan_errors[slug] = error
+            continue
+        jobs: list[RenderJob] = []
+        for number, products in enumerate(variants, start=1):
+            # Cycle through the page's candidate views so pages with
+            # several usable shots produce examples of each.
+            view = views[(number - 1) % len(views)]
+            products = [(row, view_asset(row["SKU"], view)) for row, _ in products]
+            selection = ", ".join(
+                f'{row["SKU"]} ({row["model"]}, {row["kind"]})'
+                for row, _ in products
+            )
+            jobs.append(
+                (
+                    number,
                     products,
-                    args.output_dir / filename,
-                    args.output_dir / transparent_filename,
-                    cache,
+                    args.output_dir / f"ipad-{slug}-{number}.{output.name}",
+                    args.output_dir / f"ipad-{slug}-{number}-transparent.{output.name}",
+                    f"{slug}: {number}/{args.variants}: {selection}",
                 )
-                selection = ", ".join(
-                    f'{row["SKU"]} ({row["model"]}, {row["kind"]})'
-                    for row, _ in products
-                )
-                print(f"{slug}: {number}/{args.variants}: {selection}", flush=True)
-        except Exception as error:
-            failures.append(f"{slug}: {error}")
+            )
+        planned.append((slug, jobs))
+
+    if args.plan_only:
+        for _, jobs in planned:
+            for *_, line in jobs:
+                print(line)
+        for slug, error in plan_errors.items():
+            print(f"- {slug}: {error}", file=sys.stderr)
+        return 1 if plan_errors else 0
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = OgManifest(args.output_dir / MANIFEST_NAME)
+    fingerprints = master_fingerprints(
+        (master for _, jobs in planned for job in jobs for _, master in job[1]),
+        MetricsCache(),
+        args.workers,
+    )
+    # Affine frames also depend on asset_cache's own constants.
+    resample = [args.resample, *AFFINE_PARAMS] if args.resample == "affine" else args.resample
+    stale, inputs = stale_jobs(
+        planned, manifest, layout_hash(*LAYOUT, resample, output), fingerprints, args.force
+    )
+    rendered = sum(len(jobs) for _, jobs in stale)
+    unchanged = sum(len(jobs) for _, jobs in planned) - rendered
+
+    results: dict[int, ShardResult] = {}
+    try:
+        for index, result in run_shards(
+            shard_pages(stale, args.workers),
+            render_shard,
+            args.workers,
+            init_worker,
+            (args.resample, output, args.encoders),
+        ):
+            results[index] = result
+            for line in result.lines:
+                print(line, flush=True)
+            for background_path in result.outputs:
+                manifest.record(background_path, *inputs[background_path])
+    finally:
+        manifest.save()
+    errors = {**plan_errors, **first_errors(results)}
+    failures = [f"{slug}: {errors[slug]}" for slug in pages if slug in errors]
 
     if failures:
         print("\nFailed pages:", file=sys.stderr)
         for failure in failures:
             print(f"- {failure}", file=sys.stderr)
         return 1
-    print(f"\nGenerated {len(pages) * args.variants * 2} images in {args.output_dir}")
+    print(
+        f"\nGenerated {rendered * 2} images in {args.output_dir} "
+        f"({unchanged} unchanged variants skipped)"
+    )
     return 0
 
 
@@ -11,13 +11,47 @@ from __future__ import annotations
 import argparse
 import csv
 import hashlib
+import itertools
+import math
 import random
 import re
 import sys
 from collections import OrderedDict
 from pathlib import Path
-
-from PIL import Image, ImageChops
+from typing import Callable, Iterator
+
+from PIL import Image
+
+from asset_cache import (
+    AFFINE_PARAMS,
+    AffineFrames,
+    Composite,
+    LayerCompositor,
+    NormalizedAssetCache,
+    RotatedLayer,
+    RotatedLayerCache,
+    layers_collide,
+    rotate_layer,
+)
+from image_analysis import MetricsCache
+from og_pipeline import (
+    DEFAULT_ENCODERS,
+    DEFAULT_WORKERS,
+    MANIFEST_NAME,
+    OUTPUT_FORMATS,
+    EncoderPool,
+    OgManifest,
+    OutputFormat,
+    RenderJob,
+    ShardResult,
+    first_errors,
+    layout_hash,
+    master_fingerprints,
+    render_jobs,
+    run_shards,
+    shard_pages,
+    stale_jobs,
+)
 
 
 SCRIPT_DIR = Path(__file__).resolve().parent
@@ -29,7 +63,11 @@ SOURCE_DIR = Path("/Volumes/Storage/Images/1_final-sources")
 
 MODEL_PATTERN = re.compile(r'\bmodel:\s*["\']([^"\']+)["\']')
 OUTPUT_SIZE = (2400, 1260)
-CANVAS_SIZE = (4000, 4000)
+CANVAS_SIZE = (4000, 4000)  # layout frame POSITIONS are given in; never allocated
+CANVAS_ORIGIN = (
+    (CANVAS_SIZE[0] - OUTPUT_SIZE[0]) // 2,
+    (CANVAS_SIZE[1] - OUTPUT_SIZE[1]) // 2,
+)
 CASE_SIZE = (1600, 1600)
 NORMALIZED_OBJECT_HEIGHT = 1320
 NORMALIZED_OBJECT_MAX_WIDTH = 700
@@ -56,6 +94,26 @@ DEFAULT_VARIANTS = 20
 RESIZED_CACHE_LIMIT = 24
 COLLISION_NUDGE = 12
 MAX_COLLISION_PASSES = 100
+# Everything normalize_case depends on; part of the on-disk asset cache key.
+NORMALIZE_NAMESPACE = "iphone-case"
+NORMALIZE_PARAMS = (CASE_SIZE, NORMALIZED_OBJECT_HEIGHT, NORMALIZED_OBJECT_MAX_WIDTH)
+RESAMPLE_MODES = ("two-pass", "affine")
+# Everything besides the masters that shapes a render; part of each variant's
+# og_manifest.csv record. Bump the version when render() itself changes.
+LAYOUT_VERSION = 1
+LAYOUT = (
+    LAYOUT_VERSION,
+    OUTPUT_SIZE,
+    CANVAS_SIZE,
+    BACKGROUND_COLOUR,
+    ROTATIONS,
+    POSITIONS,
+    COLLISION_NUDGE,
+    MAX_COLLISION_PASSES,
+    NORMALIZE_PARAMS,
+)
+# Per-process layer cache, output buffers and encoders, set up by init_worker.
+_renderer: tuple[RotatedLayerCache, LayerCompositor, EncoderPool] | None = None
 
 
 def parse_args() -> argparse.Namespace:
@@ -78,6 +136,59 @@ def parse_args() -> argparse.Namespace:
         default=[],
         help="page slug to render; repeat for multiple pages (default: all)",
     )
+    parser.add_argument(
+        "--resample",
+        choices=RESAMPLE_MODES,
+        default=RESAMPLE_MODES[0],
+        help="two-pass: LANCZOS normalise, then BICUBIC rotate; affine: one "
+        "BICUBIC crop+scale+rotate from a box-reduced master "
+        "(default: two-pass)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"render processes; 1 renders in-process (default: {DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--format",
+        choices=sorted(OUTPUT_FORMATS),
+        default="png",
+        help="output format; webp is what lib/og.ts serves (default: png)",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        help="WebP/AVIF quality 0-100 (default: "
+        + ", ".join(
+            f"{name} {quality}" for name, (quality, _, _) in OUTPUT_FORMATS.items() if quality
+        )
+        + ")",
+    )
+    parser.add_argument(
+        "--effort",
+        type=int,
+        help="encoder effort, higher is smaller and slower: PNG compress_level "
+        "0-9, WebP method 0-6, AVIF 0-10 (10 - speed) (default: "
+        + ", ".join(f"{name} {effort}" for name, (_, effort, _) in OUTPUT_FORMATS.items())
+        + ")",
+    )
+    parser.add_argument(
+        "--encoders",
+        type=int,
+        default=DEFAULT_ENCODERS,
+        help=f"encoder threads per render process (default: {DEFAULT_ENCODERS})",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help=f"re-render every variant, even those {MANIFEST_NAME} records as current",
+    )
+    parser.add_argument(
+        "--plan-only",
+        action="store_true",
+        help="print each variant's selection without rendering or touching the output folder",
+    )
     return parser.parse_args()
 
 
@@ -132,10 +243,28 @@ def variant_seed(page_slug: str, variant: int, retry: int = 0) -> int:
     return int.from_bytes(hashlib.sha256(value).digest()[:8], "big")
 
 
+# (SKU, model, casefolded colour, kind, candidate): what choose_cases compares,
+# computed once per page rather than on every pick of every retry.
+KeyedCase = tuple[str, str, str, str, tuple[dict[str, str], Path]]
+
+
+def keyed_cases(candidates: list[tuple[dict[str, str], Path]]) -> list[KeyedCase]:
+    return [
+        (row["SKU"], row["model"], row["colour"].casefold(), row["kind"], (row, asset))
+        for row, asset in candidates
+    ]
+
+
 def choose_cases(
-    candidates: list[tuple[dict[str, str], Path]], rng: random.Random
+    candidates: list[KeyedCase], rng: random.Random
 ) -> list[tuple[dict[str, str], Path]]:
-    """Choose four distinct products, favouring model and colour variety."""
+    """Choose four distinct products, favouring model and colour variety.
+
+    Each pick is the remaining item with the lowest (model count, colour
+    used, kind count, random) key. The random draws are made for every
+    remaining item in shuffled order, as sorting by that key would, so a
+    seed always picks the same cases.
+    """
     remaining = candidates.copy()
     rng.shuffle(remaining)
     selected: list[tuple[dict[str, str], Path]] = []
@@ -145,32 +274,181 @@ def choose_cases(
     kind_counts: dict[str, int] = {}
 
     for _ in range(CASES_PER_IMAGE):
-        choices = [item for item in remaining if item[0]["SKU"] not in used_skus]
-        choices.sort(
-            key=lambda item: (
-                model_counts.get(item[0]["model"], 0),
-                item[0]["colour"].casefold() in used_colours,
-                kind_counts.get(item[0]["kind"], 0),
+        best = None
+        best_key = None
+        for sku, model, colour, kind, item in remaining:
+            if sku in used_skus:
+                continue
+            key = (
+                model_counts.get(model, 0),
+                colour in used_colours,
+                kind_counts.get(kind, 0),
                 rng.random(),
             )
-        )
-        row, asset = choices[0]
-        selected.append((row, asset))
-        used_skus.add(row["SKU"])
-        used_colours.add(row["colour"].casefold())
-        model_counts[row["model"]] = model_counts.get(row["model"], 0) + 1
-        kind_counts[row["kind"]] = kind_counts.get(row["kind"], 0) + 1
+            if best_key is None or key < best_key:
+                best, best_key = (sku, model, colour, kind, item), key
+        sku, model, colour, kind, item = best
+        selected.append(item)
+        used_skus.add(sku)
+        used_colours.add(colour)
+        model_counts[model] = model_counts.get(model, 0) + 1
+        kind_counts[kind] = kind_counts.get(kind, 0) + 1
 
     rng.shuffle(selected)
     return selected
 
 
+class SelectionSpace:
+    """Every arrangement choose_cases (+ arrange_models_symmetrically) can
+    produce for a page, counted and enumerated without sampling. plan_variants
+    only builds one when seeded sampling stops finding unused arrangements.
+
+    Candidates are bucketed by (model, colour, kind): the greedy pick only
+    looks at those, so which buckets four picks can come from is a walk over
+    bucket multisets, and any SKUs from those buckets in any order the
+    layout allows are reachable.
+    """
+
+    def __init__(
+        self,
+        candidates: list[tuple[dict[str, str], Path]],
+        expected_models: int | None,
+    ) -> None:
+        # expected_models: symmetric pages only accept selections with exactly
+        # this many models, arranged by arrange_models_symmetrically.
+        buckets: dict[tuple[str, str, str], list[tuple[dict[str, str], Path]]] = {}
+        for sku, model, colour, kind, item in keyed_cases(candidates):
+            buckets.setdefault((model, colour, kind), []).append(item)
+        self.keys = sorted(buckets)
+        self.items = [buckets[key] for key in self.keys]
+        self.expected_models = expected_models
+        self.selections = self._reachable()
+        self.total = sum(self._weight(selection) for selection in self.selections)
+
+    def _reachable(self) -> list[tuple[int, ...]]:
+        model_ids: dict[str, int] = {}
+        colour_ids: dict[str, int] = {}
+        kind_ids: dict[str, int] = {}
+        attributes = [
+            (
+                model_ids.setdefault(model, len(model_ids)),
+                colour_ids.setdefault(colour, len(colour_ids)),
+                kind_ids.setdefault(kind, len(kind_ids)),
+            )
+            for model, colour, kind in self.keys
+        ]
+        sizes = [len(items) for items in self.items]
+        # chosen buckets (sorted) -> (model counts, used colour bits, kind counts)
+        level = {(): ((0,) * len(model_ids), 0, (0,) * len(kind_ids))}
+        for pick in range(1, CASES_PER_IMAGE + 1):
+            following: dict[tuple[int, ...], tuple[tuple[int, ...], int, tuple[int, ...]] | None] = {}
+            for chosen, (model_counts, colours, kind_counts) in level.items():
+                best = None
+                options: list[int] = []
+                for index, (model, colour, kind) in enumerate(attributes):
+                    key = (model_counts[model], colours >> colour & 1, kind_counts[kind])
+                    if best is not None and key > best:
+                        continue
+                    if chosen.count(index) >= sizes[index]:
+                        continue
+                    if key != best:
+                        best, options = key, [index]
+                    else:
+                        options.append(index)
+                for index in options:
+                    state = tuple(sorted(chosen + (index,)))
+                    if pick == CASES_PER_IMAGE:
+                        following[state] = None  # final picks need no counts
+                        continue
+                    if state in following:
+                        continue
+                    model, colour, kind = attributes[index]
+                    following[state] = (
+                        model_counts[:model] + (model_counts[model] + 1,) + model_counts[model + 1:],
+                        colours | 1 << colour,
+                        kind_counts[:kind] + (kind_counts[kind] + 1,) + kind_counts[kind + 1:],
+                    )
+            level = following
+        return sorted(level)
+
+    def _symmetric_pairs(self, models: list[str]) -> set[str] | None:
+        """Models arrange_models_symmetrically puts on a diagonal; None when
+        the selection is shuffled freely instead."""
+        sizes = sorted(models.count(model) for model in set(models))
+        if sizes not in ([2, 2], [1, 1, 2]):
+            return None
+        return {model for model in models if models.count(model) == 2}
+
+    def _orders(self, models: list[str]) -> list[tuple[int, ...]]:
+        """Slot orders of a selection (by position in `models`) the layout
+        can produce."""
+        orders = list(itertools.permutations(range(CASES_PER_IMAGE)))
+        if self.expected_models is None:
+            return orders
+        if len(set(models)) != self.expected_models:
+            return []
+        pairs = self._symmetric_pairs(models)
+        if pairs is None:
+            return orders
+        return [
+            order
+            for order in orders
+            if all(
+                {slot for slot, index in enumerate(order) if models[index] == model}
+                in ({0, 3}, {1, 2})
+                for model in pairs
+            )
+        ]
+
+    def _weight(self, selection: tuple[int, ...]) -> int:
+        combinations = 1
+        for index, repeats in itertools.groupby(selection):
+            combinations *= math.comb(len(self.items[index]), len(list(repeats)))
+        orders = math.factorial(CASES_PER_IMAGE)
+        if self.expected_models is not None:
+            models = [self.keys[index][0] for index in selection]
+            if len(set(models)) != self.expected_models:
+                return 0
+            if self._symmetric_pairs(models) is not None:
+                orders = 8  # each pair on either diagonal, either way round
+        return combinations * orders
+
+    def arrangements(
+        self, rng: random.Random
+    ) -> Iterator[list[tuple[dict[str, str], Path]]]:
+        """Every reachable arrangement once, bucket selections in random order."""
+        selections = self.selections.copy()
+        rng.shuffle(selections)
+        for selection in selections:
+            per_bucket = [
+                itertools.combinations(self.items[index], selection.count(index))
+                for index in sorted(set(selection))
+            ]
+            for picked in itertools.product(*per_bucket):
+                cases = [item for group in picked for item in group]
+                models = [row["model"] for row, _ in cases]
+                for order in self._orders(models):
+                    yield [cases[index] for index in order]
+
+
 def plan_variants(
     candidates: list[tuple[dict[str, str], Path]],
     models: list[str],
     page_slug: str,
     count: int,
 ) -> list[list[tuple[dict[str, str], Path]]]:
+    symmetric = page_slug in SYMMETRIC_MULTI_MODEL_PAGES
+    expected_model_count = None
+    if symmetric:
+        available_model_count = len(
+            {row["model"] for row, _ in candidates if row["model"] in models}
+        )
+        expected_model_count = min(CASES_PER_IMAGE, available_model_count)
+    # Built only once seeded sampling runs dry: walking a big symmetric page's
+    # reachable selections takes seconds, and sampling almost never needs it.
+    space: SelectionSpace | None = None
+
+    keyed = keyed_cases(candidates)
     planned: list[list[tuple[dict[str, str], Path]]] = []
     used_orders: set[tuple[str, ...]] = set()
 
@@ -179,15 +457,11 @@ def plan_variants(
         signature = None
         for retry in range(200):
             rng = random.Random(variant_seed(page_slug, variant, retry))
-            candidate_selection = choose_cases(candidates, rng)
-            if page_slug in SYMMETRIC_MULTI_MODEL_PAGES:
+            candidate_selection = choose_cases(keyed, rng)
+            if symmetric:
                 candidate_selection = arrange_models_symmetrically(
                     candidate_selection, rng
                 )
-                available_model_count = len(
-                    {row["model"] for row, _ in candidates if row["model"] in models}
-                )
-                expected_model_count = min(CASES_PER_IMAGE, available_model_count)
                 if (
                     len({row["model"] for row, _ in candidate_selection})
                     != expected_model_count
@@ -198,6 +472,23 @@ def plan_variants(
                 selection = candidate_selection
                 signature = candidate_signature
                 break
+        if selection is None:
+            # Sampling only keeps hitting used arrangements once nearly all
+            # are taken; pick an unused one directly, if any is left.
+            if space is None:
+                space = SelectionSpace(candidates, expected_model_count)
+                if space.total < count:
+                    raise ValueError(
+                        f"{page_slug}: only {space.total} unique variants are possible, "
+                        f"{count} requested"
+                    )
+            rng = random.Random(variant_seed(page_slug, variant, -1))
+            for candidate_selection in space.arrangements(rng):
+                candidate_signature = tuple(row["SKU"] for row, _ in candidate_selection)
+                if candidate_signature not in used_orders:
+                    selection = candidate_selection
+                    signature = candidate_signature
+                    break
         if selection is None or signature is None:
             raise ValueError(f"{page_slug}: could not create {count} unique variants")
         used_orders.add(signature)
@@ -240,11 +531,18 @@ def arrange_models_symmetrically(
 
 
 class ResizedImageCache:
-    """Small LRU cache; full-size masters are large enough to exhaust RAM."""
-
-    def __init__(self, limit: int = RESIZED_CACHE_LIMIT) -> None:
+    """Small in-memory LRU of normalised layers (premultiplied RGBa) in front
+    of the on-disk NormalizedAssetCache."""
+
+    def __init__(
+        self,
+        limit: int = RESIZED_CACHE_LIMIT,
+        assets: NormalizedAssetCache | None = None,
+    ) -> None:
         self.limit = limit
         self.images: OrderedDict[Path, Image.Image] = OrderedDict()
+        # Normalised layers persist across runs and are shared between scripts.
+        self.assets = assets or NormalizedAssetCache()
 
     def get(self, path: Path) -> Image.Image:
         if path in self.images:
@@ -252,38 +550,51 @@ class ResizedImageCache:
             self.images[path] = image
             return image
 
-        with Image.open(path) as source:
-            image = normalize_case(source)
+        image = self.assets.get(
+            path, NORMALIZE_NAMESPACE, NORMALIZE_PARAMS, normalize_case
+        )
         self.images[path] = image
         if len(self.images) > self.limit:
             _, evicted = self.images.popitem(last=False)
             evicted.close()
         return image
 
+    def frame(self, path: Path, angle: int) -> Image.Image:
+        return rotate_layer(self.get(path), angle)
+
+
+def case_geometry(
+    product_size: tuple[int, int],
+) -> tuple[tuple[int, int], tuple[int, int]]:
+    """Size and top-left of a normalised product on the CASE_SIZE canvas."""
+    width, height = product_size
+    scale = min(
+        NORMALIZED_OBJECT_HEIGHT / height,
+        NORMALIZED_OBJECT_MAX_WIDTH / width,
+    )
+    size = (
+        max(1, round(width * scale)),
+        max(1, round(height * scale)),
+    )
+    position = ((CASE_SIZE[0] - size[0]) // 2, (CASE_SIZE[1] - size[1]) // 2)
+    return size, position
+
 
-def normalize_case(source: Image.Image) -> Image.Image:
+def normalize_case(
+    rgba: Image.Image, alpha_box: tuple[int, int, int, int] | None
+) -> Image.Image:
     """Normalize the visible product, not its inconsistent source padding."""
-    rgba = source.convert("RGBA")
-    alpha_box = rgba.getbbox()
     if alpha_box is None:
         rgba.close()
         raise ValueError("source image is fully transparent")
 
     product = rgba.crop(alpha_box)
     rgba.close()
-    scale = min(
-        NORMALIZED_OBJECT_HEIGHT / product.height,
-        NORMALIZED_OBJECT_MAX_WIDTH / product.width,
-    )
-    size = (
-        max(1, round(product.width * scale)),
-        max(1, round(product.height * scale)),
-    )
+    size, position = case_geometry(product.size)
     resized = product.resize(size, Image.Resampling.LANCZOS)
     product.close()
 
     normalized = Image.new("RGBA", CASE_SIZE, (0, 0, 0, 0))
-    position = ((CASE_SIZE[0] - size[0]) // 2, (CASE_SIZE[1] - size[1]) // 2)
     normalized.alpha_composite(resized, position)
     resized.close()
     return normalized
@@ -291,129 +602,77 @@ def normalize_case(source: Image.Image) -> Image.Image:
 
 def render(
     cases: list[tuple[dict[str, str], Path]],
-    background_path: Path,
-    transparent_path: Path,
-    cache: ResizedImageCache,
-) -> None:
-    canvas = Image.new("RGBA", CANVAS_SIZE, (0, 0, 0, 0))
-
+    cache: RotatedLayerCache,
+    compositor: LayerCompositor,
+) -> Composite:
     layers = [
-        cache.get(asset).rotate(
-            angle,
-            resample=Image.Resampling.BICUBIC,
-            expand=True,
-            fillcolor=(0, 0, 0, 0),
-        )
+        cache.get(asset, angle)
         for (_, asset), angle in zip(cases, ROTATIONS, strict=True)
     ]
-    positions = [list(position) for position in POSITIONS]
+    # Layers are trimmed to their alpha bbox; POSITIONS place the full frame.
+    positions = [
+        [x + layer.offset[0], y + layer.offset[1]]
+        for layer, (x, y) in zip(layers, POSITIONS, strict=True)
+    ]
     separate_colliding_layers(layers, positions)
 
-    for layer, position in zip(layers, positions, strict=True):
-        canvas.alpha_composite(layer, tuple(position))
-        layer.close()
-
-    crop_left = (CANVAS_SIZE[0] - OUTPUT_SIZE[0]) // 2
-    crop_top = (CANVAS_SIZE[1] - OUTPUT_SIZE[1]) // 2
-    crop_box = (
-        crop_left,
-        crop_top,
-        crop_left + OUTPUT_SIZE[0],
-        crop_top + OUTPUT_SIZE[1],
-    )
-    transparent = canvas.crop(crop_box)
-    canvas.close()
-
-    transparent.save(transparent_path, format="PNG", compress_level=7)
-    background = Image.new("RGBA", OUTPUT_SIZE, BACKGROUND_COLOUR)
-    background.alpha_composite(transparent)
-    background.convert("RGB").save(background_path, format="PNG", compress_level=7)
-    background.close()
-    transparent.close()
-
-
-def layers_overlap(
-    first: Image.Image,
-    first_position: list[int],
-    second: Image.Image,
-    second_position: list[int],
-) -> bool:
-    first_alpha = first.getchannel("A")
-    second_alpha = second.getchannel("A")
-    first_box = first_alpha.getbbox()
-    second_box = second_alpha.getbbox()
-    if first_box is None or second_box is None:
-        first_alpha.close()
-        second_alpha.close()
-        return False
-
-    first_global = (
-        first_position[0] + first_box[0],
-        first_position[1] + first_box[1],
-        first_position[0] + first_box[2],
-        first_position[1] + first_box[3],
-    )
-    second_global = (
-        second_position[0] + second_box[0],
-        second_position[1] + second_box[1],
-        second_position[0] + second_box[2],
-        second_position[1] + second_box[3],
-    )
-    intersection = (
-        max(first_global[0], second_global[0]),
-        max(first_global[1], second_global[1]),
-        min(first_global[2], second_global[2]),
-        min(first_global[3], second_global[3]),
-    )
-    if intersection[0] >= intersection[2] or intersection[1] >= intersection[3]:
-        first_alpha.close()
-        second_alpha.close()
-        return False
-
-    first_crop = first_alpha.crop(
-        (
-            intersection[0] - first_position[0],
-            intersection[1] - first_position[1],
-            intersection[2] - first_position[0],
-            intersection[3] - first_position[1],
-        )
-    )
-    second_crop = second_alpha.crop(
-        (
-            intersection[0] - second_position[0],
-            intersection[1] - second_position[1],
-            intersection[2] - second_position[0],
-            intersection[3] - second_position[1],
-        )
-    )
-    overlap = ImageChops.multiply(first_crop, second_crop).getbbox() is not None
-    first_crop.close()
-    second_crop.close()
-    first_alpha.close()
-    second_alpha.close()
-    return overlap
+    return compositor.composite(layers, positions)
 
 
 def separate_colliding_layers(
-    layers: list[Image.Image], positions: list[list[int]]
+    layers: list[RotatedLayer], positions: list[list[int]]
 ) -> None:
     directions = ((-1, -1), (1, -1), (-1, 1), (1, 1))
+    pairs = [
+        (first, second)
+        for first in range(len(layers))
+        for second in range(first + 1, len(layers))
+    ]
+    # A pair that did not collide stays clear until one of its layers moves,
+    # so each pass only retests pairs touching last pass's nudged layers.
+    collides: dict[tuple[int, int], bool] = {}
     for _ in range(MAX_COLLISION_PASSES):
         colliding: set[int] = set()
-        for first in range(len(layers)):
-            for second in range(first + 1, len(layers)):
-                if layers_overlap(
+        for first, second in pairs:
+            if (first, second) not in collides:
+                collides[first, second] = layers_collide(
                     layers[first], positions[first], layers[second], positions[second]
-                ):
-                    colliding.update((first, second))
+                )
+            if collides[first, second]:
+                colliding.update((first, second))
         if not colliding:
             return
         for index in colliding:
             positions[index][0] += directions[index][0] * COLLISION_NUDGE
             positions[index][1] += directions[index][1] * COLLISION_NUDGE
+        for pair in pairs:
+            if pair[0] in colliding or pair[1] in colliding:
+                collides.pop(pair, None)
     raise ValueError("could not separate colliding case layers")
 
 
+def layer_frames(resample: str) -> Callable[[Path, int], Image.Image]:
+    if resample == "affine":
+        return AffineFrames(
+            NORMALIZE_NAMESPACE, NORMALIZE_PARAMS, CASE_SIZE, case_geometry
+        )
+    return ResizedImageCache().frame
+
+
+def init_worker(resample: str, output: OutputFormat, encoders: int) -> None:
+    global _renderer
+    compositor = LayerCompositor(OUTPUT_SIZE, BACKGROUND_COLOUR, CANVAS_ORIGIN)
+    _renderer = (
+        RotatedLayerCache(layer_frames(resample)),
+        compositor,
+        EncoderPool(output, compositor, encoders),
+    )
+
+
+def render_shard(page: str, jobs: list[RenderJob]) -> ShardResult:
+    return render_jobs(page, jobs, render, *_renderer)
+
+
 def selected_pages(requested_slugs: list[str]) -> list[Path]:
     pages = sorted(CONTENT_DIR.glob("*.mdx"))
     if not requested_slugs:
@@ -431,37 +690,94 @@ def main() -> int:
     if args.variants < 1:
         print("--variants must be at least 1", file=sys.stderr)
         return 2
+    if args.workers < 1 or args.encoders < 1:
+        print("--workers and --encoders must be at least 1", file=sys.stderr)
+        return 2
+    try:
+        output = OutputFormat.parse(args.format, args.quality, args.effort)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 2
     if not SOURCE_DIR.is_dir():
         print(f"Local source directory not found: {SOURCE_DIR}", file=sys.stderr)
         return 1
 
     rows = read_database()
-    args.output_dir.mkdir(parents=True, exist_ok=True)
-    cache = ResizedImageCache()
     try:
         pages = selected_pages(args.page)
     except ValueError as error:
         print(error, file=sys.stderr)
         return 2
-    failures: list[str] = []
 
+    # Plan every page first; variant plans are deterministic, so the jobs
+    # can then render in any order and on any worker.
+    planned: list[tuple[str, list[RenderJob]]] = []
+    plan_errors: dict[str, Exception] = {}
     for page in pages:
         try:
             models = page_models(page)
             candidates = eligible_cases(rows, models, page.stem)
             variants = plan_variants(candidates, models, page.stem, args.variants)
-            for number, cases in enumerate(variants, start=1):
-                filename = f"{page.stem}-{number}.png"
-                transparent_filename = f"{page.stem}-{number}-transparent.png"
-                render(
-                    cases,
-                    args.output_dir / filename,
-                    args.output_dir / transparent_filename,
-                    cache,
-                )
-                print(f"{page.stem}: {number}/{args.variants}", flush=True)
         except Exception as error:
-            failures.append(f"{page.stem}: {error}")
+            plan_errors[page.stem] = error
+            continue
+        planned.append(
+            (
+                page.stem,
+                [
+                    (
+                        number,
+                        cases,
+                        args.output_dir / f"{page.stem}-{number}.{output.name}",
+                        args.output_dir / f"{page.stem}-{number}-transparent.{output.name}",
+                        f"{page.stem}: {number}/{args.variants}",
+                    )
+                    for number, cases in enumerate(variants, start=1)
+                ],
+            )
+        )
+
+    if args.plan_only:
+        for _, jobs in planned:
+            for _, layers, _, _, line in jobs:
+                print(f"{line}: {' '.join(row['SKU'] for row, _ in layers)}")
+        for slug, error in plan_errors.items():
+            print(f"- {slug}: {error}", file=sys.stderr)
+        return 1 if plan_errors else 0
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = OgManifest(args.output_dir / MANIFEST_NAME)
+    fingerprints = master_fingerprints(
+        (master for _, jobs in planned for job in jobs for _, master in job[1]),
+        MetricsCache(),
+        args.workers,
+    )
+    # Affine frames also depend on asset_cache's own constants.
+    resample = [args.resample, *AFFINE_PARAMS] if args.resample == "affine" else args.resample
+    stale, inputs = stale_jobs(
+        planned, manifest, layout_hash(*LAYOUT, resample, output), fingerprints, args.force
+    )
+    rendered = sum(len(jobs) for _, jobs in stale)
+    unchanged = sum(len(jobs) for _, jobs in planned) - rendered
+
+    results: dict[int, ShardResult] = {}
+    try:
+        for index, result in run_shards(
+            shard_pages(stale, args.workers),
+            render_shard,
+            args.workers,
+            init_worker,
+            (args.resample, output, args.encoders),
+        ):
+            results[index] = result
+            for line in result.lines:
+                print(line, flush=True)
+            for background_path in result.outputs:
+                manifest.record(background_path, *inputs[background_path])
+    finally:
+        manifest.save()
+    errors = {**plan_errors, **first_errors(results)}
+    failures = [f"{page.stem}: {errors[page.stem]}" for page in pages if page.stem in errors]
 
     if failures:
         print("\nFailed pages:", file=sys.stderr)
@@ -469,8 +785,10 @@ def main() -> int:
             print(f"- {failure}", file=sys.stderr)
         return 1
 
-    total = len(pages) * args.variants * 2
-    print(f"\nGenerated {total} images in {args.output_dir}")
+    print(
+        f"\nGenerated {rendered * 2} images in {args.output_dir} "
+        f"({unchanged} unchanged variants skipped)"
+    )
     return 0
 
 
@@ -0,0 +1,575 @@
+"""In-process measurements of product renders, shared by the analysis scripts.
+
+Each image is decoded once; everything analyze_padding.py and
+measure_centering.py need is accumulated with NumPy in one top-to-bottom pass
+over row bands: canvas size, the content bounding box, the colour just inside
+the bbox corner (to tell white-rectangle art from pure-alpha products), and the
+alpha-weighted centroid. PNG masters are streamed (PngBands), so measuring
+holds one band in memory rather than the full decoded image, and bands of the
+blank margin around a product are neither unfiltered nor measured.
+
+The bounding box follows ImageMagick's `-trim` / `%@` rule that the scripts
+used before: content is every pixel that differs from the top-left corner
+pixel. For the usual transparent-cornered masters that is simply alpha > 0.
+
+MetricsCache persists those measurements on disk, keyed by path, size, mtime
+and content hash, so every script (analysis, recentering, OG rendering) only
+decodes masters it has never seen or that have changed since.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import sqlite3
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError as exc:  # pragma: no cover - makes failure mode obvious
+    raise SystemExit(
+        "Pillow and NumPy are required. Install them via 'pip install Pillow numpy'."
+    ) from exc
+
+CORNER_INSET = 8        # px inside the bbox corner to sample for classification
+WHITE_THRESHOLD = 250   # r,g,b all >= this (0-255) counts as "white"
+BAND_ROWS = 256         # rows decoded / measured at a time (bounds memory)
+INFLATE_CHUNK = 1 << 20 # max bytes inflated per step (IDAT can expand ~1000x)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+METRICS_CACHE_PATH = Path(__file__).resolve().parent / "image_metrics.sqlite3"
+METRICS_VERSION = 1     # bump when ImageMetrics or how it is measured changes
+
+
+@dataclass(frozen=True)
+class ImageMetrics:
+    width: int
+    height: int
+    bbox: tuple[int, int, int, int] | None     # (x, y, w, h); None = no content
+    corner: tuple[int, int, int, int] | None   # RGBA (0-255) CORNER_INSET inside bbox
+    centroid: tuple[float, float] | None       # alpha-weighted (x, y), pixels
+    alpha_bbox: tuple[int, int, int, int] | None = None  # (x, y, w, h) of alpha > 0
+    mean_colour: tuple[int, int, int] | None = None      # alpha-weighted RGB
+
+    @classmethod
+    def from_json(cls, text: str) -> "ImageMetrics":
+        data = json.loads(text)
+        return cls(**{
+            key: tuple(value) if isinstance(value, list) else value
+            for key, value in data.items()
+        })
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), separators=(",", ":"))
+
+    @property
+    def alpha_box(self) -> tuple[int, int, int, int] | None:
+        """alpha_bbox as a Pillow (left, top, right, bottom) box."""
+        if self.alpha_bbox is None:
+            return None
+        x, y, w, h = self.alpha_bbox
+        return (x, y, x + w, y + h)
+
+    @property
+    def canvas(self) -> int:
+        return max(self.width, self.height)
+
+    @property
+    def bbox_long(self) -> int:
+        return max(self.bbox[2], self.bbox[3]) if self.bbox else 0
+
+    @property
+    def white_corner(self) -> bool:
+        """Opaque near-white inside the bbox corner => white-rectangle art."""
+        if self.corner is None:
+            return False
+        r, g, b, a = self.corner
+        return a > 127 and min(r, g, b) >= WHITE_THRESHOLD
+
+    def bbox_offsets(self) -> tuple[float, float]:
+        """Bbox centre minus canvas centre, as fractions of the canvas (x, y)."""
+        x, y, w, h = self.bbox
+        return (
+            (x + w / 2 - self.width / 2) / self.width,
+            (y + h / 2 - self.height / 2) / self.height,
+        )
+
+
+def rgba_array(image: Image.Image) -> np.ndarray:
+    """(H, W, 4) uint8 view of an image, converting to RGBA only if needed."""
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    return np.asarray(image)
+
+
+class _BandMetrics:
+    """ImageMetrics accumulated from consecutive RGBA row bands, top to bottom.
+
+    Every measurement is a running min/max or an integer sum, so nothing
+    larger than one band (plus per-column totals) is ever held.
+    """
+
+    def __init__(self, width: int, height: int, inset: int = CORNER_INSET):
+        self.width, self.height, self.inset = width, height, inset
+        self.top = 0
+        self.reference: np.ndarray | None = None
+        self.alpha_rows: list[int] = []        # [first, last] row with alpha > 0
+        self.alpha_cols = np.zeros(width, dtype=bool)
+        self.content_rows: list[int] = []      # same, for the trim-rule content
+        self.content_cols = np.zeros(width, dtype=bool)
+        self.corner_row: np.ndarray | None = None
+        self.col_weight = np.zeros(width, dtype=np.uint64)
+        self.row_moment = 0
+        self.colour = [0, 0, 0]
+        self.weight = 0
+
+    @staticmethod
+    def _extend(rows: list[int], cols: np.ndarray, mask: np.ndarray, top: int) -> None:
+        hits = np.flatnonzero(mask.any(axis=1))
+        if hits.size:
+            if not rows:
+                rows.append(top + int(hits[0]))
+                rows.append(0)
+            rows[1] = top + int(hits[-1])
+            cols |= mask.any(axis=0)
+
+    def add(self, band: np.ndarray) -> None:
+        top, rows = self.top, band.shape[0]
+        if self.reference is None:
+            self.reference = band[0, 0].copy()
+        if not band.strides[0] and self._empty(band[0]):
+            # One empty row repeated (PngBands' blank margins): it adds to no
+            # box or sum, so only the corner row can come from it.
+            self._keep_corner(band, top, rows)
+            self.top += rows
+            return
+        alpha = band[..., 3]
+        alpha_mask = alpha != 0
+        self._extend(self.alpha_rows, self.alpha_cols, alpha_mask, top)
+        if self.reference[3] == 0:
+            content_mask = alpha_mask
+        else:  # opaque corner (e.g. no alpha channel): trim against that colour
+            content_mask = (band != self.reference).any(axis=2)
+        self._extend(self.content_rows, self.content_cols, content_mask, top)
+        self._keep_corner(band, top, rows)
+
+        # Alpha-weighted centroid and colour, as exact integer sums.
+        self.col_weight += alpha.sum(axis=0, dtype=np.uint64)
+        row_weight = alpha.sum(axis=1, dtype=np.uint64)
+        self.row_moment += int(row_weight @ np.arange(top, top + rows, dtype=np.uint64))
+        self.weight += int(row_weight.sum())
+        alpha = alpha.astype(np.uint32)
+        for channel in range(3):
+            self.colour[channel] += int((band[..., channel] * alpha).sum(dtype=np.uint64))
+        self.top += rows
+
+    def _empty(self, row: np.ndarray) -> bool:
+        """Whether a row has neither alpha nor trim-rule content."""
+        if row[:, 3].any():
+            return False
+        return self.reference[3] == 0 or bool((row == self.reference).all())
+
+    def _keep_corner(self, band: np.ndarray, top: int, rows: int) -> None:
+        """Keep the one row the corner sample will come from."""
+        if self.content_rows and self.corner_row is None:
+            cy = min(self.content_rows[0] + self.inset, self.height - 1)
+            if top <= cy < top + rows:
+                self.corner_row = band[cy - top].copy()
+
+    @staticmethod
+    def _box(rows: list[int], cols: np.ndarray) -> tuple[int, int, int, int] | None:
+        if not rows:
+            return None
+        hits = np.flatnonzero(cols)
+        x, y = int(hits[0]), rows[0]
+        return (x, y, int(hits[-1]) - x + 1, rows[1] - y + 1)
+
+    def result(self) -> ImageMetrics:
+        if self.top != self.height:
+            raise ValueError(f"expected {self.height} rows, decoded {self.top}")
+        alpha_bbox = self._box(self.alpha_rows, self.alpha_cols)
+        bbox = self._box(self.content_rows, self.content_cols)
+        if bbox is None:
+            return ImageMetrics(self.width, self.height, None, None, None, alpha_bbox)
+
+        cx = min(bbox[0] + self.inset, self.width - 1)
+        corner = tuple(int(v) for v in self.corner_row[cx])
+        total = float(self.col_weight.sum())
+        centroid = None
+        if total:
+            centroid = (
+                float(self.col_weight @ np.arange(self.width, dtype=np.uint64)) / total,
+                float(self.row_moment) / total,
+            )
+        mean_colour = None
+        if alpha_bbox and self.weight:
+            mean_colour = tuple(int(round(c / self.weight)) for c in self.colour)
+        return ImageMetrics(
+            self.width, self.height, bbox, corner, centroid, alpha_bbox, mean_colour
+        )
+
+
+def measure_array(pixels: np.ndarray, inset: int = CORNER_INSET) -> ImageMetrics:
+    height, width = pixels.shape[:2]
+    acc = _BandMetrics(width, height, inset)
+    for top in range(0, height, BAND_ROWS):
+        acc.add(pixels[top:top + BAND_ROWS])
+    return acc.result()
+
+
+class UnstreamablePng(ValueError):
+    """The file is not a PNG that PngBands can decode (caller falls back)."""
+
+
+class PngBands:
+    """Decode a PNG BAND_ROWS rows at a time, as RGBA arrays.
+
+    The IDAT stream is inflated incrementally; each band's filtered rows are
+    wrapped, behind the previous band's last reconstructed row, into a small
+    stand-alone PNG that Pillow unfilters and converts. Peak memory is one band
+    rather than the whole image (~85 MB for a 4608x4608 RGBA master), and the
+    result is bit-identical to a full decode. Only non-interlaced 8-bit images
+    are streamed; anything else raises UnstreamablePng before decoding starts.
+
+    Filtered bytes that are all zero, below a row that is all zero, rebuild
+    to zero under every filter type. So a band of such rows (the transparent
+    margin above and below a product) is not unfiltered at all: it comes back
+    as a read-only broadcast of one decoded blank row, which _BandMetrics
+    skips without measuring. It still has to be inflated; zlib is the only
+    way to know the margin really is blank.
+
+    Iterating can stop at any band; nothing past it is read.
+    """
+
+    _CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}   # PNG colour type -> samples
+    _KEPT = (b"PLTE", b"tRNS")                  # chunks every band needs
+
+    def __init__(self, handle: BinaryIO, rows: int = BAND_ROWS):
+        self.handle = handle
+        self.rows = rows
+        if handle.read(8) != PNG_SIGNATURE:
+            raise UnstreamablePng("not a PNG")
+        length, kind, ihdr = self._chunk()
+        if kind != b"IHDR" or length != 13:
+            raise UnstreamablePng("missing IHDR")
+        self.ihdr = ihdr
+        self.width, self.height, depth, colour, _, _, interlace = struct.unpack(
+            ">IIBBBBB", ihdr
+        )
+        if depth != 8 or colour not in self._CHANNELS or interlace:
+            raise UnstreamablePng(
+                f"depth {depth}, colour type {colour}, interlace {interlace}"
+            )
+        self.stride = self.width * self._CHANNELS[colour]
+        self.kept = b""
+        self._blank: np.ndarray | None = None  # decoded all-zero row, once needed
+        self._pending: bytes | None = None   # first IDAT payload, once found
+        while self._pending is None:
+            length, kind, data = self._chunk()
+            if kind == b"IDAT":
+                self._pending = data
+            elif kind == b"IEND":
+                raise ValueError("PNG has no image data")
+            elif kind in self._KEPT:
+                self.kept += _png_chunk(kind, data)
+
+    def _chunk(self) -> tuple[int, bytes, bytes]:
+        header = self.handle.read(8)
+        if len(header) != 8:
+            raise ValueError("PNG truncated")
+        length, kind = struct.unpack(">I4s", header)
+        data = self.handle.read(length)
+        crc = self.handle.read(4)
+        if len(data) != length or len(crc) != 4:
+            raise ValueError("PNG truncated")
+        if zlib.crc32(kind + data) != struct.unpack(">I", crc)[0]:
+            raise ValueError(f"{kind.decode('latin-1')} CRC mismatch")
+        return length, kind, data
+
+    def _idat(self) -> Iterator[bytes]:
+        data = self._pending
+        while True:
+            yield data
+            _, kind, data = self._chunk()
+            if kind != b"IDAT":
+                return
+
+    def _inflated(self) -> Iterator[bytes]:
+        inflater = zlib.decompressobj()
+        for data in self._idat():
+            while data:
+                out = inflater.decompress(data, INFLATE_CHUNK)
+                if out:
+                    yield out
+                data = inflater.unconsumed_tail
+        tail = inflater.flush()
+        if tail:
+            yield tail
+
+    def _decode(self, raw: bytes, previous: bytes | None) -> tuple[np.ndarray, bytes]:
+        rows = len(raw) // (self.stride + 1)
+        if previous is not None:
+            raw = b"\x00" + previous + raw   # filter type None: stored as-is
+            rows += 1
+        ihdr = struct.pack(">II", self.width, rows) + self.ihdr[8:]
+        png = b"".join((
+            PNG_SIGNATURE,
+            _png_chunk(b"IHDR", ihdr),
+            self.kept,
+            _png_chunk(b"IDAT", zlib.compress(raw, 0)),
+            _png_chunk(b"IEND", b""),
+        ))
+        with Image.open(io.BytesIO(png)) as image:
+            image.load()
+            last = image.crop((0, rows - 1, self.width, rows)).tobytes()
+            pixels = rgba_array(image)
+        return (pixels if previous is None else pixels[1:]), last
+
+    def _band(self, raw: bytes, previous: bytes | None) -> tuple[np.ndarray, bytes]:
+        rows = np.frombuffer(raw, np.uint8).reshape(-1, self.stride + 1)
+        blank_above = previous is None or not previous.strip(b"\x00")
+        if not blank_above or rows[:, 1:].any() or rows[:, 0].max() > 4:
+            return self._decode(raw, previous)
+        if self._blank is None:
+            self._blank = self._decode(bytes(self.stride + 1), None)[0][0]
+            self._blank.flags.writeable = False
+        blank = np.broadcast_to(self._blank, (len(rows), self.width, 4))
+        return blank, bytes(self.stride)
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        band_bytes = self.rows * (self.stride + 1)
+        buffer = bytearray()
+        previous = None
+        for out in self._inflated():
+            buffer += out
+            while len(buffer) >= band_bytes:
+                pixels, previous = self._band(bytes(buffer[:band_bytes]), previous)
+                del buffer[:band_bytes]
+                yield pixels
+        usable = len(buffer) - len(buffer) % (self.stride + 1)
+        if usable:
+            pixels, previous = self._band(bytes(buffer[:usable]), previous)
+            yield pixels
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return (struct.pack(">I", len(data)) + kind + data
+            + struct.pack(">I", zlib.crc32(kind + data)))
+
+
+def measure_png(handle: BinaryIO, inset: int = CORNER_INSET) -> ImageMetrics:
+    """Measure a PNG from an open binary file, one band in memory at a time.
+
+    Raises UnstreamablePng (before decoding anything) for PNGs PngBands cannot
+    stream; measure_path falls back to a full decode for those.
+    """
+    bands = PngBands(handle)
+    acc = _BandMetrics(bands.width, bands.height, inset)
+    for pixels in bands:
+        acc.add(pixels)
+    return acc.result()
+
+
+def measure_image(image: Image.Image, inset: int = CORNER_INSET) -> ImageMetrics:
+    return measure_array(rgba_array(image), inset)
+
+
+def measure_path(path: Path, inset: int = CORNER_INSET) -> ImageMetrics:
+    """Measure `path`, streaming it when it is a plain 8-bit PNG."""
+    with Path(path).open("rb") as handle:
+        try:
+            return measure_png(handle, inset)
+        except UnstreamablePng:
+            handle.seek(0)
+            with Image.open(handle) as image:
+                return measure_image(image, inset)
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _HashingReader:
+    """File wrapper that hashes everything read through it."""
+
+    def __init__(self, handle: BinaryIO):
+        self.handle = handle
+        self.digest = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.handle.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        for block in iter(lambda: self.read(1 << 20), b""):
+            pass
+        return self.digest.hexdigest()
+
+
+def fingerprint_and_measure(path: Path) -> tuple[str, ImageMetrics] | Exception:
+    """Hash and measure from a single read of the file (pool-friendly).
+
+    PNGs are streamed band by band, so a worker holds one band rather than
+    the whole decoded master. Errors are returned rather than raised so one
+    bad file cannot abort a ProcessPoolExecutor.map over thousands.
+    """
+    try:
+        with Path(path).open("rb") as handle:
+            reader = _HashingReader(handle)
+            try:
+                metrics = measure_png(reader)
+            except UnstreamablePng:
+                handle.seek(0)
+                reader = _HashingReader(handle)
+                with Image.open(io.BytesIO(reader.read())) as image:
+                    metrics = measure_image(image)
+            return reader.hexdigest(), metrics
+    except Exception as exc:  # noqa: BLE001 - reported by the caller
+        return exc
+
+
+class MetricsCache:
+    """On-disk ImageMetrics, filled lazily and shared by every script.
+
+    An entry is reused while the file's size and mtime are unchanged; if they
+    differ, the content hash decides (a touched-but-identical file is still a
+    hit). Only the default CORNER_INSET measurement is cached.
+    """
+
+    def __init__(self, path: Path = METRICS_CACHE_PATH):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS metrics (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                metrics TEXT NOT NULL
+            )
+            """
+        )
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _entry(self, path: Path) -> tuple[str, str] | None:
+        """(sha256, metrics JSON) if the cached entry still matches the file."""
+        key = str(Path(path).resolve())
+        row = self.db.execute(
+            "SELECT size, mtime_ns, sha256, metrics FROM metrics "
+            "WHERE path = ? AND version = ?",
+            (key, METRICS_VERSION),
+        ).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, sha256, text = row
+        stat = Path(path).stat()
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            if stat.st_size != size or file_sha256(Path(path)) != sha256:
+                return None
+            with self.db:
+                self.db.execute(
+                    "UPDATE metrics SET mtime_ns = ? WHERE path = ?",
+                    (stat.st_mtime_ns, key),
+                )
+        return sha256, text
+
+    def lookup(self, path: Path) -> ImageMetrics | None:
+        entry = self._entry(path)
+        return None if entry is None else ImageMetrics.from_json(entry[1])
+
+    def fingerprint(self, path: Path) -> str | None:
+        """Content sha256 of path if it is cached and unchanged, else None."""
+        entry = self._entry(path)
+        return None if entry is None else entry[0]
+
+    def store(self, path: Path, sha256: str, metrics: ImageMetrics) -> None:
+        stat = Path(path).stat()
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO metrics "
+                "(path, size, mtime_ns, sha256, version, metrics) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns,
+                 sha256, METRICS_VERSION, metrics.to_json()),
+            )
+
+    def measure(self, path: Path) -> ImageMetrics:
+        cached = self.lookup(path)
+        if cached is not None:
+            return cached
+        result = fingerprint_and_measure(Path(path))
+        if isinstance(result, Exception):
+            raise result
+        sha256, metrics = result
+        self.store(path, sha256, metrics)
+        return metrics
+
+    def open_rgba(self, path: Path) -> tuple[Image.Image, ImageMetrics]:
+        """Decode path as RGBA and return it with its metrics.
+
+        For callers that need the pixels anyway: on a miss the metrics are
+        measured from this same decode instead of decoding the file twice.
+        """
+        cached = self.lookup(path)
+        if cached is not None:
+            with Image.open(path) as image:
+                return image.convert("RGBA"), cached
+        data = Path(path).read_bytes()
+        with Image.open(io.BytesIO(data)) as image:
+            rgba = image.convert("RGBA")
+        metrics = measure_image(rgba)
+        self.store(path, hashlib.sha256(data).hexdigest(), metrics)
+        return rgba, metrics
+
+    def measure_many(
+        self, paths: Iterable[Path], workers: int = 1
+    ) -> list[ImageMetrics | Exception]:
+        """Metrics for every path, in order; only misses are decoded.
+
+        Misses are measured on a process pool; this process does all cache
+        reads and writes. Unreadable files come back as their exception.
+        """
+        paths = list(paths)
+        results: list[ImageMetrics | Exception | None] = []
+        misses: list[int] = []
+        for index, path in enumerate(paths):
+            try:
+                cached = self.lookup(path)
+            except OSError as exc:
+                cached = exc
+            results.append(cached)
+            if cached is None:
+                misses.append(index)
+
+        if misses:
+            miss_paths = [paths[index] for index in misses]
+            if workers > 1 and len(misses) > 1:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    measured = list(pool.map(fingerprint_and_measure, miss_paths))
+            else:
+                measured = [fingerprint_and_measure(path) for path in miss_paths]
+            for index, outcome in zip(misses, measured):
+                if isinstance(outcome, Exception):
+                    results[index] = outcome
+                    continue
+                sha256, metrics = outcome
+                self.store(paths[index], sha256, metrics)
+                results[index] = metrics
+        return results  # type: ignore[return-value]
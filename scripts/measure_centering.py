@@ -9,23 +9,32 @@ centre as a fraction of the canvas.
   off_x_frac > 0  => content sits RIGHT of centre
 
 Only writes a report CSV. Feed the flagged rows to 7_recenter_devices.py.
+
+With --incremental the existing report is merged instead of rewritten: rows
+whose file is unchanged since the last run are kept, new or changed files are
+measured, and rows for files that no longer exist are dropped. Each row
+carries its file's content sha256, so a report written by this script
+validates itself in any checkout; the hash comes from MetricsCache while its
+entry is current and is only recomputed (a read, not a decode) otherwise.
+A report without the sha256 column (written before it existed) vouches for
+nothing: the first --incremental run over it measures every file, as a full
+run would, and writes the column.
 """
 
 import argparse
 import csv
-import subprocess
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass, asdict
+import os
+from collections import defaultdict
+from dataclasses import dataclass, asdict, fields
 from pathlib import Path
 
+from image_analysis import ImageMetrics, MetricsCache, file_sha256
+
 REPO = Path(__file__).resolve().parent.parent
 DEVICES_CSV = REPO / "database" / "devices.csv"
 DEFAULT_SOURCE = Path("/Volumes/Storage/Images/1_final-sources")
 DEFAULT_REPORT = Path(__file__).resolve().parent / "centering_report.csv"
 
-WHITE_THRESHOLD = 250   # r,g,b all >= this counts as opaque white (no alpha gap)
-CORNER_INSET = 8        # px inside the bbox corner to sample for classification
-
 
 @dataclass
 class Measure:
@@ -42,55 +51,32 @@ class Measure:
     off_max_frac: float = 0.0
     kind: str = ""          # alpha | white | empty | error
     note: str = ""
+    sha256: str = ""        # content hash of the measured file
 
 
-def _im(args):
-    return subprocess.run(
-        ["magick", *args], capture_output=True, text=True, timeout=120
-    ).stdout.strip()
-
-
-def _parse_pixel(px):
-    inside = px[px.index("(") + 1:px.index(")")]
-    parts = [p.strip() for p in inside.split(",")]
-    r, g, b = (float(parts[i]) for i in range(3))
-    a = float(parts[3]) if len(parts) > 3 else 1.0
-    return r, g, b, a
-
-
-def measure(path: Path) -> Measure:
+def measure(path: Path, metrics: ImageMetrics | Exception) -> Measure:
     m = Measure(code=path.stem, file=path.name)
-    try:
-        w, h = (int(v) for v in _im([str(path), "-format", "%w %h", "info:"]).split())
-        m.canvas_w, m.canvas_h = w, h
-
-        trim = _im([str(path), "-format", "%@", "info:"])
-        bw, rest = trim.split("x", 1)
-        bh, xoff, yoff = rest.replace("+", " ").split()
-        bw, bh, x, y = int(bw), int(bh), int(xoff), int(yoff)
-        m.bbox_w, m.bbox_h, m.x, m.y = bw, bh, x, y
-
-        if bw <= 0 or bh <= 0:
-            m.kind = "empty"
-            m.note = "no content found"
-            return m
-
-        # classify the corner just inside the bbox
-        px = _im([str(path), "-format",
-                  f"%[pixel:p{{{x + CORNER_INSET},{y + CORNER_INSET}}}]", "info:"])
-        r, g, b, a = _parse_pixel(px)
-        m.kind = "white" if (a > 0.5 and min(r, g, b) >= WHITE_THRESHOLD) else "alpha"
-
-        cx, cy = x + bw / 2, y + bh / 2
-        m.off_x_frac = round((cx - w / 2) / w, 4)
-        m.off_y_frac = round((cy - h / 2) / h, 4)
-        m.off_max_frac = round(max(abs(m.off_x_frac), abs(m.off_y_frac)), 4)
-        return m
-    except Exception as exc:  # noqa: BLE001
+    if isinstance(metrics, Exception):
         m.kind = "error"
-        m.note = str(exc)[:100]
+        m.note = str(metrics)[:100]
         return m
 
+    m.canvas_w, m.canvas_h = metrics.width, metrics.height
+    if metrics.bbox is None:
+        m.kind = "empty"
+        m.note = "no content found"
+        return m
+    m.x, m.y, m.bbox_w, m.bbox_h = metrics.bbox
+
+    # classify the corner just inside the bbox
+    m.kind = "white" if metrics.white_corner else "alpha"
+
+    off_x, off_y = metrics.bbox_offsets()
+    m.off_x_frac = round(off_x, 4)
+    m.off_y_frac = round(off_y, 4)
+    m.off_max_frac = round(max(abs(m.off_x_frac), abs(m.off_y_frac)), 4)
+    return m
+
 
 def device_files(source: Path):
     keys = []
@@ -102,34 +88,109 @@ def device_files(source: Path):
                 seen.add(k)
                 keys.append(k)
 
+    # One directory scan instead of an exists() + glob() per key.
+    names = set()
+    alternates = defaultdict(list)   # "<key>" -> ["<key>_AV1.png", ...]
+    with os.scandir(source) as it:
+        for entry in it:
+            name = entry.name
+            if not name.endswith(".png"):
+                continue
+            names.add(name)
+            at = name.find("_AV")
+            while at != -1:
+                alternates[name[:at]].append(name)
+                at = name.find("_AV", at + 1)
+
     files = []
     fseen = set()
     for k in keys:
-        for p in [source / f"{k}.png", *sorted(source.glob(f"{k}_AV*.png"))]:
-            if p.exists() and p not in fseen:
-                fseen.add(p)
-                files.append(p)
+        base = f"{k}.png"
+        candidates = ([base] if base in names else []) + sorted(alternates.get(k, ()))
+        for name in candidates:
+            if name not in fseen:
+                fseen.add(name)
+                files.append(source / name)
     return keys, files
 
 
+def content_hash(path: Path, cache: MetricsCache) -> str | None:
+    """sha256 of path, from the metrics cache while its entry is current."""
+    try:
+        return cache.fingerprint(path) or file_sha256(path)
+    except OSError:
+        return None   # vanished since the scan; measure() reports it as an error
+
+
+def read_report(report: Path) -> dict[str, Measure]:
+    """Existing report rows keyed by file name.
+
+    Empty if there is no report, or if it predates the sha256 column and so
+    cannot tell which rows are still current.
+    """
+    if not report.exists():
+        return {}
+    types = {f.name: f.type for f in fields(Measure)}
+    rows = {}
+    with report.open(newline="") as f:
+        reader = csv.DictReader(f)
+        if "sha256" not in (reader.fieldnames or []):
+            print(f"{report.name} has no sha256 column; measuring every file")
+            return {}
+        for row in reader:
+            m = Measure(**{
+                key: types[key](value or types[key]())
+                for key, value in row.items() if key in types
+            })
+            rows[m.file] = m
+    return rows
+
+
 def main():
     ap = argparse.ArgumentParser(description=__doc__)
     ap.add_argument("--source", type=Path, default=DEFAULT_SOURCE)
     ap.add_argument("--report", type=Path, default=DEFAULT_REPORT)
     ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--incremental", action="store_true",
+                    help="merge into the existing report, measuring only new or "
+                         "changed files and dropping rows for deleted ones")
     args = ap.parse_args()
 
     keys, files = device_files(args.source)
     print(f"{len(keys)} unique device image_keys -> {len(files)} PNGs in {args.source}")
 
-    with ProcessPoolExecutor(max_workers=args.workers) as pool:
-        results = list(pool.map(measure, files))
-
+    cache = MetricsCache()
+    previous = read_report(args.report) if args.incremental else {}
+    kept = {
+        path.name: previous[path.name]
+        for path in files
+        if path.name in previous
+        and previous[path.name].kind != "error"
+        and previous[path.name].sha256
+        and content_hash(path, cache) == previous[path.name].sha256
+    }
+    stale = [path for path in files if path.name not in kept]
+    if args.incremental:
+        dropped = len(previous.keys() - {path.name for path in files})
+        print(f"incremental: {len(kept)} unchanged, {len(stale)} to measure, "
+              f"{dropped} dropped")
+
+    # Only files new or changed since the last run are decoded.
+    measured = cache.measure_many(stale, args.workers)
+    fresh = {}
+    for path, metrics in zip(stale, measured):
+        fresh[path.name] = measure(path, metrics)
+        if not isinstance(metrics, Exception):
+            fresh[path.name].sha256 = cache.fingerprint(path) or ""
+    cache.close()
+
+    # Device-file order, then a stable sort: a merge matches a full run exactly.
+    results = [kept.get(path.name) or fresh[path.name] for path in files]
     results.sort(key=lambda m: m.off_max_frac, reverse=True)
 
-    fields = list(asdict(results[0]).keys()) if results else []
+    columns = [f.name for f in fields(Measure)]
     with args.report.open("w", newline="") as f:
-        wr = csv.DictWriter(f, fieldnames=fields)
+        wr = csv.DictWriter(f, fieldnames=columns)
         wr.writeheader()
         for m in results:
             wr.writerow(asdict(m))
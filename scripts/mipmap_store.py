@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""Mipmap pyramid of every master, shared by the pipeline stages.
+
+Masters are 4608 px squares, but 3_compress.sh only needs 512 px previews
+and 2048 px sources. A stage therefore asks for "the smallest level >= N px"
+of MIPMAP_LEVELS (long edge) instead of decoding the master, and only the
+levels some stage asks for are ever built; a build pass decodes each master
+once for all of them.
+
+Every level is resampled straight from the master (never from the level
+above, so errors do not compound), in floating point: colour is
+premultiplied, filtered and divided back out at full precision, so faint
+edge pixels keep their colour. The premultiplication is internal to the
+filter: levels are stored, loaded and exported as straight-alpha RGBA, in
+PNG files (an export is a plain copy), with the index in SQLite. They are
+keyed by the master's content hash (from MetricsCache), so a replaced master
+simply misses and is rebuilt. Requests above the largest level the master
+has get the decoded master itself.
+
+    python3 mipmap_store.py build [--workers N] [--edge N]... SOURCE...
+    python3 mipmap_store.py export [--workers N] EDGE DIRECTORY SOURCE...
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from image_analysis import MetricsCache, file_sha256, measure_image
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError as exc:  # pragma: no cover - makes failure mode obvious
+    raise SystemExit(
+        "Pillow and NumPy are required. Install them via 'pip install Pillow numpy'."
+    ) from exc
+
+MIPMAP_DIR = Path(__file__).resolve().parent / "mipmap_cache"
+MIPMAP_VERSION = 3  # bump when the stored layout or resampling changes
+MIPMAP_LEVELS = (2048, 1024, 512, 256)  # long edge in px, largest first
+DEFAULT_WORKERS = 8
+
+
+def save_array(blob: Path, pixels: np.ndarray) -> None:
+    """Write pixels to blob as .npy, atomically."""
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    tmp = blob.with_name(f"{blob.stem}.{os.getpid()}.tmp")
+    with tmp.open("wb") as handle:
+        np.save(handle, pixels)
+    os.replace(tmp, blob)
+
+
+def store_blob(blob: Path, layer: Image.Image) -> tuple[int, int, int, int]:
+    """Write the non-transparent rectangle of a premultiplied layer to blob
+    (atomically) and return that rectangle."""
+    box = layer.getbbox() or (0, 0, 0, 0)  # premultiplied: 0 wherever alpha is
+    pixels = np.asarray(layer.crop(box)) if box[2] > box[0] else np.zeros((0, 0, 4), np.uint8)
+    save_array(blob, pixels)
+    return box
+
+
+def load_blob(blob: Path, size: tuple[int, int], origin: tuple[int, int]) -> Image.Image | None:
+    """The layer store_blob wrote, back on its full transparent `size`, or
+    None if the blob is lost or truncated."""
+    try:
+        pixels = np.load(blob, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    layer = Image.new("RGBa", size, (0, 0, 0, 0))
+    if pixels.size:
+        height, width = pixels.shape[:2]
+        content = Image.frombuffer(
+            "RGBa", (width, height), np.ascontiguousarray(pixels), "raw", "RGBa", 0, 1
+        )
+        layer.paste(content, origin)
+    return layer
+
+
+def level_size(size: tuple[int, int], edge: int) -> tuple[int, int]:
+    """A master of `size` scaled to `edge` px on its long side."""
+    scale = edge / max(size)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def level_edges(size: tuple[int, int]) -> tuple[int, ...]:
+    """The MIPMAP_LEVELS a master of `size` has: those below its long edge."""
+    return tuple(edge for edge in MIPMAP_LEVELS if edge < max(size))
+
+
+def choose_edge(size: tuple[int, int], edge: int | None) -> int | None:
+    """The smallest level edge >= `edge` for a master of `size`; None means
+    the master itself (no level is big enough, or `edge` is None)."""
+    if edge is None:
+        return None
+    fitting = [level for level in level_edges(size) if level >= edge]
+    return min(fitting) if fitting else None
+
+
+def resample(rgba: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """LANCZOS-resize straight-alpha RGBA to `size` in floating point.
+
+    Pillow's own RGBA resize rounds the premultiplied colour to 8 bits before
+    filtering and again after, which shifts the colour of low-alpha pixels;
+    here each band is filtered as a float image and only the final straight
+    colour is rounded.
+    """
+    pixels = np.asarray(rgba)
+    alpha = pixels[..., 3].astype(np.float32)
+    coverage = np.asarray(Image.fromarray(alpha).resize(size, Image.Resampling.LANCZOS))
+    visible = coverage >= 0.5  # rounds to alpha >= 1
+    output = np.zeros((size[1], size[0], 4), np.uint8)
+    output[..., 3] = np.clip(np.rint(coverage), 0, 255)
+    for band in range(3):
+        premultiplied = pixels[..., band] * alpha
+        filtered = np.asarray(
+            Image.fromarray(premultiplied).resize(size, Image.Resampling.LANCZOS)
+        )
+        colour = np.divide(filtered, coverage, out=np.zeros_like(filtered), where=visible)
+        output[..., band] = np.clip(np.rint(colour), 0, 255)
+    return Image.fromarray(output)
+
+
+@dataclass
+class MipmapLevel:
+    """One pyramid level (or the master itself, at scale 1)."""
+
+    image: Image.Image  # straight RGBA
+    scale: float  # level px per master px
+
+    def close(self) -> None:
+        self.image.close()
+
+
+def build_levels(
+    master: Image.Image, edges: tuple[int, ...] | None = None
+) -> list[tuple[int, Image.Image]]:
+    """(edge, straight RGBA level) for each of `edges` (default: every level
+    of a straight RGBA master), in that order; every one is resampled from
+    the master itself."""
+    if edges is None:
+        edges = level_edges(master.size)
+    return [(edge, resample(master, level_size(master.size, edge))) for edge in edges]
+
+
+def mipmap_key(fingerprint: str, edge: int) -> str:
+    payload = json.dumps(
+        [MIPMAP_VERSION, MIPMAP_LEVELS, fingerprint, edge], separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class MipmapStore:
+    """Pyramid levels on disk, built on first use of each master."""
+
+    def __init__(
+        self,
+        directory: Path = MIPMAP_DIR,
+        metrics: MetricsCache | None = None,
+    ) -> None:
+        self.directory = directory
+        directory.mkdir(parents=True, exist_ok=True)
+        self.metrics = metrics or MetricsCache()
+        self.db = sqlite3.connect(directory / "index.sqlite3", timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mipmaps (
+                key TEXT PRIMARY KEY,
+                master TEXT NOT NULL,
+                edge INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL
+            )
+            """
+        )
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _blob(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.png"
+
+    def _load(self, key: str) -> Image.Image | None:
+        """The stored level, or None if it is not stored or its blob is lost
+        or truncated."""
+        row = self.db.execute(
+            "SELECT width, height FROM mipmaps WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            with Image.open(self._blob(key)) as image:
+                image.load()
+        except (OSError, SyntaxError):  # Pillow reports bad PNG chunks as SyntaxError
+            return None
+        if image.mode != "RGBA" or image.size != tuple(row):
+            image.close()
+            return None
+        return image
+
+    def _stored(self, key: str) -> bool:
+        row = self.db.execute("SELECT 1 FROM mipmaps WHERE key = ?", (key,)).fetchone()
+        return row is not None and self._blob(key).is_file()
+
+    def _fingerprint(self, path: Path, rgba: Image.Image | None) -> tuple[str, Image.Image | None]:
+        """The master's content hash, and its decoded RGBA if that took a
+        decode (or the caller already had it)."""
+        fingerprint = self.metrics.fingerprint(path)
+        if fingerprint is not None:
+            return fingerprint, rgba
+        if rgba is None:  # unmeasured or changed: hashes it while decoding
+            rgba, _ = self.metrics.open_rgba(path)
+        else:
+            self.metrics.store(path, file_sha256(Path(path)), measure_image(rgba))
+        return self.metrics.fingerprint(path), rgba
+
+    def build(
+        self,
+        path: Path,
+        edges: tuple[int, ...] | None = None,
+        rgba: Image.Image | None = None,
+    ) -> dict[int, Path]:
+        """Make sure the smallest level >= each of `edges` px (default: every
+        level) of the master at path is stored, decoding it at most once;
+        returns {level edge: its PNG}. Edges the master is too small for
+        have no level and are left out. `rgba` (straight RGBA) saves the
+        decode when the caller already has the master's pixels."""
+        caller_rgba = rgba
+        fingerprint, rgba = self._fingerprint(path, rgba)
+        size = rgba.size if rgba is not None else self._size(path)
+        if edges is None:
+            wanted = level_edges(size)
+        else:
+            chosen = {choose_edge(size, edge) for edge in edges} - {None}
+            wanted = tuple(sorted(chosen, reverse=True))
+        missing = tuple(
+            edge for edge in wanted if not self._stored(mipmap_key(fingerprint, edge))
+        )
+        if missing:
+            if rgba is None:
+                rgba, _ = self.metrics.open_rgba(path)
+            for level in self._store(path, fingerprint, rgba, missing).values():
+                level.close()
+        if rgba is not None and rgba is not caller_rgba:
+            rgba.close()
+        return {edge: self._blob(mipmap_key(fingerprint, edge)) for edge in wanted}
+
+    def _size(self, path: Path) -> tuple[int, int]:
+        metrics = self.metrics.measure(path)
+        return metrics.width, metrics.height
+
+    def _store(
+        self, path: Path, fingerprint: str, master: Image.Image, edges: tuple[int, ...]
+    ) -> dict[int, Image.Image]:
+        levels = dict(build_levels(master, edges))
+        for edge, level in levels.items():
+            key = mipmap_key(fingerprint, edge)
+            blob = self._blob(key)
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp = blob.with_name(f"{blob.stem}.{os.getpid()}.tmp")
+            level.save(tmp, format="PNG")
+            os.replace(tmp, blob)
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO mipmaps (key, master, edge, width, height) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, str(path), edge, *level.size),
+                )
+        return levels
+
+    def level(
+        self, path: Path, edge: int | None, rgba: Image.Image | None = None
+    ) -> MipmapLevel:
+        """The smallest level of the master at path with a long edge of at
+        least `edge` px, building just that level on a miss; the master itself
+        (scale 1) when no level is that big or `edge` is None. `rgba` is the
+        master's straight RGBA pixels, if the caller already decoded them."""
+        caller_rgba = rgba
+        fingerprint, rgba = self._fingerprint(path, rgba)
+        size = rgba.size if rgba is not None else self._size(path)
+        chosen = choose_edge(size, edge)
+        if chosen is None:
+            if rgba is None:
+                rgba, _ = self.metrics.open_rgba(path)
+            return MipmapLevel(rgba.copy() if rgba is caller_rgba else rgba, 1.0)
+        scale = chosen / max(size)
+        cached = self._load(mipmap_key(fingerprint, chosen))
+        if cached is not None:
+            if rgba is not None and rgba is not caller_rgba:
+                rgba.close()
+            return MipmapLevel(cached, scale)
+
+        if rgba is None:
+            rgba, _ = self.metrics.open_rgba(path)
+        levels = self._store(path, fingerprint, rgba, (chosen,))
+        if rgba is not caller_rgba:
+            rgba.close()
+        return MipmapLevel(levels[chosen], scale)
+
+
+def export_level(store: MipmapStore, path: Path, edge: int, output: Path) -> None:
+    """Copy the smallest level >= edge, a straight-alpha PNG, to output (or
+    the master when none is that big), atomically; builds only that level."""
+    stored = store.build(path, (edge,))
+    tmp = output.with_name(f".{output.name}.{os.getpid()}.tmp")
+    shutil.copyfile(next(iter(stored.values()), path), tmp)
+    os.replace(tmp, output)
+
+
+def build_file(job: tuple[Path, tuple[int, ...] | None]) -> dict[int, Path] | Exception:
+    """Build one master's levels; runs in a worker process, so errors are
+    returned rather than raised."""
+    path, edges = job
+    store = MipmapStore()
+    try:
+        return store.build(path, edges)
+    except Exception as exc:  # noqa: BLE001 - reported by the caller
+        return exc
+    finally:
+        store.close()
+
+
+def export_file(job: tuple[Path, int, Path]) -> None | Exception:
+    """Export one master's level to DIRECTORY/<stem>.png; runs in a worker
+    process, so errors are returned rather than raised."""
+    path, edge, directory = job
+    store = MipmapStore()
+    try:
+        export_level(store, path, edge, directory / f"{path.stem}.png")
+        return None
+    except Exception as exc:  # noqa: BLE001 - reported by the caller
+        return exc
+    finally:
+        store.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build the pyramids of masters")
+    build.add_argument("sources", nargs="+", type=Path, help="master PNGs or folders of them")
+    build.add_argument(
+        "--edge", type=int, action="append", dest="edges",
+        help="only build the smallest level >= EDGE px (repeatable; default every level)",
+    )
+    build.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    export = commands.add_parser(
+        "export", help="write each master's smallest level >= EDGE as DIRECTORY/<stem>.png"
+    )
+    export.add_argument("edge", type=int)
+    export.add_argument("directory", type=Path)
+    export.add_argument("sources", nargs="*", type=Path, help="master PNGs (none is a no-op)")
+    export.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    if args.command == "export":
+        args.directory.mkdir(parents=True, exist_ok=True)
+        paths = args.sources
+        jobs = [(path, args.edge, args.directory) for path in paths]
+        worker = export_file
+    else:
+        paths = []
+        for source in args.sources:
+            paths.extend(sorted(source.glob("*.png")) if source.is_dir() else [source])
+        edges = tuple(args.edges) if args.edges else None
+        jobs = [(path, edges) for path in paths]
+        worker = build_file
+    if args.workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(worker, jobs))
+    else:
+        results = [worker(job) for job in jobs]
+    failures = 0
+    for path, result in zip(paths, results):
+        if isinstance(result, Exception):
+            failures += 1
+            print(f"{path.name}: {result}", file=sys.stderr)
+    if args.command == "export":
+        print(f"{len(paths) - failures} levels >= {args.edge} px exported to {args.directory}")
+    else:
+        print(f"{len(paths) - failures} masters' levels up to date in {MIPMAP_DIR}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
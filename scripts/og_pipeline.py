@@ -0,0 +1,399 @@
+"""Process-parallel rendering shared by the OG generators.
+
+Every variant plan is deterministic (variant_seed), so both generators plan
+all of their (page, variant) jobs up front and only then render. Rendering
+is sharded by page: a page's variants stay together in contiguous chunks, so
+the worker that renders them keeps reusing the same masters' rotated layers
+from its RotatedLayerCache. Pages are only split further when there are
+fewer pages than workers. Each job writes its own files and no job depends
+on another. Like a serial run, a page stops at its first failure: results
+come back per page in shard order, and a failed shard's later siblings are
+cancelled, or dropped unreported and unrecorded if they already ran (their
+files may be left behind, but the manifest does not know them, so the next
+run renders them again).
+
+Inside each process, finished composites go to a bounded EncoderPool of
+threads that writes the web-ready format directly (PNG, WebP or AVIF with
+the chosen quality and effort), so the next variant renders while the last
+one encodes.
+
+Reruns are incremental: og_manifest.csv in the output folder records, per
+variant, the variant_seed inputs (page, variant), the SKUs chosen, each
+master's content hash in layer order and a hash of the generator's layout
+constants. A variant whose record still matches, and whose two files still
+exist, is not rendered again, so a catalogue edit only re-renders the
+variants whose selection or masters actually changed.
+"""
+
+from __future__ import annotations
+
+import csv
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, TypeVar
+
+from PIL import features
+
+from asset_cache import Composite, LayerCompositor, RotatedLayerCache
+from image_analysis import MetricsCache, file_sha256
+
+DEFAULT_WORKERS = 8
+DEFAULT_ENCODERS = 2  # encoder threads per render process
+# format -> (default quality, default effort, max effort). Effort is PNG's
+# compress_level, WebP's method and AVIF's 10 - speed: higher is smaller
+# and slower. PNG ignores quality.
+OUTPUT_FORMATS = {
+    "png": (None, 7, 9),
+    "webp": (85, 4, 6),
+    "avif": (60, 4, 10),
+}
+# format -> the PIL.features entry its encoder needs (PNG is always built in).
+OUTPUT_FEATURES = {"webp": "webp", "avif": "avif"}
+MANIFEST_NAME = "og_manifest.csv"  # kept in the output folder
+MANIFEST_HEADER = ["output", "transparent", "page", "variant", "skus", "masters", "layout"]
+
+Job = TypeVar("Job")
+# (variant number, (row, master) per layer, background path, transparent
+# path, progress line)
+RenderJob = tuple[int, list[tuple[dict[str, str], Path]], Path, Path, str]
+
+
+@dataclass
+class ShardResult:
+    """Progress lines of the jobs a shard rendered, and the error that
+    stopped it (the rest of that shard is skipped, as in a serial run)."""
+
+    page: str
+    lines: list[str] = field(default_factory=list)
+    outputs: list[Path] = field(default_factory=list)  # rendered, in job order
+    error: Exception | None = None
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """How rendered variants are written; `name` is also the file suffix."""
+
+    name: str
+    quality: int | None
+    effort: int
+
+    @classmethod
+    def parse(cls, name: str, quality: int | None, effort: int | None) -> "OutputFormat":
+        default_quality, default_effort, max_effort = OUTPUT_FORMATS[name]
+        feature = OUTPUT_FEATURES.get(name)
+        if feature is not None and not features.check(feature):
+            # Checked once up front: otherwise every shard fails at save time.
+            raise ValueError(
+                f"--format {name}: this Pillow build has no {name.upper()} encoder"
+            )
+        effort = default_effort if effort is None else effort
+        if not 0 <= effort <= max_effort:
+            raise ValueError(f"--effort for {name} must be 0-{max_effort}")
+        if default_quality is None:
+            return cls(name, None, effort)
+        quality = default_quality if quality is None else quality
+        if not 0 <= quality <= 100:
+            raise ValueError("--quality must be 0-100")
+        return cls(name, quality, effort)
+
+    def save_options(self) -> dict[str, object]:
+        if self.name == "png":
+            return {"format": "PNG", "compress_level": self.effort}
+        if self.name == "webp":
+            return {"format": "WEBP", "quality": self.quality, "method": self.effort}
+        return {"format": "AVIF", "quality": self.quality, "speed": 10 - self.effort}
+
+
+class EncoderPool:
+    """Bounded background stage that saves finished composites.
+
+    Pillow's encoders release the GIL, so `threads` encodes overlap the next
+    render. submit() blocks once twice that many are in flight, which also
+    bounds how many pooled buffers the compositor hands out. Each composite
+    goes back to the compositor once both of its files are written.
+    """
+
+    def __init__(self, output: OutputFormat, compositor: LayerCompositor, threads: int):
+        self.options = output.save_options()
+        self.compositor = compositor
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(threads * 2)
+
+    def submit(
+        self, composite: Composite, background_path: Path, transparent_path: Path
+    ) -> Future:
+        self.slots.acquire()
+        try:
+            return self.executor.submit(
+                self._encode, composite, background_path, transparent_path
+            )
+        except BaseException:
+            self.compositor.release(composite)
+            self.slots.release()
+            raise
+
+    def _encode(
+        self, composite: Composite, background_path: Path, transparent_path: Path
+    ) -> None:
+        try:
+            composite.transparent.save(transparent_path, **self.options)
+            background = composite.background.convert("RGB")
+            try:
+                background.save(background_path, **self.options)
+            finally:
+                background.close()
+        finally:
+            self.compositor.release(composite)
+            self.slots.release()
+
+
+def render_jobs(
+    page: str,
+    jobs: list[RenderJob],
+    render: Callable[[list[tuple[dict[str, str], Path]], RotatedLayerCache, LayerCompositor], Composite],
+    cache: RotatedLayerCache,
+    compositor: LayerCompositor,
+    encoder: EncoderPool,
+) -> ShardResult:
+    """Render a shard's jobs in order, encoding each in the background.
+
+    As in a serial run, the first failure (render or encode, in job order)
+    ends the shard; only the jobs before it count as done.
+    """
+    result = ShardResult(page)
+    encoding: list[tuple[Path, str, Future]] = []
+    for _, layers, background_path, transparent_path, line in jobs:
+        try:
+            composite = render(layers, cache, compositor)
+        except Exception as error:
+            result.error = error
+            break
+        encoding.append(
+            (background_path, line, encoder.submit(composite, background_path, transparent_path))
+        )
+    for background_path, line, future in encoding:
+        error = future.exception()
+        if error is not None:
+            result.error = error
+            break
+        result.lines.append(line)
+        result.outputs.append(background_path)
+    for _, _, future in encoding:
+        future.exception()  # let every started encode finish before returning
+    return result
+
+
+def shard_pages(
+    pages: list[tuple[str, list[Job]]], workers: int
+) -> list[tuple[str, list[Job]]]:
+    """Split each page's jobs into contiguous chunks, about `workers` shards
+    overall when pages are scarce and exactly one per page otherwise."""
+    chunks = max(1, -(-workers // max(1, len(pages))))
+    shards: list[tuple[str, list[Job]]] = []
+    for page, jobs in pages:
+        size = max(1, -(-len(jobs) // chunks))
+        shards.extend((page, jobs[start:start + size]) for start in range(0, len(jobs), size))
+    return shards
+
+
+def run_shards(
+    shards: list[tuple[str, list[Job]]],
+    render: Callable[[str, list[Job]], ShardResult],
+    workers: int,
+    initializer: Callable[..., None],
+    initargs: tuple = (),
+) -> Iterator[tuple[int, ShardResult]]:
+    """Render shards in-process (workers <= 1) or on a process pool, yielding
+    (shard index, result) as they finish, each page's in shard order.
+
+    A page stops at its first failing shard, as a serial run would: nothing
+    after it is yielded, whether it was skipped, cancelled or had already
+    finished. `initializer(*initargs)` builds the per-process caches `render`
+    uses; `render` must be a module-level function so it can be sent to the
+    workers.
+    """
+    failed: set[str] = set()
+    if workers <= 1 or len(shards) <= 1:
+        initializer(*initargs)
+        for index, (page, jobs) in enumerate(shards):
+            if page in failed:
+                continue
+            result = render(page, jobs)
+            if result.error is not None:
+                failed.add(page)
+            yield index, result
+        return
+
+    waiting: dict[str, list[int]] = {}  # per page, shard indices not yet yielded
+    for index, (page, _) in enumerate(shards):
+        waiting.setdefault(page, []).append(index)
+    finished: dict[int, ShardResult] = {}
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(shards)),
+        initializer=initializer,
+        initargs=initargs,
+    ) as pool:
+        futures = {
+            pool.submit(render, page, jobs): index
+            for index, (page, jobs) in enumerate(shards)
+        }
+        by_index = {index: future for future, index in futures.items()}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            index = futures[future]
+            page = shards[index][0]
+            try:
+                finished[index] = future.result()
+            except Exception as error:  # noqa: BLE001 - e.g. a worker died
+                finished[index] = ShardResult(page, error=error)
+            pending = waiting[page]
+            while pending and pending[0] in finished and page not in failed:
+                ready = pending.pop(0)
+                result = finished.pop(ready)
+                if result.error is not None:
+                    failed.add(page)
+                    for later in pending:
+                        by_index[later].cancel()
+                yield ready, result
+
+
+def first_errors(
+    results: dict[int, ShardResult],
+) -> dict[str, Exception]:
+    """Each page's error from its earliest failing shard, as a serial run
+    would have stopped at it (run_shards yields no shard after it)."""
+    errors: dict[str, Exception] = {}
+    for index in sorted(results):
+        result = results[index]
+        if result.error is not None:
+            errors.setdefault(result.page, result.error)
+    return errors
+
+
+def layout_hash(*constants: object) -> str:
+    """Digest of everything besides the masters that shapes a render."""
+    payload = json.dumps(constants, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def _content_hash(path: Path) -> str:
+    try:
+        return file_sha256(path)
+    except OSError:
+        return ""
+
+
+def master_fingerprints(
+    paths: Iterable[Path], metrics: MetricsCache, workers: int = 1
+) -> dict[Path, str]:
+    """Content sha256 per master; unchanged ones come from the metrics
+    cache, new or replaced ones are only hashed (not decoded or measured),
+    on `workers` threads since hashlib releases the GIL. Missing or
+    unreadable masters map to "" (their render will report the error)."""
+    paths = list(dict.fromkeys(paths))
+    fingerprints: dict[Path, str] = {}
+    for path in paths:
+        try:
+            fingerprints[path] = metrics.fingerprint(path) or ""
+        except OSError:
+            fingerprints[path] = ""
+    changed = [path for path in paths if not fingerprints[path]]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        fingerprints.update(zip(changed, pool.map(_content_hash, changed)))
+    return fingerprints
+
+
+@dataclass(frozen=True)
+class VariantInputs:
+    """Everything one variant's render depends on."""
+
+    page: str
+    variant: int
+    skus: tuple[str, ...]
+    masters: tuple[str, ...]  # "<file name>:<sha256>", in layer order
+    layout: str
+
+
+class OgManifest:
+    """What produced every rendered variant, keyed by its (background)
+    output file name. Kept in memory during a run and rewritten atomically
+    by save(); rows for pages not rendered this run are kept as they are."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: dict[str, tuple[str, VariantInputs]] = {}
+        if path.exists():
+            with path.open("r", encoding="utf-8", newline="") as handle:
+                for row in csv.DictReader(handle):
+                    self.entries[row["output"]] = (
+                        row["transparent"],
+                        VariantInputs(
+                            page=row["page"],
+                            variant=int(row["variant"]),
+                            skus=tuple(row["skus"].split()),
+                            masters=tuple(row["masters"].split()),
+                            layout=row["layout"],
+                        ),
+                    )
+
+    def current(self, output: Path, transparent: Path, inputs: VariantInputs) -> bool:
+        """Whether output and transparent were rendered from these inputs."""
+        return (
+            self.entries.get(output.name) == (transparent.name, inputs)
+            and output.is_file()
+            and transparent.is_file()
+        )
+
+    def record(self, output: Path, transparent: Path, inputs: VariantInputs) -> None:
+        self.entries[output.name] = (transparent.name, inputs)
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with tmp_path.open("w", encoding="utf-8", newline="") as handle:
+            writer = csv.writer(handle, lineterminator="\n")
+            writer.writerow(MANIFEST_HEADER)
+            for output, (transparent, inputs) in sorted(self.entries.items()):
+                writer.writerow(
+                    [output, transparent, inputs.page, inputs.variant,
+                     " ".join(inputs.skus), " ".join(inputs.masters), inputs.layout]
+                )
+        os.replace(tmp_path, self.path)
+
+
+def stale_jobs(
+    planned: list[tuple[str, list[RenderJob]]],
+    manifest: OgManifest,
+    layout: str,
+    fingerprints: dict[Path, str],
+    force: bool = False,
+) -> tuple[list[tuple[str, list[RenderJob]]], dict[Path, tuple[Path, VariantInputs]]]:
+    """The planned jobs that need rendering (every one with `force`), and
+    each planned output's transparent sibling and inputs, for recording."""
+    stale: list[tuple[str, list[RenderJob]]] = []
+    inputs: dict[Path, tuple[Path, VariantInputs]] = {}
+    for page, jobs in planned:
+        pending = []
+        for job in jobs:
+            number, layers, background_path, transparent_path, _ = job
+            variant = VariantInputs(
+                page=page,
+                variant=number,
+                skus=tuple(row["SKU"] for row, _ in layers),
+                masters=tuple(
+                    f"{master.name}:{fingerprints.get(master, '')}" for _, master in layers
+                ),
+                layout=layout,
+            )
+            inputs[background_path] = (transparent_path, variant)
+            if force or not manifest.current(background_path, transparent_path, variant):
+                pending.append(job)
+        if pending:
+            stale.append((page, pending))
+    return stale, inputs
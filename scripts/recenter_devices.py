@@ -3,87 +3,211 @@
 Reads centering_report.csv (from 6_measure_centering.py), flags every
 kind==alpha row whose off_max_frac >= --threshold, then for each:
 
-  1. copies the ORIGINAL from 1_final-sources -> download/   (untouched source stays put)
-  2. re-centres the download/ copy IN PLACE: trims to the content bounding box
-     and re-pads it with transparent alpha equally on all sides back to the
-     original canvas size.
+  1. reads the ORIGINAL from 1_final-sources   (untouched source stays put)
+  2. writes a re-centred copy to download/: the content bounding box, re-padded
+     with transparent alpha equally on all sides back to the original canvas
+     size.
 
 Because canvas >= bbox on every axis, centring only ever ADDS/REDISTRIBUTES
 transparent padding — it never crops content, and the content pixels are copied
 verbatim (no resampling). White-background (kind==white) rows are skipped.
 
+Each original is decoded once, in-process: the content rectangle is pasted
+onto a fresh canvas, checked against the original by array comparison (any
+visible pixel outside the report's box counts as a loss), and the result
+encoded once and decoded again to confirm it. Anything that is not exact is
+reported and not written; so are sources deeper than 8 bits per channel.
+Images are processed on a --workers process pool.
+
 Nothing is written back to 1_final-sources. Also writes a manifest and a
-before/after review montage per image into download/_review/.
+before/after review montage per image into download/_review/, drawn from
+one panel-sized downscale of the decoded original.
 """
 
 import argparse
 import csv
-import shutil
-import subprocess
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from image_analysis import MetricsCache, measure_array, rgba_array
+
+try:
+    import numpy as np
+    from PIL import Image, ImageDraw
+except ImportError as exc:  # pragma: no cover - makes failure mode obvious
+    raise SystemExit(
+        "Pillow and NumPy are required. Install them via 'pip install Pillow numpy'."
+    ) from exc
+
 REPO = Path(__file__).resolve().parent.parent
 DEFAULT_SOURCE = Path("/Volumes/Storage/Images/1_final-sources")
 DEFAULT_DEST = Path("/Volumes/Storage/Images/download")
 DEFAULT_REPORT = Path(__file__).resolve().parent / "centering_report.csv"
 
-
-def run(args):
-    r = subprocess.run(["magick", *args], capture_output=True, text=True, timeout=180)
-    if r.returncode != 0:
-        raise RuntimeError(r.stderr.strip()[:200])
-    return r.stdout.strip()
+MONTAGE_SIDE = 400              # px per before/after panel
+MONTAGE_BACKGROUND = (229, 229, 229, 255)   # gray90
+MONTAGE_CROSSHAIR = (255, 0, 0, 255)
+LOSSLESS_MODES = {"1", "L", "LA", "P", "PA", "RGB", "RGBA"}  # 8-bit, exact as RGBA
 
 
-def bbox(path):
-    trim = run([str(path), "-format", "%@", "info:"])
-    bw, rest = trim.split("x", 1)
-    bh, x, y = rest.replace("+", " ").split()
-    return int(bw), int(bh), int(x), int(y)
+def bbox(path, cache):
+    """Trim box as (w, h, x, y) from the shared metrics cache, or None if the
+    file is not cached (the worker then measures it from its own decode)."""
+    try:
+        metrics = cache.lookup(path)
+    except OSError:
+        return None  # reported by the worker
+    if metrics is None:
+        return None
+    box = metrics.bbox
+    if box is None:
+        raise RuntimeError(f"{Path(path).name}: no content found")
+    x, y, bw, bh = box
+    return bw, bh, x, y
 
 
-def recenter_in_place(path, w, h, axis="y"):
-    """Re-centre the content bbox on the chosen axis/axes, keeping the other
-    axis at its original position. Content pixels are copied verbatim onto a
-    fresh transparent canvas (no resampling).
+def target_origin(w, h, box, axis="y"):
+    """Where the content bbox goes on the chosen axis/axes, keeping the other
+    axis at its original position.
 
       axis="y"     centre vertically only  (fix the droop, keep X composition)
       axis="x"     centre horizontally only
       axis="both"  centre on both axes
     """
-    bw, bh, x, y = bbox(path)
+    bw, bh, x, y = box
     nx = x if axis == "y" else (w - bw) // 2
     ny = y if axis == "x" else (h - bh) // 2
-    run(["-size", f"{w}x{h}", "xc:none",
-         "(", str(path), "-background", "none", "-trim", "+repage", ")",
-         "-geometry", f"+{nx}+{ny}", "-compose", "over", "-composite",
-         "+repage", str(path)])
-
-
-def verify_lossless(original, recentered):
-    """Trimmed content of both must be pixel-identical (0 abs error)."""
-    out = subprocess.run(
-        ["magick", "compare", "-metric", "AE",
-         "(", str(original), "-trim", "+repage", ")",
-         "(", str(recentered), "-trim", "+repage", ")",
-         "null:"],
-        capture_output=True, text=True, timeout=180)
-    return out.stderr.strip()  # AE count as string, "0" == identical
-
-
-def montage(original, recentered, out_png, w, h):
-    """Side-by-side before|after, downscaled, with a centre crosshair."""
-    line = "xc:none -fill none -stroke red -strokewidth 3"
-    run([
-        "(", str(original), "-resize", "400x400", "-background", "gray90",
-        "-flatten", "-gravity", "center",
-        "-draw", "stroke red stroke-width 1 line 0,200 400,200",
-        "-draw", "stroke red stroke-width 1 line 200,0 200,400", ")",
-        "(", str(recentered), "-resize", "400x400", "-background", "gray90",
-        "-flatten", "-gravity", "center",
-        "-draw", "stroke red stroke-width 1 line 0,200 400,200",
-        "-draw", "stroke red stroke-width 1 line 200,0 200,400", ")",
-        "+append", str(out_png)])
+    return nx, ny
+
+
+def recenter_pixels(pixels, box, axis="y"):
+    """Paste the content bbox verbatim onto a fresh transparent canvas of the
+    same size (no resampling). `box` is the original's trim box as returned by
+    bbox(). Returns the new canvas and the content's new (x, y)."""
+    h, w = pixels.shape[:2]
+    bw, bh, x, y = box
+    nx, ny = target_origin(w, h, box, axis)
+    canvas = np.zeros_like(pixels)
+    canvas[ny:ny + bh, nx:nx + bw] = pixels[y:y + bh, x:x + bw]
+    return canvas, (nx, ny)
+
+
+def verify_lossless(pixels, box, canvas, origin):
+    """Differing-pixel count between the trimmed content of the original and
+    the re-centred canvas (0 == identical), plus every visible pixel of the
+    original that lies outside `box` and so was not carried over (a stale or
+    wrong report box clips content; this is where that shows up)."""
+    bw, bh, x, y = box
+    nx, ny = origin
+    moved = canvas[ny:ny + bh, nx:nx + bw]
+    ae = int((moved != pixels[y:y + bh, x:x + bw]).any(axis=2).sum())
+    dropped = (int(np.count_nonzero(pixels[..., 3]))
+               - int(np.count_nonzero(pixels[y:y + bh, x:x + bw, 3])))
+    return ae + dropped
+
+
+def eight_bit_pixels(image):
+    """rgba_array() of `image`, refusing anything that conversion to 8-bit
+    RGBA would quantise (16-bit PNGs, I/F, CMYK ...): such a copy could not
+    be lossless."""
+    tile = image.tile[0].args if image.tile else None
+    rawmode = tile if isinstance(tile, str) else image.mode
+    if image.mode not in LOSSLESS_MODES or ";16" in rawmode:
+        raise RuntimeError(f"unsupported pixel format {rawmode} "
+                           "(only 8-bit images can be re-centred losslessly)")
+    return rgba_array(image)
+
+
+def _panel(small, shift=(0.0, 0.0)):
+    """A premultiplied panel-sized image, its content moved by `shift` px, on
+    gray with a centre crosshair. Transformed premultiplied, so transparent
+    pixels do not bleed dark into the edges."""
+    image = small
+    if shift != (0, 0):
+        image = small.transform(small.size, Image.AFFINE,
+                                (1, 0, -shift[0], 0, 1, -shift[1]),
+                                resample=Image.BICUBIC, fillcolor=(0, 0, 0, 0))
+    image = image.convert("RGBA")
+    panel = Image.new("RGBA", image.size, MONTAGE_BACKGROUND)
+    panel.alpha_composite(image)
+    draw = ImageDraw.Draw(panel)
+    mid = MONTAGE_SIDE // 2
+    draw.line([(0, mid), (MONTAGE_SIDE, mid)], fill=MONTAGE_CROSSHAIR)
+    draw.line([(mid, 0), (mid, MONTAGE_SIDE)], fill=MONTAGE_CROSSHAIR)
+    return panel.convert("RGB")
+
+
+def montage(pixels, shift, out_png):
+    """Side-by-side before|after, with a centre crosshair. Re-centring only
+    moves the content by `shift` master px, so both panels come from one
+    MONTAGE_SIDE downscale of the original's `pixels`."""
+    image = Image.fromarray(pixels, "RGBA").convert("RGBa")
+    scale = MONTAGE_SIDE / max(image.size)
+    small = image.resize((max(1, round(image.width * scale)),
+                          max(1, round(image.height * scale))),
+                         Image.LANCZOS, reducing_gap=3.0)
+    image.close()
+    before = _panel(small)
+    after = _panel(small, (shift[0] * scale, shift[1] * scale))
+    sheet = Image.new("RGB", (before.width + after.width,
+                              max(before.height, after.height)), "white")
+    sheet.paste(before, (0, 0))
+    sheet.paste(after, (before.width, 0))
+    sheet.save(out_png)
+
+
+def recenter_file(job):
+    """Decode the original once, re-centre, verify and encode the copy.
+
+    `job` is (src, dst, w, h, box, axis, montage_png); box may be None to
+    measure it from this decode. Runs in a worker process; errors are
+    returned rather than raised so one bad file cannot abort the pool.
+    """
+    src, dst, w, h, box, axis, montage_png = job
+    try:
+        with Image.open(src) as image:
+            icc_profile = image.info.get("icc_profile")
+            pixels = eight_bit_pixels(image)
+        if pixels.shape[:2] != (h, w):
+            raise RuntimeError(f"canvas is {pixels.shape[1]}x{pixels.shape[0]}, "
+                               f"report says {w}x{h}")
+        if box is None:
+            trim = measure_array(pixels).bbox
+            if trim is None:
+                raise RuntimeError(f"{Path(src).name}: no content found")
+            x, y, bw, bh = trim
+            box = (bw, bh, x, y)
+
+        canvas, origin = recenter_pixels(pixels, box, axis)
+        ae = verify_lossless(pixels, box, canvas, origin)
+        if ae:
+            raise RuntimeError(f"not pixel-lossless (AE={ae}); nothing written")
+
+        # Encode once, atomically, never touching the source; the encoded
+        # file is decoded again and must match the canvas before it lands.
+        tmp = Path(dst).with_name(Path(dst).name + ".tmp")
+        try:
+            Image.fromarray(canvas, "RGBA").save(tmp, format="PNG", icc_profile=icc_profile)
+            with Image.open(tmp) as written:
+                ae = int((rgba_array(written) != canvas).any(axis=2).sum())
+            if ae:
+                raise RuntimeError(f"encoded copy differs from the canvas (AE={ae})")
+            os.replace(tmp, dst)
+        finally:
+            tmp.unlink(missing_ok=True)
+        if montage_png is not None:
+            montage(pixels, (origin[0] - box[2], origin[1] - box[3]), montage_png)
+
+        bw, bh = box[0], box[1]
+        nx, ny = origin
+        return {
+            "new_off_x": round((nx + bw / 2 - w / 2) / w, 4),
+            "new_off_y": round((ny + bh / 2 - h / 2) / h, 4),
+            "ae": str(ae),
+        }
+    except Exception as exc:  # noqa: BLE001 - reported by the caller
+        return exc
 
 
 def main():
@@ -96,6 +220,7 @@ def main():
     ap.add_argument("--dest", type=Path, default=DEFAULT_DEST)
     ap.add_argument("--report", type=Path, default=DEFAULT_REPORT)
     ap.add_argument("--montage", action="store_true", help="write review montages")
+    ap.add_argument("--workers", type=int, default=8)
     ap.add_argument("--dry-run", action="store_true")
     args = ap.parse_args()
 
@@ -111,35 +236,52 @@ def main():
     review.mkdir(parents=True, exist_ok=True)
     manifest = []
     bad = []
-
-    for i, r in enumerate(rows, 1):
+    cache = MetricsCache()  # originals are usually already measured
+    queued, jobs = [], []
+    for r in rows:
         src = args.source / r["file"]
-        dst = args.dest / r["file"]
-        w, h = int(r["canvas_w"]), int(r["canvas_h"])
-        shutil.copy2(src, dst)
-        recenter_in_place(dst, w, h, args.axis)
-
-        ae = verify_lossless(src, dst)
-        bw, bh, x, y = bbox(dst)
-        new_off_x = round((x + bw / 2 - w / 2) / w, 4)
-        new_off_y = round((y + bh / 2 - h / 2) / h, 4)
-        if args.montage:
-            montage(src, dst, review / f"{Path(r['file']).stem}.png", w, h)
-
-        ok = ae.split()[0] in ("0", "0.0")
-        if not ok:
+        try:
+            box = bbox(src, cache)
+        except RuntimeError as exc:  # e.g. cached as empty: nothing to recentre
+            bad.append((r["file"], f"error: {exc}"))
+            print(f"  {r['file']}  ERROR {exc}")
+            continue
+        montage_png = review / f"{Path(r['file']).stem}.png" if args.montage else None
+        queued.append(r)
+        jobs.append((src, args.dest / r["file"], int(r["canvas_w"]), int(r["canvas_h"]),
+                     box, args.axis, montage_png))
+    cache.close()
+
+    if args.workers > 1 and len(jobs) > 1:
+        pool = ProcessPoolExecutor(max_workers=args.workers)
+        results = pool.map(recenter_file, jobs)
+    else:
+        pool = None
+        results = map(recenter_file, jobs)
+
+    for i, (r, result) in enumerate(zip(queued, results), 1):
+        if isinstance(result, Exception):
+            bad.append((r["file"], f"error: {result}"))
+            print(f"  [{i}/{len(queued)}] {r['file']}  ERROR {result}")
+            continue
+        ae = result["ae"]
+        if ae != "0":
             bad.append((r["file"], ae))
         manifest.append({
-            "file": r["file"], "canvas": f"{w}x{h}",
-            "old_off_y": r["off_y_frac"], "new_off_y": new_off_y,
-            "old_off_x": r["off_x_frac"], "new_off_x": new_off_x,
+            "file": r["file"], "canvas": f"{r['canvas_w']}x{r['canvas_h']}",
+            "old_off_y": r["off_y_frac"], "new_off_y": result["new_off_y"],
+            "old_off_x": r["off_x_frac"], "new_off_x": result["new_off_x"],
             "lossless_AE": ae,
         })
-        print(f"  [{i}/{len(rows)}] {r['file']}  "
-              f"y {float(r['off_y_frac']):+.3f}->{new_off_y:+.3f}  AE={ae}")
+        print(f"  [{i}/{len(queued)}] {r['file']}  "
+              f"y {float(r['off_y_frac']):+.3f}->{result['new_off_y']:+.3f}  AE={ae}")
+    if pool is not None:
+        pool.shutdown()
 
+    fields = ["file", "canvas", "old_off_y", "new_off_y",
+              "old_off_x", "new_off_x", "lossless_AE"]
     with (args.dest / "centering_manifest.csv").open("w", newline="") as f:
-        wr = csv.DictWriter(f, fieldnames=list(manifest[0].keys()))
+        wr = csv.DictWriter(f, fieldnames=fields)
         wr.writeheader()
         wr.writerows(manifest)
 
@@ -148,7 +290,7 @@ def main():
     if args.montage:
         print(f"Review montages -> {review}")
     if bad:
-        print(f"\nWARNING: {len(bad)} not pixel-lossless:")
+        print(f"\nWARNING: {len(bad)} failed or not pixel-lossless:")
         for f, ae in bad:
             print(f"  {f}: AE={ae}")
     else:
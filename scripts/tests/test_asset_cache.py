@@ -0,0 +1,241 @@
+"""Rotated layers, collisions and compositing in asset_cache.py."""
+
+from __future__ import annotations
+
+import math
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image, ImageChops
+
+from asset_cache import (
+    AFFINE_PADDING,
+    LayerCompositor,
+    RotatedLayer,
+    RotatedLayerCache,
+    affine_layer,
+    layers_collide,
+    prefilter_sigma,
+    reduce_master,
+    reduction_factor,
+    rotate_layer,
+    rotation_frame,
+)
+
+
+def _layer(size=(40, 30), box=(5, 8, 25, 20), colour=(200, 40, 40, 255)) -> Image.Image:
+    image = Image.new("RGBA", size, (0, 0, 0, 0))
+    image.paste(colour, box)
+    return image
+
+
+def test_rotated_layer_is_trimmed_to_its_alpha():
+    layer = RotatedLayer.from_frame(_layer())
+    assert (layer.offset, layer.size, layer.image.size) == ((5, 8), (40, 30), (20, 12))
+    assert layer.alpha.shape == (12, 20) and (layer.alpha == 255).all()
+
+    empty = RotatedLayer.from_frame(Image.new("RGBA", (40, 30)))
+    assert (empty.image.size, empty.size) == ((1, 1), (40, 30))
+    assert not empty.alpha.any()
+
+
+def test_rotate_layer_returns_the_straight_expanded_frame():
+    straight = _layer(colour=(200, 40, 40, 128))
+    frame = rotate_layer(straight.convert("RGBa"), 90)
+    assert frame.mode == "RGBA" and frame.size == (30, 40)
+    expected = np.asarray(straight.transpose(Image.Transpose.ROTATE_90), np.int16)
+    assert np.abs(np.asarray(frame, np.int16) - expected).max() <= 1  # premultiply rounding
+
+
+def test_rotated_layer_cache_memoises_and_evicts_least_recent():
+    built = []
+
+    def frames(path: Path, angle: int) -> Image.Image:
+        built.append((path.name, angle))
+        return _layer()
+
+    one = RotatedLayer.from_frame(_layer()).nbytes
+    cache = RotatedLayerCache(frames, budget=2 * one)
+    a, b, c = Path("a.png"), Path("b.png"), Path("c.png")
+    first = cache.get(a, 5)
+    assert cache.get(a, 5) is first
+    cache.get(a, -5)  # another angle is another layer
+    cache.get(a, 5)   # a@5 is now the most recent
+    cache.get(b, 5)   # evicts a@-5
+    assert list(cache.layers) == [(a, 5), (b, 5)] and cache.nbytes == 2 * one
+    cache.get(a, -5)
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert built == [("a.png", 5), ("a.png", -5), ("b.png", 5), ("a.png", -5)]
+
+    tiny = RotatedLayerCache(frames, budget=1)
+    assert tiny.get(c, 0) is not None and len(tiny.layers) == 1  # always keeps one
+
+
+def _random_frame(rng: np.random.Generator) -> Image.Image:
+    """Opaque blocks, soft edges, holes and faint pixels: every span kind."""
+    height, width = rng.integers(4, 24, 2)
+    alpha = np.zeros((height, width), np.uint8)
+    for _ in range(rng.integers(1, 4)):
+        top, left = rng.integers(0, height), rng.integers(0, width)
+        bottom, right = rng.integers(top, height + 1), rng.integers(left, width + 1)
+        alpha[top:bottom, left:right] = 255
+    soft = rng.random(alpha.shape) < 0.15
+    alpha[soft] = rng.integers(1, 255, soft.sum())
+    alpha[rng.random(alpha.shape) < 0.05] = 0
+    rgba = np.zeros((height, width, 4), np.uint8)
+    rgba[..., 3] = alpha
+    return Image.fromarray(rgba, "RGBA")
+
+
+def _collide_by_multiply(first, first_position, second, second_position) -> bool:
+    """The rule layers_collide replaced: multiply full-size alpha planes."""
+    planes = []
+    for layer, (x, y) in ((first, first_position), (second, second_position)):
+        plane = Image.new("L", (64, 64))
+        plane.paste(Image.fromarray(layer.alpha), (x + 16, y + 16))
+        planes.append(plane)
+    return ImageChops.multiply(*planes).getbbox() is not None
+
+
+def test_layers_collide_matches_alpha_multiplication():
+    rng = np.random.default_rng(18)
+    outcomes = set()
+    for _ in range(3000):
+        first = RotatedLayer.from_frame(_random_frame(rng))
+        second = RotatedLayer.from_frame(_random_frame(rng))
+        first_position = tuple(int(v) for v in rng.integers(0, 16, 2))
+        second_position = tuple(int(v) for v in rng.integers(-8, 24, 2))
+        expected = _collide_by_multiply(first, first_position, second, second_position)
+        assert layers_collide(first, first_position, second, second_position) == expected
+        assert layers_collide(second, second_position, first, first_position) == expected
+        outcomes.add(expected)
+    assert outcomes == {True, False}
+
+
+def test_faint_overlap_is_not_a_collision():
+    faint = RotatedLayer.from_frame(_layer(colour=(0, 0, 0, 15)))
+    assert not layers_collide(faint, (0, 0), faint, (3, 2))  # 15 * 15 < 255
+    half = RotatedLayer.from_frame(_layer(colour=(0, 0, 0, 16)))
+    assert layers_collide(half, (0, 0), half, (3, 2))  # 16 * 16 >= 255
+
+
+BACKGROUND = (229, 229, 229, 255)
+
+
+def _reference(layers, positions, size, origin):
+    """Composite on the whole layout frame, then crop out the output."""
+    frame = Image.new("RGBA", (200, 200), (0, 0, 0, 0))
+    for layer, position in zip(layers, positions):
+        frame.alpha_composite(layer.image, tuple(position))
+    transparent = frame.crop((*origin, origin[0] + size[0], origin[1] + size[1]))
+    background = Image.new("RGBA", size, BACKGROUND)
+    background.alpha_composite(transparent)
+    return transparent, background
+
+
+def _soft_layer(rng: np.random.Generator) -> RotatedLayer:
+    height, width = rng.integers(5, 40, 2)
+    pixels = rng.integers(0, 256, (height, width, 4), np.uint8)
+    return RotatedLayer.from_frame(Image.fromarray(pixels, "RGBA"))
+
+
+def test_compositor_matches_a_full_frame_composite_across_reuse():
+    rng = np.random.default_rng(19)
+    size, origin = (60, 45), (30, 20)
+    compositor = LayerCompositor(size, BACKGROUND, origin)
+    for round_number in range(40):
+        layers = [_soft_layer(rng) for _ in range(rng.integers(0, 5))]
+        positions = [[int(v) for v in rng.integers(0, 110, 2)] for _ in layers]
+        composite = compositor.composite(layers, positions)
+        transparent, background = _reference(layers, positions, size, origin)
+        assert composite.transparent.tobytes() == transparent.tobytes(), round_number
+        assert composite.background.tobytes() == background.tobytes(), round_number
+        if composite.dirty is None:
+            assert transparent.getbbox() is None
+        else:
+            left, top, right, bottom = composite.dirty
+            assert 0 <= left < right <= size[0] and 0 <= top < bottom <= size[1]
+            bbox = transparent.getchannel("A").getbbox()
+            if bbox is not None:  # everything drawn lies inside the dirty box
+                assert bbox[0] >= composite.dirty[0] and bbox[1] >= composite.dirty[1]
+                assert bbox[2] <= composite.dirty[2] and bbox[3] <= composite.dirty[3]
+        compositor.release(composite)
+    assert len(compositor.free) == 1  # one buffer pair, reused every round
+
+
+def test_layers_outside_the_output_touch_nothing():
+    compositor = LayerCompositor((20, 20), BACKGROUND, (50, 50))
+    layer = RotatedLayer.from_frame(_layer())
+    composite = compositor.composite([layer, layer], [(0, 0), (75, 50)])
+    assert composite.dirty is None
+    assert composite.transparent.getbbox() is None
+    assert composite.background.getcolors() == [(400, BACKGROUND)]
+
+
+@pytest.mark.parametrize("angle", [0, 3, -7, 12.5, 45, 90, 181, -135])
+@pytest.mark.parametrize("size", [(40, 30), (33, 51), (1, 9)])
+def test_rotation_frame_is_pillows_rotate(size, angle):
+    # Opaque noise: rotate() takes lossless shortcuts at multiples of 90
+    # degrees, while transform() resamples premultiplied.
+    rng = np.random.default_rng(20)
+    pixels = rng.integers(0, 256, (size[1], size[0], 4), np.uint8)
+    pixels[..., 3] = 255
+    image = Image.fromarray(pixels, "RGBA")
+    expected = image.rotate(angle, Image.Resampling.BICUBIC, expand=True)
+    frame, matrix = rotation_frame(size, angle)
+    assert frame == expected.size
+    transformed = image.transform(
+        frame, Image.Transform.AFFINE, matrix, resample=Image.Resampling.BICUBIC
+    )
+    assert transformed.tobytes() == expected.tobytes()
+
+
+def test_reduction_leaves_less_than_2x_to_the_affine_pass():
+    assert reduction_factor((1000, 800), (300, 200)) == 3
+    assert reduction_factor((100, 80), (300, 200)) == 1  # upscale: no reduction
+    assert prefilter_sigma((900, 600), (300, 200), 3) == 0.0
+    sigma = prefilter_sigma((1000, 800), (300, 200), 3)
+    assert sigma == pytest.approx(0.5 * math.sqrt((4 / 3) ** 2 - 1))  # 800 / 200 / 3
+
+
+def test_reduce_master_pads_and_box_reduces_the_bbox():
+    master = Image.new("RGBA", (50, 40), (0, 0, 0, 0))
+    master.paste((10, 20, 30, 255), (10, 5, 21, 17))  # 11 x 12 bbox
+    reduced = reduce_master(master, (10, 5, 21, 17), 4)
+    assert reduced.mode == "RGBa"
+    assert reduced.size == (3 + 2 * AFFINE_PADDING, 3 + 2 * AFFINE_PADDING)
+    alpha = np.asarray(reduced.getchannel("a"))
+    inner = alpha[AFFINE_PADDING:-AFFINE_PADDING, AFFINE_PADDING:-AFFINE_PADDING]
+    # The last column covers 3 of its 4 master columns, the rest are full.
+    assert inner[0].tolist() == [255, 255, 191]
+    assert alpha.sum() == inner.sum()
+
+
+def test_affine_layer_matches_resize_then_rotate():
+    master = np.zeros((400, 300, 4), np.uint8)
+    ramp = np.linspace(0, 255, 240).astype(np.uint8)
+    master[40:360, 30:270, 0] = ramp
+    master[40:360, 30:270, 1] = ramp[::-1]
+    master[40:360, 30:270, 3] = 255
+    master = Image.fromarray(master, "RGBA")
+    alpha_box, canvas = (30, 40, 270, 360), (100, 120)
+    geometry = ((71, 93), (17, 11))  # product size and top-left on the canvas
+    factor = reduction_factor((240, 320), geometry[0])
+
+    normalised = Image.new("RGBa", canvas, (0, 0, 0, 0))
+    product = master.crop(alpha_box).convert("RGBa").resize(
+        geometry[0], Image.Resampling.LANCZOS
+    )
+    normalised.paste(product, geometry[1])
+    reduced = reduce_master(
+        master, alpha_box, factor, prefilter_sigma((240, 320), geometry[0], factor)
+    )
+    for angle in (0, 4, -9):
+        expected = rotate_layer(normalised, angle)
+        frame = affine_layer(reduced, factor, (240, 320), geometry, canvas, angle)
+        assert frame.size == expected.size
+        difference = np.abs(
+            np.asarray(frame, np.int16) - np.asarray(expected, np.int16)
+        )
+        assert difference.mean() < 1 and np.percentile(difference, 99) < 16  # edges only
@@ -0,0 +1,75 @@
+"""Spec matching in batch_cropper.py against the linear scan it replaced."""
+
+from __future__ import annotations
+
+import random
+from typing import Dict, List, Sequence
+
+import pytest
+
+from batch_cropper import COLUMN_SEPARATOR, DatabaseView, compile_match, filter_database
+
+COLUMNS = ["code", "name", "model", "colour", "year"]
+WORDS = ["", "Wallet", "wallet", "MagSafe", "Key Ring", "iPhone 15", "iphone", "15",
+         "Leather", "Black", "black", "Sleeve", "a", "A;b", "x=y", "~"]
+
+
+def reference_filter(rows: Sequence[Dict[str, str]], expr: str) -> List[Dict[str, str]]:
+    """filter_database as it was before DatabaseView: a linear scan per clause."""
+    if not expr:
+        return []
+    clauses = [clause.strip() for clause in expr.split(COLUMN_SEPARATOR) if clause.strip()]
+    if not clauses:
+        return []
+    matched = list(rows)
+    for clause in clauses:
+        if "~" in clause:
+            key, value = clause.split("~", 1)
+            needle = value.strip().lower()
+            matched = [row for row in matched if needle in row.get(key.strip().lower(), "").lower()]
+        elif "=" in clause:
+            key, value = clause.split("=", 1)
+            target = value.strip()
+            matched = [row for row in matched if row.get(key.strip().lower(), "") == target]
+        else:
+            raise ValueError(clause)
+    return matched
+
+
+def random_rows(rng: random.Random, count: int) -> List[Dict[str, str]]:
+    rows = []
+    for number in range(count):
+        row = {"code": f"MX{number:03d}"}
+        for column in COLUMNS[1:]:
+            if rng.random() < 0.9:  # some rows lack a column entirely
+                row[column] = " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 3)))
+        rows.append(row)
+    return rows
+
+
+def random_expr(rng: random.Random) -> str:
+    clauses = []
+    for _ in range(rng.randint(0, 3)):
+        key = rng.choice(COLUMNS + ["missing", " Name ", "MODEL"])
+        value = rng.choice(WORDS + [f"MX{rng.randint(0, 80):03d}"])
+        clauses.append(f"{key}{rng.choice('~=')}{rng.choice(['', ' '])}{value}")
+    return COLUMN_SEPARATOR.join(clauses)
+
+
+def test_database_view_matches_linear_filter():
+    rng = random.Random(20261018)
+    rows = random_rows(rng, 60)
+    view = DatabaseView(rows)
+    checked = 0
+    for _ in range(3000):
+        expr = random_expr(rng)
+        try:
+            expected = reference_filter(rows, expr)
+        except ValueError:
+            with pytest.raises(ValueError):
+                filter_database(view, expr)
+            continue
+        assert filter_database(view, expr) == expected, expr
+        assert compile_match(expr).select(view) == (expected if expr else []), expr
+        checked += 1
+    assert checked > 2500
@@ -0,0 +1,121 @@
+"""Crop-manifest staleness and orphan pruning in batch_cropper.py."""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from batch_cropper import (
+    CropManifest,
+    CropSpec,
+    DatabaseView,
+    ManifestEntry,
+    SourceFingerprint,
+    SourceIndex,
+    build_plan,
+    file_sha256,
+    keep_reason,
+)
+
+
+def _write(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def _record(manifest: CropManifest, output_dir: Path, dest: Path, src: Path,
+            spec: CropSpec) -> None:
+    stat = src.stat()
+    manifest.entries[dest.relative_to(output_dir).as_posix()] = ManifestEntry(
+        src.name,
+        SourceFingerprint(stat.st_size, stat.st_mtime_ns, file_sha256(src)),
+        (spec.left, spec.top, spec.right, spec.bottom, spec.output_subdir, spec.output_suffix),
+        spec.label,
+    )
+
+
+@pytest.fixture
+def tree(tmp_path: Path):
+    source_dir, output_dir = tmp_path / "src", tmp_path / "out"
+    for name in ("AAA.png", "BBB.png"):
+        _write(source_dir / name, name.encode())
+        _write(output_dir / name, b"crop")
+    specs = [CropSpec("A", 1, 2, 3, 4, glob="AAA*"), CropSpec("B", 5, 5, 5, 5, glob="BBB*")]
+    manifest = CropManifest(output_dir / "crop_manifest.csv")
+    _record(manifest, output_dir, output_dir / "AAA.png", source_dir / "AAA.png", specs[0])
+    _record(manifest, output_dir, output_dir / "BBB.png", source_dir / "BBB.png", specs[1])
+    manifest.save()
+    return source_dir, output_dir, specs
+
+
+def _plan(source_dir: Path, output_dir: Path, specs, overwrite: bool = False):
+    manifest = CropManifest(output_dir / "crop_manifest.csv")
+    plan = build_plan(specs, DatabaseView([]), SourceIndex.scan(source_dir), (".png",),
+                      output_dir, overwrite, manifest)
+    return plan, manifest
+
+
+def _reasons(plan) -> Dict[str, str]:
+    return {dest.name: reason for dest, reason in plan.reasons.items()}
+
+
+def test_recorded_outputs_are_current(tree):
+    source_dir, output_dir, specs = tree
+    plan, _ = _plan(source_dir, output_dir, specs)
+    assert (plan.outputs, plan.current, plan.orphans) == (0, 2, [])
+
+
+def test_touched_source_with_same_content_is_current(tree):
+    source_dir, output_dir, specs = tree
+    os.utime(source_dir / "AAA.png", ns=(1, 1))
+    plan, _ = _plan(source_dir, output_dir, specs)
+    assert plan.outputs == 0
+
+
+def test_changed_source_spec_and_missing_output_are_stale(tree):
+    source_dir, output_dir, specs = tree
+    _write(source_dir / "AAA.png", b"new pixels")
+    (output_dir / "BBB.png").unlink()
+    plan, _ = _plan(source_dir, output_dir, specs)
+    assert _reasons(plan) == {"AAA.png": "source changed", "BBB.png": "missing"}
+
+    _write(output_dir / "BBB.png", b"crop")
+    specs[1].left = 6
+    plan, _ = _plan(source_dir, output_dir, specs)
+    assert _reasons(plan)["BBB.png"] == "spec changed"
+
+
+def test_untracked_output_is_skipped_and_new_one_planned(tree):
+    source_dir, output_dir, specs = tree
+    _write(source_dir / "CCC.png", b"c")
+    _write(source_dir / "DDD.png", b"d")
+    _write(output_dir / "CCC.png", b"not ours")
+    specs.append(CropSpec("C", 0, 0, 0, 0, glob="[CD]*"))
+    plan, _ = _plan(source_dir, output_dir, specs)
+    assert plan.skipped == 1
+    assert _reasons(plan) == {"DDD.png": "new"}
+
+    plan, _ = _plan(source_dir, output_dir, specs, overwrite=True)
+    assert set(_reasons(plan).values()) == {"overwrite"} and plan.outputs == 4
+
+
+def test_orphans_are_pruned_only_when_source_is_gone(tree):
+    source_dir, output_dir, specs = tree
+    # B's selector comes up empty (as with a partial mount): never prunable.
+    (source_dir / "BBB.png").rename(source_dir.parent / "BBB.png")
+    plan, manifest = _plan(source_dir, output_dir, specs)
+    assert plan.orphans == ["BBB.png"]
+    assert "matched 0 files" in keep_reason(manifest.entries["BBB.png"], plan, source_dir)
+
+    # Spec dropped but source still there: kept.
+    (source_dir.parent / "BBB.png").rename(source_dir / "BBB.png")
+    plan, manifest = _plan(source_dir, output_dir, specs[:1])
+    assert "still exists" in keep_reason(manifest.entries["BBB.png"], plan, source_dir)
+
+    # Spec dropped and source gone: prunable.
+    (source_dir / "BBB.png").unlink()
+    plan, manifest = _plan(source_dir, output_dir, specs[:1])
+    assert keep_reason(manifest.entries["BBB.png"], plan, source_dir) == ""
@@ -0,0 +1,482 @@
+"""2_image_downloader.py against a local stand-in for the Apple CDN."""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import importlib.util
+import io
+import random
+import sys
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Set
+
+import aiohttp
+import numpy as np
+import pytest
+from aiohttp import web
+from PIL import Image
+
+import analyze_padding
+
+SCRIPTS = Path(__file__).resolve().parent.parent
+
+
+def _load_downloader():
+    # The file name starts with a digit, so it cannot be imported by name.
+    spec = importlib.util.spec_from_file_location(
+        "image_downloader", SCRIPTS / "2_image_downloader.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+dl = _load_downloader()
+
+
+def png_bytes(side: int = 64, seed: int = 0) -> bytes:
+    """A noisy RGBA PNG, large enough to arrive in several reads."""
+    pixels = np.random.default_rng(seed).integers(0, 256, (side, side, 4), np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, "RGBA").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class FakeCdn:
+    """Serves `files` like the CDN: Range, If-Range, ETag and conditional GETs.
+
+    `statuses` scripts error responses per code (popped one per request
+    before the file is served); `truncate` cuts a code's body short.
+    `sizes` gives a code's encoded size per canvas, answered to one-byte
+    Range probes.
+    """
+
+    def __init__(self) -> None:
+        self.files: Dict[str, bytes] = {}
+        self.statuses: Dict[str, List[int]] = {}
+        self.truncate: Set[str] = set()
+        self.ranges = True
+        self.sizes: Dict[str, Callable[[int], int]] = {}
+        self.requests: List[tuple] = []
+
+    def etag(self, code: str) -> str:
+        return '"' + hashlib.sha256(self.files[code]).hexdigest()[:16] + '"'
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        code = request.match_info["code"]
+        self.requests.append((code, int(request.query["wid"]), dict(request.headers)))
+        scripted = self.statuses.get(code)
+        if scripted:
+            return web.Response(status=scripted.pop(0), headers={"Retry-After": "0"})
+        if code in self.sizes and request.headers.get("Range") == "bytes=0-0":
+            total = self.sizes[code](int(request.query["wid"]))
+            return web.Response(
+                status=206, body=b"\0", headers={"Content-Range": f"bytes 0-0/{total}"}
+            )
+        if code not in self.files:
+            return web.Response(status=404)
+        body = self.files[code]
+        headers = {"ETag": self.etag(code), "Content-Type": "image/png"}
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            return web.Response(status=304, headers=headers)
+        status = 200
+        requested = request.headers.get("Range", "")
+        if_range = request.headers.get("If-Range")
+        if self.ranges and requested and if_range in (None, headers["ETag"]):
+            start, _, end = requested.removeprefix("bytes=").partition("-")
+            end = int(end) if end else len(body) - 1
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            body = body[int(start): end + 1]
+            status = 206
+        if code in self.truncate:
+            body = body[: len(body) // 2]
+        return web.Response(status=status, body=body, headers=headers)
+
+    @asynccontextmanager
+    async def serve(self):
+        app = web.Application()
+        app.router.add_get("/{code}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            yield f"http://127.0.0.1:{port}/{{code}}?wid={{wid}}&hei={{hei}}"
+        finally:
+            await runner.cleanup()
+
+
+@pytest.fixture
+def cdn(monkeypatch):
+    """Run a coroutine function against a FakeCdn with a live session."""
+    fake = FakeCdn()
+
+    def run(body):
+        async def main():
+            async with fake.serve() as template:
+                monkeypatch.setattr(dl, "BASE_URL_TEMPLATE", template)
+                async with aiohttp.ClientSession() as session:
+                    return await body(session)
+
+        return asyncio.run(main())
+
+    fake.run = run
+    return fake
+
+
+def _task(folder: Path, code: str = "MX001", size: int = 1024):
+    return dl.DownloadTask(code, size, size, folder)
+
+
+def test_download_writes_file_and_reports_outcomes(cdn, tmp_path: Path):
+    cdn.files["MX001"] = png_bytes()
+    task, gone = _task(tmp_path), _task(tmp_path, "GONE")
+
+    first, missing = cdn.run(
+        lambda session: asyncio.gather(
+            dl.download_image(session, task), dl.download_image(session, gone)
+        )
+    )
+    assert first.outcome == "downloaded" and first.resolved
+    assert (tmp_path / "MX001.png").read_bytes() == cdn.files["MX001"]
+    assert missing.outcome == "missing" and missing.resolved
+    assert not (tmp_path / "GONE.png").exists()
+
+    requests = len(cdn.requests)
+    again = cdn.run(lambda session: dl.download_image(session, task))
+    assert again.outcome == "existing"
+    assert len(cdn.requests) == requests  # nothing fetched
+
+
+def test_download_all_shares_one_session(cdn, tmp_path: Path):
+    codes = [f"MX{i:03}" for i in range(12)]
+    for i, code in enumerate(codes):
+        cdn.files[code] = png_bytes(seed=i)
+
+    async def body(session):
+        return await dl.download_all([_task(tmp_path, code) for code in codes], 4)
+
+    results = cdn.run(body)
+    assert sorted(result.task.code for result in results) == codes
+    assert all(result.outcome == "downloaded" for result in results)
+    for code in codes:
+        assert (tmp_path / f"{code}.png").read_bytes() == cdn.files[code]
+
+
+def test_remove_resolved_lines_keeps_everything_else(tmp_path: Path):
+    listing = tmp_path / "list.txt"
+    listing.write_text(
+        "# comment\niphone:\nMX001,1024x1024\n\nMX002, 2048x2048\nMX003,512x512\n",
+        encoding="utf-8",
+    )
+    assert [task.code for task in dl.parse_tasks(listing, tmp_path)] == [
+        "MX001", "MX002", "MX003",
+    ]
+    assert dl.remove_resolved_lines(listing, {"MX002", "MX003"}) == 2
+    assert listing.read_text(encoding="utf-8") == "# comment\niphone:\nMX001,1024x1024\n\n"
+
+
+def test_parse_retry_after():
+    assert dl.parse_retry_after(None) is None
+    assert dl.parse_retry_after("") is None
+    assert dl.parse_retry_after(" 120 ") == 120.0
+    assert dl.parse_retry_after("soon") is None
+    assert dl.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    later = dl.parse_retry_after(
+        time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 30))
+    )
+    assert 25 < later <= 30
+
+
+def test_backoff_is_capped_and_honours_retry_after():
+    scheduler = dl.DownloadScheduler(None, dl.AdaptiveLimiter(1, 1))
+    random.seed(0)
+    for attempt in range(1, 12):
+        delay = scheduler.backoff(attempt, None)
+        assert 0 <= delay <= min(dl.BACKOFF_CAP, dl.BACKOFF_BASE * 2 ** attempt)
+    assert scheduler.backoff(1, 30.0) >= 30.0
+    assert scheduler.backoff(1, 3600.0) == dl.BACKOFF_CAP
+
+
+def test_limiter_grows_on_success_and_halves_once_per_burst():
+    limiter = dl.AdaptiveLimiter(8, 32)
+    task = dl.DownloadTask("MX001", 1024, 1024, Path("."))
+    for _ in range(8):
+        limiter._record(dl.DownloadResult(task, "downloaded", latency=0.1))
+    assert 8.9 < limiter.window < 9.1  # about +1 per window of responses
+
+    limiter._record(dl.DownloadResult(task, "existing"))
+    assert 8.9 < limiter.window < 9.1  # no request made, no signal
+
+    throttled = dl.DownloadResult(task, "transient", "HTTP 503", 0.1, throttled=True)
+    limiter._record(throttled)
+    halved = limiter.window
+    assert halved == pytest.approx(9.0 * dl.DECREASE_FACTOR, abs=0.2)
+    limiter._record(throttled)  # same round trip: one congestion signal
+    assert limiter.window == halved
+
+    for _ in range(20):
+        limiter._record(throttled)
+        limiter._last_decrease = 0.0
+    assert limiter.window == limiter.minimum
+
+
+def test_scheduler_requeues_transient_and_gives_up(cdn, tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(dl, "BACKOFF_BASE", 0.0)
+    for code in ("FLAKY", "DOWN", "DENIED"):
+        cdn.files[code] = png_bytes()
+    cdn.statuses = {"FLAKY": [503, 500], "DOWN": [502] * 10, "DENIED": [403]}
+    tasks = [_task(tmp_path, code) for code in ("FLAKY", "DOWN", "DENIED")]
+
+    async def body(session):
+        scheduler = dl.DownloadScheduler(
+            session, dl.AdaptiveLimiter(4, 4), max_attempts=3
+        )
+        for task in tasks:
+            scheduler.submit(task)
+        results = await scheduler.run(4)
+        return {result.task.code: result for result in results}, scheduler.attempts
+
+    results, attempts = cdn.run(body)
+    assert results["FLAKY"].outcome == "downloaded" and attempts[tasks[0]] == 3
+    assert results["DOWN"].outcome == "transient" and attempts[tasks[1]] == 3
+    assert results["DENIED"].outcome == "failed" and attempts[tasks[2]] == 1
+    assert (tmp_path / "FLAKY.png").is_file()
+    assert not (tmp_path / "DOWN.png").exists()
+
+
+def _validate(data: bytes, step: int) -> "dl.PngStreamValidator":
+    validator = dl.PngStreamValidator()
+    for start in range(0, len(data), step):
+        validator.feed(data[start: start + step])
+    validator.finish()
+    return validator
+
+
+@pytest.mark.parametrize("step", [1, 7, 8, 13, 4096, 1 << 20])
+def test_png_validator_accepts_any_split(step: int):
+    data = png_bytes()
+    validator = _validate(data, step)
+    assert validator.complete and validator.offset == len(data)
+    assert validator.digest.hexdigest() == hashlib.sha256(data).hexdigest()
+
+
+def test_png_validator_rejects_damage():
+    data = png_bytes()
+    with pytest.raises(dl.PngIntegrityError, match="signature"):
+        _validate(b"GIF89a" + data[6:], 4096)
+    with pytest.raises(dl.PngIntegrityError, match="truncated"):
+        _validate(data[:-1], 4096)
+    flipped = bytearray(data)
+    flipped[len(data) // 2] ^= 0x01
+    with pytest.raises(dl.PngIntegrityError, match="CRC mismatch in IDAT"):
+        _validate(bytes(flipped), 4096)
+    with pytest.raises(dl.PngIntegrityError, match="after IEND"):
+        _validate(data + b"\0", 4096)
+
+
+def test_prepare_resume(tmp_path: Path):
+    data = png_bytes()
+    final, part = tmp_path / "MX001.png", tmp_path / "MX001.png.part"
+
+    final.write_bytes(data)
+    assert dl.prepare_resume(final, part).complete
+
+    final.write_bytes(data[:1000])  # truncated by a pre-atomic downloader
+    validator = dl.prepare_resume(final, part)
+    assert not final.exists() and part.read_bytes() == data[:1000]
+    assert validator.offset == 1000 and not validator.complete
+
+    part.write_bytes(b"not a png")
+    assert dl.prepare_resume(final, part).offset == 0
+    assert not part.exists()
+
+
+def _partial(folder: Path, data: bytes, version: str) -> None:
+    (folder / "MX001.png.part").write_bytes(data[: len(data) // 3])
+    (folder / "MX001.png.part.etag").write_text(version, encoding="utf-8")
+
+
+def test_resume_requests_only_the_missing_bytes(cdn, tmp_path: Path):
+    data = cdn.files["MX001"] = png_bytes()
+    _partial(tmp_path, data, cdn.etag("MX001"))
+
+    result = cdn.run(lambda session: dl.download_image(session, _task(tmp_path)))
+    assert result.outcome == "downloaded"
+    headers = cdn.requests[-1][2]
+    assert headers["Range"] == f"bytes={len(data) // 3}-"
+    assert headers["If-Range"] == cdn.etag("MX001")
+    assert (tmp_path / "MX001.png").read_bytes() == data
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["MX001.png"]
+
+
+def test_resume_restarts_when_the_remote_changed(cdn, tmp_path: Path):
+    _partial(tmp_path, png_bytes(seed=1), '"older-version"')
+    data = cdn.files["MX001"] = png_bytes(seed=2)
+
+    result = cdn.run(lambda session: dl.download_image(session, _task(tmp_path)))
+    assert result.outcome == "downloaded"
+    assert (tmp_path / "MX001.png").read_bytes() == data
+
+
+def test_truncated_download_leaves_no_png(cdn, tmp_path: Path):
+    cdn.files["MX001"] = png_bytes()
+    cdn.truncate.add("MX001")
+
+    result = cdn.run(lambda session: dl.download_image(session, _task(tmp_path)))
+    assert result.outcome == "transient" and "corrupt PNG" in result.note
+    assert not (tmp_path / "MX001.png").exists()
+    assert not (tmp_path / "MX001.png.part").exists()
+
+
+def test_manifest_round_trip(tmp_path: Path):
+    manifest = dl.DownloadManifest(tmp_path / dl.MANIFEST_NAME)
+    task = _task(tmp_path)
+    entry = dl.ManifestEntry('"abc"', "Wed, 21 Oct 2015 07:28:00 GMT", 1234, "f" * 64)
+    manifest.record(task, entry)
+    manifest.save()
+
+    reloaded = dl.DownloadManifest(tmp_path / dl.MANIFEST_NAME)
+    assert reloaded.get(task) == entry
+    assert reloaded.get(_task(tmp_path, size=2048)) is None  # another rendition
+
+
+def test_conditional_headers():
+    entry = dl.ManifestEntry('"abc"', "Wed, 21 Oct 2015 07:28:00 GMT", 1234, "f" * 64)
+    assert dl.conditional_headers(None, 1234) == {}
+    assert dl.conditional_headers(entry, 999) == {}  # modified locally
+    assert dl.conditional_headers(entry, 1234) == {
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT",
+    }
+    assert dl.conditional_headers(dl.ManifestEntry("", "", 1234, ""), 1234) == {}
+
+
+def test_revalidate_fetches_only_changed_images(cdn, tmp_path: Path):
+    manifest = dl.DownloadManifest(tmp_path / dl.MANIFEST_NAME)
+    task = _task(tmp_path)
+    cdn.files["MX001"] = png_bytes(seed=1)
+
+    def fetch(revalidate: bool):
+        return cdn.run(
+            lambda session: dl.download_image(session, task, manifest, revalidate)
+        )
+
+    assert fetch(False).outcome == "downloaded"
+    assert manifest.get(task).etag == cdn.etag("MX001")
+
+    assert fetch(True).outcome == "unchanged"
+    assert cdn.requests[-1][2]["If-None-Match"] == cdn.etag("MX001")
+
+    cdn.files["MX001"] = png_bytes(seed=2)
+    assert fetch(True).outcome == "updated"
+    assert (tmp_path / "MX001.png").read_bytes() == cdn.files["MX001"]
+    assert manifest.get(task).sha256 == hashlib.sha256(cdn.files["MX001"]).hexdigest()
+
+
+def test_existing_file_bootstraps_its_manifest_entry(cdn, tmp_path: Path):
+    data = png_bytes()
+    (tmp_path / "MX001.png").write_bytes(data)
+    manifest = dl.DownloadManifest(tmp_path / dl.MANIFEST_NAME)
+    task = _task(tmp_path)
+
+    result = cdn.run(lambda session: dl.download_image(session, task, manifest))
+    assert result.outcome == "existing" and not cdn.requests
+    assert manifest.get(task) == dl.ManifestEntry(
+        "", "", len(data), hashlib.sha256(data).hexdigest()
+    )
+
+
+def test_rendition_size(cdn, tmp_path: Path):
+    data = cdn.files["MX001"] = png_bytes()
+    assert cdn.run(lambda session: dl.rendition_size(session, "MX001", 512)) == len(data)
+    cdn.ranges = False  # Content-Length of a full 200 will do
+    assert cdn.run(lambda session: dl.rendition_size(session, "MX001", 512)) == len(data)
+    with pytest.raises(dl.ProbeError):
+        cdn.run(lambda session: dl.rendition_size(session, "GONE", 512))
+
+
+def test_probe_finds_the_native_size(cdn, tmp_path: Path):
+    native = 2000
+    render = np.zeros((dl.PROBE_CANVAS, dl.PROBE_CANVAS, 4), np.uint8)
+    quarter = dl.PROBE_CANVAS // 4
+    render[quarter:-quarter, quarter:-quarter] = (40, 80, 120, 255)  # fills half
+    buffer = io.BytesIO()
+    Image.fromarray(render, "RGBA").save(buffer, "PNG")
+    cdn.files["MX001"] = buffer.getvalue()
+    # Bytes grow with the product's area up to the native size, then only padding.
+    cdn.sizes["MX001"] = lambda canvas: min(canvas, native) ** 2 + canvas
+
+    probed = cdn.run(lambda session: dl.probe_task(session, _task(tmp_path, size=4608)))
+    expected = native * 0.5 / analyze_padding.TARGET_FILL
+    assert probed.width == probed.height
+    assert abs(probed.width - expected) <= dl.PROBE_PRECISION
+
+
+def test_failed_probe_downloads_the_listed_size(cdn, tmp_path: Path):
+    cdn.files["MX001"] = png_bytes()
+    cdn.statuses["MX001"] = [500]  # the probe render
+
+    async def body(session):
+        scheduler = dl.DownloadScheduler(session, dl.AdaptiveLimiter(1, 1), probe=True)
+        scheduler.submit(_task(tmp_path))
+        return await scheduler.run(1)
+
+    (result,) = cdn.run(body)
+    assert result.outcome == "downloaded" and result.task.width == 1024
+    assert cdn.requests[-1][1] == 1024
+
+
+def _store_states(store) -> Dict[str, str]:
+    return dict(store.db.execute("SELECT code, state FROM jobs"))
+
+
+def test_job_store_resumes_a_killed_run(tmp_path: Path):
+    path = tmp_path / "jobs.sqlite3"
+    tasks = [_task(tmp_path, code) for code in ("DONE", "GONE", "LATER", "KILLED")]
+    store = dl.JobStore(path)
+    store.import_tasks(tasks)
+    (tmp_path / "DONE.png").write_bytes(b"png")
+    store.start(tasks[0])
+    store.record(dl.DownloadResult(tasks[0], "downloaded"))
+    store.record(dl.DownloadResult(tasks[1], "missing", "HTTP 404"))
+    store.record(dl.DownloadResult(tasks[2], "transient", "HTTP 503"))
+    store.start(tasks[3])
+    store.close()  # killed with KILLED in flight
+
+    store = dl.JobStore(path)
+    assert _store_states(store) == {
+        "DONE": "done", "GONE": "missing", "LATER": "transient", "KILLED": "pending",
+    }
+    store.import_tasks(tasks)
+    assert [task.code for task in store.runnable()] == ["LATER", "KILLED"]
+    assert store.resolved_codes() == {"DONE", "GONE"}
+
+    store.import_tasks(tasks, retry_missing=True)
+    assert _store_states(store)["GONE"] == "pending"
+
+    (tmp_path / "DONE.png").unlink()
+    store.import_tasks(tasks[:2])  # LATER and KILLED deleted from the list
+    assert _store_states(store) == {"DONE": "pending", "GONE": "pending"}
+    store.close()
+
+
+def test_job_store_exports_new_images_once(tmp_path: Path):
+    images_csv = tmp_path / "images.csv"
+    images_csv.write_text("filename,res,hidden,colour,non_transparent\nOLD,1024,,,\n")
+    store = dl.JobStore(tmp_path / "jobs.sqlite3")
+    store.sync_images_csv(images_csv)
+    tasks = [_task(tmp_path, "OLD"), _task(tmp_path, "NEW", 4608)]
+    store.import_tasks(tasks)
+    store.record(dl.DownloadResult(tasks[0], "existing"))
+    store.record(dl.DownloadResult(_task(tmp_path, "NEW", 1600), "downloaded"))
+
+    assert store.export_images_csv(images_csv) == 1
+    assert store.export_images_csv(images_csv) == 0
+    assert images_csv.read_text().splitlines()[1:] == ["OLD,1024,,,", "NEW,1600,,,"]
+    store.close()
@@ -0,0 +1,112 @@
+"""Streamed PNG decoding and band measurement against a full Pillow decode."""
+
+from __future__ import annotations
+
+import io
+import struct
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_analysis import (
+    PNG_SIGNATURE,
+    PngBands,
+    UnstreamablePng,
+    _png_chunk,
+    measure_array,
+    measure_png,
+    rgba_array,
+)
+
+
+def _encode(image: Image.Image, **params) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", **params)
+    return buffer.getvalue()
+
+
+def _product(mode: str, size=(150, 97), seed: int = 0) -> Image.Image:
+    """Noise on a transparent canvas, the way masters have margins."""
+    rng = np.random.default_rng(seed)
+    pixels = np.zeros((size[1], size[0], 4), np.uint8)
+    pixels[30:70, 20:110] = rng.integers(0, 256, (40, 90, 4), np.uint8)
+    pixels[30:70, 20:110, 3] |= 1
+    image = Image.fromarray(pixels, "RGBA")
+    if mode == "P":
+        return image.convert("RGB").quantize(200)  # 8-bit indices
+    return image.convert(mode)
+
+
+def _streamed(data: bytes, rows: int) -> np.ndarray:
+    return np.concatenate(list(PngBands(io.BytesIO(data), rows)))
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "RGB", "LA", "L", "P"])
+@pytest.mark.parametrize("rows", [1, 7, 32, 256])
+def test_bands_match_a_full_decode(mode: str, rows: int):
+    data = _encode(_product(mode))
+    with Image.open(io.BytesIO(data)) as image:
+        expected = rgba_array(image)
+    assert np.array_equal(_streamed(data, rows), expected)
+
+
+def _raw_png(rows: list[tuple[int, bytes]], width: int, interlace: int = 0) -> bytes:
+    """An RGBA PNG from (filter type, filtered bytes) rows, as an encoder wrote them."""
+    ihdr = struct.pack(">IIBBBBB", width, len(rows), 8, 6, 0, 0, interlace)
+    raw = b"".join(bytes([kind]) + data for kind, data in rows)
+    return b"".join((
+        PNG_SIGNATURE,
+        _png_chunk(b"IHDR", ihdr),
+        _png_chunk(b"IDAT", zlib.compress(raw)),
+        _png_chunk(b"IEND", b""),
+    ))
+
+
+def test_blank_margins_under_every_filter():
+    width = 9
+    rng = np.random.default_rng(1)
+    above = [(kind, bytes(width * 4)) for kind in (0, 1, 2, 3, 4) * 3]
+    content = [(0, rng.integers(0, 256, width * 4, np.uint8).tobytes()) for _ in range(4)]
+    below = [(kind, bytes(width * 4)) for kind in (2, 4, 0, 1, 3) * 3]
+    data = _raw_png(above + content + below, width)
+    with Image.open(io.BytesIO(data)) as image:
+        expected = rgba_array(image)
+
+    bands = list(PngBands(io.BytesIO(data), 5))
+    assert np.array_equal(np.concatenate(bands), expected)
+    assert not bands[0].strides[0] and not bands[-1].strides[0]  # never unfiltered
+    # Zero bytes under content are not blank: Up and Paeth copy the row above.
+    assert bands[4].strides[0] and expected[20].any()
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "RGB", "P"])
+def test_measure_png_matches_measure_array(mode: str):
+    data = _encode(_product(mode, seed=2))
+    with Image.open(io.BytesIO(data)) as image:
+        expected = measure_array(rgba_array(image))
+    assert measure_png(io.BytesIO(data)) == expected
+    assert expected.bbox is not None
+
+
+def test_measure_png_of_an_empty_canvas():
+    data = _encode(Image.new("RGBA", (40, 30)))
+    metrics = measure_png(io.BytesIO(data))
+    assert (metrics.width, metrics.height, metrics.bbox) == (40, 30, None)
+
+
+def test_unstreamable_pngs_are_refused_up_front():
+    with pytest.raises(UnstreamablePng, match="depth 16"):
+        PngBands(io.BytesIO(_encode(Image.new("I;16", (8, 8)))))
+    # Pillow never writes Adam7, so build the interlaced file by hand.
+    interlaced = _raw_png([(0, bytes(8 * 4))] * 8, 8, interlace=1)
+    with pytest.raises(UnstreamablePng, match="interlace 1"):
+        PngBands(io.BytesIO(interlaced))
+
+
+def test_corrupt_idat_is_an_error():
+    data = bytearray(_encode(_product("RGBA")))
+    data[data.index(b"IDAT") + 20] ^= 0xFF
+    with pytest.raises(ValueError, match="CRC"):
+        list(PngBands(io.BytesIO(bytes(data))))
@@ -0,0 +1,74 @@
+"""Mipmap levels in mipmap_store.py: built on demand, stored as PNG."""
+
+from __future__ import annotations
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_analysis import MetricsCache
+from mipmap_store import MipmapStore, export_level, mipmap_key, resample
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MipmapStore(tmp_path / "mipmaps", MetricsCache(tmp_path / "metrics.sqlite3"))
+    yield store
+    store.metrics.close()
+    store.close()
+
+
+@pytest.fixture
+def master(tmp_path):
+    rng = np.random.default_rng(25)
+    pixels = np.zeros((1200, 900, 4), np.uint8)
+    pixels[100:1100, 150:750] = rng.integers(0, 256, (1000, 600, 4), np.uint8)
+    path = tmp_path / "master.png"
+    Image.fromarray(pixels, "RGBA").save(path)
+    return path
+
+
+def _stored(store: MipmapStore) -> list[int]:
+    return [edge for (edge,) in store.db.execute("SELECT edge FROM mipmaps ORDER BY edge")]
+
+
+def test_only_the_levels_asked_for_are_built(store, master):
+    files = store.build(master, (300, 1024))
+    assert sorted(files) == [512, 1024] == _stored(store)
+    assert all(path.suffix == ".png" and path.is_file() for path in files.values())
+    assert store.build(master, (5000,)) == {}  # beyond every level: the master
+    assert _stored(store) == [512, 1024]
+
+    level = store.level(master, 200)
+    assert (level.image.size, level.scale) == ((192, 256), 256 / 1200)
+    assert _stored(store) == [256, 512, 1024]
+    level.close()
+
+
+def test_levels_round_trip_the_straight_resample(store, master):
+    with Image.open(master) as image:
+        expected = np.asarray(resample(image, (384, 512)))
+    built = store.level(master, 512)
+    loaded = store.level(master, 512)  # the second time from its PNG
+    assert loaded.image.mode == "RGBA"
+    assert np.array_equal(np.asarray(built.image), expected)
+    assert np.array_equal(np.asarray(loaded.image), expected)
+    built.close()
+    loaded.close()
+
+
+def test_a_truncated_level_is_rebuilt(store, master):
+    blob = store.build(master, (512,))[512]
+    blob.write_bytes(blob.read_bytes()[:200])
+    fingerprint = store.metrics.fingerprint(master)
+    assert store._load(mipmap_key(fingerprint, 512)) is None
+    level = store.level(master, 512)
+    assert level.image.size == (384, 512)
+    level.close()
+
+
+def test_export_copies_the_level_or_the_master(store, master, tmp_path):
+    export_level(store, master, 512, tmp_path / "preview.png")
+    assert (tmp_path / "preview.png").read_bytes() == store.build(master, (512,))[512].read_bytes()
+    export_level(store, master, 2048, tmp_path / "source.png")
+    assert (tmp_path / "source.png").read_bytes() == master.read_bytes()
@@ -0,0 +1,75 @@
+"""Manifest staleness of the OG generators' incremental reruns."""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from og_pipeline import MANIFEST_NAME, OgManifest, VariantInputs, stale_jobs
+
+LAYOUT = "layout-1"
+
+
+@pytest.fixture
+def page(tmp_path: Path):
+    """One page with two variants, both rendered and recorded."""
+    masters = [tmp_path / "M1.png", tmp_path / "M2.png"]
+    jobs = []
+    for number in (1, 2):
+        background = tmp_path / f"page-{number}.png"
+        transparent = tmp_path / f"page-{number}-transparent.png"
+        background.write_bytes(b"bg")
+        transparent.write_bytes(b"fg")
+        layers = [({"SKU": f"SKU{number}{i}"}, master) for i, master in enumerate(masters)]
+        jobs.append((number, layers, background, transparent, f"page #{number}"))
+    planned = [("page", jobs)]
+    fingerprints = {masters[0]: "aaa", masters[1]: "bbb"}
+    manifest = OgManifest(tmp_path / MANIFEST_NAME)
+    _, inputs = stale_jobs(planned, manifest, LAYOUT, fingerprints)
+    for background, (transparent, variant) in inputs.items():
+        manifest.record(background, transparent, variant)
+    manifest.save()
+    return tmp_path, planned, fingerprints
+
+
+def _stale(directory: Path, planned, fingerprints, layout: str = LAYOUT, force: bool = False):
+    manifest = OgManifest(directory / MANIFEST_NAME)
+    stale, _ = stale_jobs(planned, manifest, layout, fingerprints, force)
+    return [job[0] for _, jobs in stale for job in jobs]
+
+
+def test_manifest_round_trips(page):
+    directory, planned, fingerprints = page
+    manifest = OgManifest(directory / MANIFEST_NAME)
+    transparent, inputs = manifest.entries["page-1.png"]
+    assert transparent == "page-1-transparent.png"
+    assert inputs == VariantInputs(
+        "page", 1, ("SKU10", "SKU11"), ("M1.png:aaa", "M2.png:bbb"), LAYOUT
+    )
+    assert _stale(directory, planned, fingerprints) == []
+
+
+def test_changed_master_or_layout_makes_variants_stale(page):
+    directory, planned, fingerprints = page
+    second_master = planned[0][1][0][1][1][1]
+    assert _stale(directory, planned, {**fingerprints, second_master: "ccc"}) == [1, 2]
+    assert _stale(directory, planned, fingerprints, layout="layout-2") == [1, 2]
+    assert _stale(directory, planned, fingerprints, force=True) == [1, 2]
+
+
+def test_changed_selection_or_missing_file_makes_one_variant_stale(page):
+    directory, planned, fingerprints = page
+    number, layers, background, transparent, line = planned[0][1][1]
+    reselected = [({"SKU": "OTHER"}, layers[0][1]), layers[1]]
+    changed = [("page", [planned[0][1][0], (number, reselected, background, transparent, line)])]
+    assert _stale(directory, changed, fingerprints) == [2]
+
+    (directory / "page-1-transparent.png").unlink()
+    assert _stale(directory, planned, fingerprints) == [1]
+
+
+def test_unreadable_master_is_never_current(page):
+    directory, planned, fingerprints = page
+    unreadable = {master: "" for master in fingerprints}
+    assert _stale(directory, planned, unreadable) == [1, 2]
@@ -0,0 +1,145 @@
+"""OG variant planning: SelectionSpace against brute-force enumeration."""
+
+from __future__ import annotations
+
+import itertools
+import random
+from pathlib import Path
+
+import pytest
+
+import generate_ipad_og_images as ipad
+import generate_og_images as iphone
+
+# (SKU, model, colour, kind): enough overlap that picks tie and buckets repeat.
+CASES = [
+    ("A1", "15", "Black", "Silicone Case"),
+    ("A2", "15", "Black", "Silicone Case"),
+    ("A3", "15", "Blue", "Clear Case"),
+    ("B1", "15 Plus", "Black", "Silicone Case"),
+    ("B2", "15 Plus", "Pink", "Silicone Case"),
+    ("C1", "15 Pro", "Blue", "Silicone Case"),
+    ("C2", "15 Pro", "Pink", "Leather Case"),
+]
+
+
+def _candidates(cases) -> list[tuple[dict[str, str], Path]]:
+    return [
+        ({"SKU": sku, "model": model, "colour": colour, "kind": kind}, Path(f"{sku}.png"))
+        for sku, model, colour, kind in cases
+    ]
+
+
+def _signatures(arrangements) -> list[tuple[str, ...]]:
+    return [tuple(row["SKU"] for row, _ in selection) for selection in arrangements]
+
+
+def _greedy_selections(candidates) -> set[frozenset[str]]:
+    """Every set of four choose_cases can pick: any tied lowest key may win."""
+    rows = [row for row, _ in candidates]
+    found: set[frozenset[str]] = set()
+
+    def pick(chosen: list[dict[str, str]]) -> None:
+        if len(chosen) == iphone.CASES_PER_IMAGE:
+            found.add(frozenset(row["SKU"] for row in chosen))
+            return
+        colours = {row["colour"].casefold() for row in chosen}
+
+        def key(row):
+            return (
+                sum(other["model"] == row["model"] for other in chosen),
+                row["colour"].casefold() in colours,
+                sum(other["kind"] == row["kind"] for other in chosen),
+            )
+
+        remaining = [row for row in rows if row not in chosen]
+        best = min(map(key, remaining))
+        for row in remaining:
+            if key(row) == best:
+                pick(chosen + [row])
+
+    pick([])
+    return found
+
+
+def _brute_force_iphone(candidates, expected_models: int | None) -> set[tuple[str, ...]]:
+    by_sku = {row["SKU"]: (row, path) for row, path in candidates}
+    arrangements: set[tuple[str, ...]] = set()
+    for skus in _greedy_selections(candidates):
+        selection = [by_sku[sku] for sku in sorted(skus)]
+        if expected_models is None:
+            arrangements.update(itertools.permutations(sorted(skus)))
+            continue
+        if len({row["model"] for row, _ in selection}) != expected_models:
+            continue
+        for seed in range(300):  # at most 24 layouts; every one is hit
+            arranged = iphone.arrange_models_symmetrically(
+                selection.copy(), random.Random(seed)
+            )
+            arrangements.add(tuple(row["SKU"] for row, _ in arranged))
+    return arrangements
+
+
+@pytest.mark.parametrize("expected_models", [None, 2, 3])
+@pytest.mark.parametrize("size", [5, 6, 7])
+def test_iphone_selection_space_matches_brute_force(size: int, expected_models):
+    candidates = _candidates(CASES[:size])
+    space = iphone.SelectionSpace(candidates, expected_models)
+    expected = _brute_force_iphone(candidates, expected_models)
+    enumerated = _signatures(space.arrangements(random.Random(0)))
+    assert space.total == len(expected) == len(enumerated)
+    assert set(enumerated) == expected
+
+
+def test_iphone_samples_stay_inside_the_space():
+    candidates = _candidates(CASES)
+    reachable = _brute_force_iphone(candidates, None)
+    keyed = iphone.keyed_cases(candidates)
+    for seed in range(500):
+        picked = iphone.choose_cases(keyed, random.Random(seed))
+        assert tuple(row["SKU"] for row, _ in picked) in reachable
+
+
+def _brute_force_ipad(candidates) -> set[tuple[str, str]]:
+    rows = [row for row, _ in candidates]
+    pairs: set[tuple[str, str]] = set()
+    for first in rows:
+        others = [row for row in rows if row["SKU"] != first["SKU"]]
+
+        def key(row):
+            return (
+                row["model"] == first["model"],
+                row["colour"].casefold() == first["colour"].casefold(),
+                row["kind"] == first["kind"],
+            )
+
+        best = min(map(key, others))
+        for row in others:
+            if key(row) == best:
+                pairs.add((first["SKU"], row["SKU"]))
+                pairs.add((row["SKU"], first["SKU"]))
+    return pairs
+
+
+@pytest.mark.parametrize("size", [2, 4, 7])
+def test_ipad_selection_space_matches_brute_force(size: int):
+    candidates = _candidates(CASES[:size])
+    space = ipad.SelectionSpace(candidates)
+    expected = _brute_force_ipad(candidates)
+    enumerated = _signatures(space.arrangements(random.Random(0)))
+    assert space.total == len(expected) == len(enumerated)
+    assert set(enumerated) == expected
+
+
+def test_plans_use_up_the_space_and_then_refuse():
+    candidates = _candidates(CASES[:5])
+    total = iphone.SelectionSpace(candidates, None).total
+    plan = iphone.plan_variants(candidates, [], "small", total)
+    assert len(set(_signatures(plan))) == total
+    with pytest.raises(ValueError, match=f"only {total} unique variants"):
+        iphone.plan_variants(candidates, [], "small", total + 1)
+
+    total = ipad.SelectionSpace(candidates).total
+    assert len(set(_signatures(ipad.plan_variants(candidates, "small", total)))) == total
+    with pytest.raises(ValueError, match=f"only {total} unique variants"):
+        ipad.plan_variants(candidates, "small", total + 1)
@@ -0,0 +1,74 @@
+"""Page-affine sharding of OG render jobs in og_pipeline.py."""
+
+from __future__ import annotations
+
+import time
+
+import pytest
+
+from og_pipeline import ShardResult, first_errors, run_shards, shard_pages
+
+WORKERS = 4
+
+
+def _pages(*counts: int) -> list[tuple[str, list[str]]]:
+    return [
+        (f"page{page}", [f"page{page}-{job}" for job in range(count)])
+        for page, count in enumerate(counts)
+    ]
+
+
+def test_shards_keep_pages_together_when_pages_are_plenty():
+    pages = _pages(5, 3, 1, 2, 4)
+    assert shard_pages(pages, WORKERS) == pages
+
+
+def test_scarce_pages_split_into_contiguous_chunks():
+    shards = shard_pages(_pages(10, 3), WORKERS)
+    assert shards == [
+        ("page0", ["page0-0", "page0-1", "page0-2", "page0-3", "page0-4"]),
+        ("page0", ["page0-5", "page0-6", "page0-7", "page0-8", "page0-9"]),
+        ("page1", ["page1-0", "page1-1"]),
+        ("page1", ["page1-2"]),
+    ]
+    assert shard_pages(_pages(0), WORKERS) == []
+
+
+def _start() -> None:
+    """Per-process setup; the render below needs none."""
+
+
+def render(page: str, jobs: list[str]) -> ShardResult:
+    """Stand-in renderer: a job named "...fail" fails, "...slow" takes a while."""
+    result = ShardResult(page)
+    for job in jobs:
+        if job.endswith("slow"):
+            time.sleep(0.3)
+        if job.endswith("fail"):
+            result.error = RuntimeError(job)
+            break
+        result.lines.append(job)
+    return result
+
+
+@pytest.mark.parametrize("workers", [1, WORKERS])
+def test_a_page_stops_at_its_first_failing_shard(workers: int):
+    shards = [
+        ("a", ["a0-slow"]),
+        ("a", ["a1", "a1-fail", "a1-never"]),
+        ("a", ["a2"]),          # finishes early, but comes after the failure
+        ("b", ["b0"]),
+        ("b", ["b1"]),
+    ]
+    results = list(run_shards(shards, render, workers, _start))
+    indices = [index for index, _ in results]
+    assert sorted(indices) == [0, 1, 3, 4]
+    for page in ("a", "b"):  # each page in shard order
+        mine = [index for index in indices if shards[index][0] == page]
+        assert mine == sorted(mine)
+
+    by_index = dict(results)
+    assert by_index[1].lines == ["a1"]
+    assert {page: str(error) for page, error in first_errors(by_index).items()} == {
+        "a": "a1-fail"
+    }